@@ -23,12 +23,13 @@ import math
 import time
 from bs4 import BeautifulSoup
 from txtai.embeddings import Embeddings
-from Modules.update_embeddings import update_embeddings
+from Modules.update_embeddings import update_embeddings_from_csv, EMBEDDINGS_FILE_NAME, EMBEDDINGS_MANIFEST_FILE_NAME
+from Modules.custom_data_store import ensure_custom_data_store, load_custom_data_store, get_next_custom_data_file_path
 
 # Convoscope
 from Modules.Summarizer import Summarizer
 import Modules.word_frequency as word_frequency
-from constants import CUSTOM_USER_DATA_PATH, USE_GPU_FOR_INFERENCING, SUMMARIZE_CUSTOM_DATA, DEFINE_RARE_WORDS, IMAGE_PATH
+from constants import CUSTOM_USER_DATA_PATH, USE_GPU_FOR_INFERENCING, SUMMARIZE_CUSTOM_DATA, DEFINE_RARE_WORDS, IMAGE_PATH, CUSTOM_DATA_RELOAD_CHECK_INTERVAL
 from server_config import google_maps_api_key
 
 # Google NLP
@@ -96,6 +97,11 @@ class ContextualSearchEngine:
         self.custom_data = dict()
         self.custom_embeddings = dict()
 
+        # version of the compiled custom data and embeddings index each user has loaded, and when we last checked for changes
+        self.custom_data_versions = dict()
+        self.custom_embeddings_versions = dict()
+        self.custom_data_last_checked = dict()
+
         self.banned_words = set(stopwords.words(
             "english") + ["mit", "MIT", "Media", "media", "really", "yeah", "we're", "thing", "going", "hey", "that", "OK", "like", "right", "one", "I'm", "to", "pretty", "I", "think", "so", "get", "has", "have"])
 
@@ -139,26 +145,7 @@ class ContextualSearchEngine:
         return filtered_results
 
     async def load_user_data(self, user_id):
-        user_folder_path = os.path.join('custom_data', str(user_id))
-
-        # List all CSV files in the user-specific folder
-        csv_files = [f for f in os.listdir(
-            user_folder_path) if f.endswith('.csv')]
-
-        # Read each CSV into a DataFrame
-        dfs = [pd.read_csv(os.path.join(user_folder_path, csv_file))
-               for csv_file in csv_files]
-
-        # Concatenate all DataFrames into a single DataFrame
-        concatenated_df = pd.concat(dfs, ignore_index=True)
-
-        self.custom_data[user_id] = concatenated_df
-
-        # load user data embeddings
-        print(f"Loading embeddings for {user_id}...")
-        self.custom_embeddings[user_id].load(
-            f"{user_folder_path}/custom_data_embeddings.txtai")
-        print(f"-- Loaded embeddings for {user_id}...")
+        self.load_custom_user_data(user_id)
 
     def get_google_static_map_img(self, place, zoom=3):
         url = "https://maps.googleapis.com/maps/api/staticmap"
@@ -298,22 +285,14 @@ class ContextualSearchEngine:
     def upload_custom_user_data(self, user_id, df):
         user_folder_path = self.get_custom_data_folder(user_id)
 
-        # Determine the next available file number
-        existing_files = [f for f in os.listdir(
-            user_folder_path) if f.startswith('data') and f.endswith('.csv')]
-        existing_numbers = [int(f[4:-4]) for f in existing_files]
-        next_file_num = 1 if not existing_numbers else max(
-            existing_numbers) + 1
-
         # Save the DataFrame with the next available file number
-        df_file_path = os.path.join(
-            user_folder_path, f'data{next_file_num}.csv')
+        df_file_path = get_next_custom_data_file_path(user_folder_path)
         df.to_csv(df_file_path, index=False)
 
         # print(f"Data saved to: {df_file_path}")
 
-        # Update the embeddings
-        update_embeddings(df, user_id)
+        # Update the embeddings, streaming the saved file through the summarization stage
+        update_embeddings_from_csv(df_file_path, user_id)
 
         self.load_custom_user_data(user_id)
 
@@ -332,51 +311,86 @@ class ContextualSearchEngine:
 
         return user_folder_path
 
-    # Run this if the user does not have custom data loaded, or after a new data upload
-    def load_custom_user_data(self, user_id):
-        user_folder_path = self.get_custom_data_folder(user_id)
-
-        # List all CSV files in the user-specific folder
-        csv_files = [f for f in os.listdir(
-            user_folder_path) if f.endswith('.csv')]
+    def get_custom_embeddings_version(self, user_folder_path):
+        # the embeddings manifest is written after the index is saved, so its mtime marks a finished rebuild
+        manifest_path = os.path.join(user_folder_path, EMBEDDINGS_MANIFEST_FILE_NAME)
+        return os.path.getmtime(manifest_path) if os.path.exists(manifest_path) else None
 
-        # print("FOUND FILES FOR {user_id}: ")
-        # print(csv_files)
-
-        # Read each CSV into a DataFrame
-        dfs = [pd.read_csv(os.path.join(user_folder_path, csv_file))
-               for csv_file in csv_files]
-
-        # Concatenate all DataFrames into a single DataFrame
-        if dfs:
-            concatenated_df = pd.concat(dfs, ignore_index=True)
-
-            concatenated_df = concatenated_df.dropna(subset=['title'])
+    def load_custom_user_data_table(self, user_id, manifest):
+        user_folder_path = self.get_custom_data_folder(user_id)
 
+        concatenated_df = load_custom_data_store(user_folder_path, manifest)
+        if not concatenated_df.empty:
             self.custom_data[user_id] = concatenated_df
         else:
             self.custom_data[user_id] = dict()
+        self.custom_data_versions[user_id] = manifest["version"]
 
         # print("SETUP CUSTOM DATA FOR USER {}, CUSTOM DATA FRAME IS BELOW:".format(user_id))
         # print(self.custom_data[user_id])
 
+    def load_custom_user_embeddings(self, user_id):
+        user_folder_path = self.get_custom_data_folder(user_id)
+
         # setup custom embeddings for user
-        custom_embeddings_path = f"{self.user_custom_data_path}/{user_id}/custom_data_embeddings.txtai"
+        custom_embeddings_path = os.path.join(user_folder_path, EMBEDDINGS_FILE_NAME)
         # print(f"Loading embeddings for {user_id}...")
-        self.custom_embeddings[user_id] = Embeddings(
+        custom_embeddings = Embeddings(
             {"path": "sentence-transformers/paraphrase-MiniLM-L3-v2", "content": True})
         if (os.path.exists(custom_embeddings_path)):
-            self.custom_embeddings[user_id].load(custom_embeddings_path)
+            custom_embeddings.load(custom_embeddings_path)
             # print(f"-- Populated embeddings loaded for {user_id}...")
         # else:
             # print(f"-- Empty embeddings only loaded for {user_id}...")
+        self.custom_embeddings[user_id] = custom_embeddings
+        self.custom_embeddings_versions[user_id] = self.get_custom_embeddings_version(user_folder_path)
+
+    # Run this if the user does not have custom data loaded, or after a new data upload
+    def load_custom_user_data(self, user_id):
+        user_folder_path = self.get_custom_data_folder(user_id)
+
+        # only re-parses the user's csvs if they changed since the store was last compiled
+        manifest = ensure_custom_data_store(user_folder_path)
+        self.load_custom_user_data_table(user_id, manifest)
+        self.load_custom_user_embeddings(user_id)
+        self.custom_data_last_checked[user_id] = time.time()
+
+    def reload_custom_user_data_if_changed(self, user_id):
+        if user_id not in self.custom_data_versions:
+            self.load_custom_user_data(user_id)
+            return
+
+        if time.time() - self.custom_data_last_checked[user_id] < CUSTOM_DATA_RELOAD_CHECK_INTERVAL:
+            return
+        self.custom_data_last_checked[user_id] = time.time()
+
+        # hot-reload whatever changed on disk since we loaded it, without restarting the CSE
+        user_folder_path = self.get_custom_data_folder(user_id)
+        manifest = ensure_custom_data_store(user_folder_path)
+        if manifest["version"] != self.custom_data_versions[user_id]:
+            print("Custom data changed for {}, reloading".format(user_id))
+            self.load_custom_user_data_table(user_id, manifest)
+        if self.get_custom_embeddings_version(user_folder_path) != self.custom_embeddings_versions[user_id]:
+            print("Custom data embeddings changed for {}, reloading".format(user_id))
+            self.load_custom_user_embeddings(user_id)
 
     def custom_data_proactive_search(self, user_id, talk):
+        # match, then summarize every match - cse_loop runs these stages itself so it can filter in between
         if talk.strip() == "":
             return
 
-        if not self.does_user_have_custom_data_loaded(user_id):
-            self.load_custom_user_data(user_id)
+        entities = self.match_custom_data_entities(user_id, talk)
+        return self.summarize_custom_data_entities(user_id, list(entities.values()))
+
+    def match_custom_data_entities(self, user_id, talk):
+        """
+        Match stage of the CSE: returns {entity name: entity} for the custom data entities (and rare words) found in talk,
+        with the raw description in "summary".
+        """
+        if talk.strip() == "":
+            return dict()
+
+        self.reload_custom_user_data_if_changed(user_id)
 
         # build response object from various processing sources
         response = dict()
@@ -464,17 +478,38 @@ class ContextualSearchEngine:
         response.update(entities_custom)
         response.update(entities_semantic_custom)
 
-        # find rare words (including acronyms) and define them
+        return response
+
+    def does_entity_need_summary(self, entity):
+        # summarize entity if greater than n words long
+        description = entity["summary"]
+        return (description != None) and (len(description.split(" ")) > 14)
+
+    def summarize_custom_data_entities(self, user_id, entities):
+        """
+        Summarize stage of the CSE: summarizes the long descriptions of the given entities in one LLM call,
+        and returns them as results ready to be stored, or None if there are none.
+        """
+        if not entities:
+            return None
+        response = {entity["name"]: entity for entity in entities}
+
         summaries_context = self.db_handler.get_transcripts_from_last_nseconds_for_user_as_string(user_id, 180)
         
-        # build response and summarize long entity descriptions
+        # summarize entities greater than n words long, all in one LLM call
+        long_descriptions = dict()
+        for entity_name in response.keys():
+            if self.does_entity_need_summary(response[entity_name]):
+                long_descriptions[entity_name] = response[entity_name]["summary"]
+        summaries = self.summarizer.summarize_entities(long_descriptions, context=summaries_context) if long_descriptions else dict()
+
+        # build response
         for entity_name in response.keys():
             # get description
             description = response[entity_name]["summary"]
 
-            # summarize entity if greater than n words long
-            if (description != None) and (description != None) and (len(description.split(" ")) > 14):
-                summary = self.summarizer.summarize_entity(description, context=summaries_context)
+            if entity_name in summaries:
+                summary = summaries[entity_name]
             elif description != None:
                 summary = description
             else:
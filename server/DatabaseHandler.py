@@ -1,14 +1,19 @@
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
+from pymongo import ReturnDocument, ASCENDING, UpdateOne
+from pymongo.errors import OperationFailure
 import time
+import datetime
 import agents.wake_words
 import math
-from hashlib import sha256
 from server_config import database_uri, clear_users_on_start, clear_cache_on_start
+from constants import SUMMARY_CACHE_TTL, RELEVANCE_FILTER_TIME
 import uuid
 import logging
 from logger_config import logger
 
+INDEX_OPTIONS_CONFLICT = 85 # mongo's error code for an index that exists with different options
+
 class DatabaseHandler:
     def __init__(self, parent_handler=True):
         print("INITTING DB HANDLER")
@@ -37,6 +42,7 @@ class DatabaseHandler:
             self.init_cache_collection()
             self.init_insights_collections()
             self.init_ratings_collection()
+            self.init_custom_data_jobs_collection()
             self.ready = True
         except Exception as e:
             print(e)
@@ -50,6 +56,12 @@ class DatabaseHandler:
     def init_cache_collection(self):
         self.cache_db = self.client['cache']
         self.cache_collection = self.get_collection(self.cache_db, 'cache', wipe=clear_cache_on_start)
+        self.cache_collection.create_index("key")
+        self.create_ttl_index(self.cache_collection, "created_at", SUMMARY_CACHE_TTL)
+        # entities resolved to a url and image, shared by every user. each item expires at its own expires_at
+        self.entity_searches_collection = self.get_collection(self.cache_db, 'entity_searches', wipe=clear_cache_on_start)
+        self.entity_searches_collection.create_index("key")
+        self.entity_searches_collection.create_index("expires_at", expireAfterSeconds=0)
 
     def init_insights_collections(self):
         self.results_db = self.client['results']
@@ -58,11 +70,20 @@ class DatabaseHandler:
         self.agent_explicit_insights_results_collection = self.get_collection(self.results_db, 'agent_explicit_insights_results', wipe=clear_cache_on_start)
         self.agent_insights_results_collection = self.get_collection(self.results_db, 'agent_insights_results', wipe=clear_cache_on_start)
         self.agent_proactive_definer_collection = self.get_collection(self.results_db, 'agent_proactive_definer_results', wipe=clear_cache_on_start)
+        self.recently_shown_terms_collection = self.get_collection(self.results_db, 'recently_shown_terms', wipe=clear_cache_on_start)
+        self.recently_shown_terms_collection.create_index([("user_id", ASCENDING), ("name", ASCENDING)], unique=True)
+        self.create_ttl_index(self.recently_shown_terms_collection, "shown_at", RELEVANCE_FILTER_TIME)
 
     def init_ratings_collection(self):
         self.ratings_db = self.client['ratings']
         self.ratings_collection = self.get_collection(self.ratings_db, 'ratings')
 
+    def init_custom_data_jobs_collection(self):
+        # never wiped on start, queued uploads have to survive a restart
+        self.jobs_db = self.client['jobs']
+        self.custom_data_jobs_collection = self.get_collection(self.jobs_db, 'custom_data_jobs')
+        self.custom_data_jobs_collection.create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+
     def get_collection(self, db, collection_name, wipe = False):
         if collection_name in db.list_collection_names():
             collection = db.get_collection(collection_name)
@@ -73,6 +94,15 @@ class DatabaseHandler:
         else:
             return db.create_collection(collection_name)
 
+    def create_ttl_index(self, collection, field, expire_after_seconds):
+        try:
+            collection.create_index(field, expireAfterSeconds=expire_after_seconds)
+        except OperationFailure as e:
+            # the TTL constant changed since the index was made, mongo won't remake it with new options so update it in place
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            collection.database.command("collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": expire_after_seconds})
+
     ### MISC ###
 
     # Returns the index of the nearest beginning of a word before "curr_index"
@@ -122,19 +152,82 @@ class DatabaseHandler:
 
     ### CACHE ###
 
-    def find_cached_summary(self, long_description):
-        description_hash = sha256(long_description.encode("utf-8")).hexdigest()
-        filter = {"description": description_hash}
+    def find_cached_summary(self, cache_key):
+        # mongo only purges expired items once a minute, so check the age here too
+        oldest_valid_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=SUMMARY_CACHE_TTL)
+        filter = {"key": cache_key, "created_at": {"$gt": oldest_valid_time}}
         item = self.cache_collection.find_one(filter)
         if item and 'summary' in item:
             return item['summary']
         else:
             return None
 
-    def save_cached_summary(self, long_description, summary):
-        description_hash = sha256(long_description.encode("utf-8")).hexdigest()
-        item = {"description": description_hash, "summary": summary}
-        self.cache_collection.insert_one(item)
+    def save_cached_summary(self, cache_key, summary):
+        self.cache_collection.update_one(
+            {"key": cache_key},
+            {"$set": {"summary": summary, "created_at": datetime.datetime.utcnow()}},
+            upsert=True)
+
+    def find_cached_entity(self, cache_key):
+        filter = {"key": cache_key, "expires_at": {"$gt": datetime.datetime.utcnow()}}
+        item = self.entity_searches_collection.find_one(filter, {'_id': 0})
+        return item['entity'] if item else None
+
+    def save_cached_entity(self, cache_key, entity, ttl):
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        self.entity_searches_collection.update_one(
+            {"key": cache_key}, {"$set": {"entity": entity, "expires_at": expires_at}}, upsert=True)
+
+    ### CUSTOM DATA JOBS ###
+
+    def add_custom_data_job(self, user_id, upload_path, job_id=None):
+        job_id = job_id if job_id is not None else str(uuid.uuid4())
+        now = time.time()
+        job = {"job_id": job_id,
+               "user_id": user_id,
+               "upload_path": upload_path,
+               "status": "queued",
+               "rows_done": 0,
+               "rows_total": None,
+               "error": None,
+               "created_at": now,
+               "updated_at": now}
+        self.custom_data_jobs_collection.insert_one(job)
+        return job_id
+
+    def claim_next_custom_data_job(self):
+        # atomically move the oldest queued job to running, so only one worker ever picks it up
+        return self.custom_data_jobs_collection.find_one_and_update(
+            {"status": "queued"},
+            {"$set": {"status": "running", "updated_at": time.time()}},
+            sort=[("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def requeue_running_custom_data_jobs(self):
+        # a job still marked running when the worker starts was interrupted by a restart
+        res = self.custom_data_jobs_collection.update_many(
+            {"status": "running"},
+            {"$set": {"status": "queued", "updated_at": time.time()}})
+        return res.modified_count
+
+    def update_custom_data_job_progress(self, job_id, rows_done, rows_total):
+        self.custom_data_jobs_collection.update_one(
+            {"job_id": job_id},
+            {"$set": {"rows_done": rows_done, "rows_total": rows_total, "updated_at": time.time()}})
+
+    def set_custom_data_job_data_path(self, job_id, data_path):
+        # where the upload is moved to, recorded before the move so a requeued job can still find its csv
+        self.custom_data_jobs_collection.update_one(
+            {"job_id": job_id},
+            {"$set": {"data_path": data_path, "updated_at": time.time()}})
+
+    def finish_custom_data_job(self, job_id, status, error=None):
+        self.custom_data_jobs_collection.update_one(
+            {"job_id": job_id},
+            {"$set": {"status": status, "error": error, "updated_at": time.time()}})
+
+    def get_custom_data_job_for_user(self, user_id, job_id):
+        return self.custom_data_jobs_collection.find_one({"job_id": job_id, "user_id": user_id}, {"_id": 0})
 
     ### TRANSCRIPTS ###
 
@@ -354,11 +447,12 @@ class DatabaseHandler:
         transcripts = []
         for user in users:
             user_id = user['user_id']
-            transcript_string = self.get_transcripts_from_last_nseconds_for_user_as_string(
-                user_id, n)
+            recent_transcripts = self.get_transcripts_from_last_nseconds_for_user(user_id, n)
+            transcript_string = self.stringify_transcripts(transcript_list=recent_transcripts)
             if transcript_string:
+                # timestamp of the newest transcript, what proactive work derives its deadline from
                 transcripts.append(
-                    {'user_id': user_id, 'text': transcript_string})
+                    {'user_id': user_id, 'text': transcript_string, 'timestamp': max(t['timestamp'] for t in recent_transcripts)})
 
         return transcripts
     
@@ -490,15 +584,21 @@ class DatabaseHandler:
 
         return query_uuid
 
-    def add_explicit_insight_result_for_user(self, user_id, query, insight):
+    # pass the insight_uuid of a partial result to replace it. partial results are shown but not consumed,
+    # so clients keep getting the latest partial until the complete result replaces it under the same uuid
+    def add_explicit_insight_result_for_user(self, user_id, query, insight, insight_uuid=None, partial=False):
         insight_time = math.trunc(time.time())
-        insight_uuid = str(uuid.uuid4())
+        if insight_uuid is None: insight_uuid = str(uuid.uuid4())
         insight_obj = {'timestamp': insight_time, 'uuid': insight_uuid, 'query': query, 'insight': insight}
-        self.agent_explicit_insights_results_collection.insert_one(insight_obj)
+        if partial: insight_obj['partial'] = True
+        res = self.agent_explicit_insights_results_collection.replace_one({'uuid': insight_uuid}, insight_obj, upsert=True)
 
-        filter = {"user_id": user_id}
-        update = {"$push": {"agent_explicit_insights_result_ids": insight_uuid}}
-        self.user_collection.update_one(filter=filter, update=update)
+        if res.upserted_id is not None:
+            filter = {"user_id": user_id}
+            update = {"$push": {"agent_explicit_insights_result_ids": insight_uuid}}
+            self.user_collection.update_one(filter=filter, update=update)
+
+        return insight_uuid
 
     def get_explicit_query_history_for_user(self, user_id, device_id = None, should_consume=True, include_consumed=False):
         return self.get_results_for_user_device("agent_explicit_query_ids", user_id, device_id, should_consume, include_consumed)
@@ -543,6 +643,7 @@ class DatabaseHandler:
             {
                 "$project": {
                     "_id": 0,
+                    "embedding": 0,
                 }
             },
         ]
@@ -571,6 +672,7 @@ class DatabaseHandler:
             {
                 "$project": {
                     "_id": 0,
+                    "embedding": 0,
                 }
             },
         ]
@@ -580,6 +682,12 @@ class DatabaseHandler:
 
         return results
 
+    def get_recent_nminutes_agent_insight_embeddings_for_user(self, user_id, n_minutes=30):
+        uuid_list = self.get_user(user_id)["agent_insights_result_ids"]
+        timestamp_threshold = math.trunc(time.time()) - n_minutes * 60
+        filter = {"uuid": {"$in": uuid_list}, "timestamp": {"$gte": timestamp_threshold}, "embedding": {"$exists": True}}
+        return [res["embedding"] for res in self.agent_insights_results_collection.find(filter, {"_id": 0, "embedding": 1})]
+
     def get_proactive_agents_insights_results_for_user_device(self, user_id, device_id, should_consume=True, include_consumed=False):
         return self.get_results_for_user_device("agent_insights_result_ids", user_id, device_id, should_consume, include_consumed)
 
@@ -594,10 +702,24 @@ class DatabaseHandler:
                 previously_defined_terms.append(result)
         return previously_defined_terms
 
-    def add_agent_insight_result_for_user(self, user_id, agent_name, agent_insight, agent_references=None, agent_motive=None):
+    def add_recently_shown_terms_for_user(self, user_id, names):
+        if not names: return
+
+        shown_at = datetime.datetime.utcnow()
+        updates = [UpdateOne({"user_id": user_id, "name": name}, {"$set": {"shown_at": shown_at}}, upsert=True) for name in names]
+        self.recently_shown_terms_collection.bulk_write(updates, ordered=False)
+
+    def get_recently_shown_terms_for_user(self, user_id):
+        oldest_valid_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=RELEVANCE_FILTER_TIME)
+        terms = self.recently_shown_terms_collection.find({"user_id": user_id, "shown_at": {"$gt": oldest_valid_time}})
+        return [{"name": term["name"], "shown_at": term["shown_at"].replace(tzinfo=datetime.timezone.utc).timestamp()} for term in terms]
+
+    # embedding is the insight's unit length MiniLM embedding, kept so later insights can be checked for near duplicates
+    def add_agent_insight_result_for_user(self, user_id, agent_name, agent_insight, agent_references=None, agent_motive=None, embedding=None):
         insight_time = math.trunc(time.time())
         insight_uuid = str(uuid.uuid4())
         insight_obj = {'timestamp': insight_time, 'uuid': insight_uuid, 'agent_name': agent_name, 'agent_insight': agent_insight, 'agent_references': agent_references, 'agent_motive': agent_motive}
+        if embedding is not None: insight_obj['embedding'] = [float(x) for x in embedding]
         self.agent_insights_results_collection.insert_one(insight_obj)
         
         filter = {"user_id": user_id}
@@ -740,7 +862,7 @@ class DatabaseHandler:
         if res: return res
         res = self.agent_explicit_insights_results_collection.find_one(filter, {'_id': 0})
         if res: return res
-        res = self.agent_insights_results_collection.find_one(filter, {'_id': 0})
+        res = self.agent_insights_results_collection.find_one(filter, {'_id': 0, 'embedding': 0})
         if res: return res
         res = self.agent_proactive_definer_collection.find_one(filter, {'_id': 0})
         if res: return res
@@ -759,10 +881,11 @@ class DatabaseHandler:
         new_results = []
         for uuid in result_ids:
             if uuid not in already_consumed_ids:
-                if should_consume:
+                result = self.get_result_from_uuid(uuid)
+                # partial results get sent again until they're complete
+                if should_consume and not (result is not None and result.get('partial')):
                     self.add_consumed_result_id_for_user_device(
                         user_id, device_id, uuid)
-                result = self.get_result_from_uuid(uuid)
                 if result is not None: new_results.append(result)
         return new_results
     
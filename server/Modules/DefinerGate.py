@@ -0,0 +1,152 @@
+# cheap local check for whether a transcript window could have a rare entity in it for the definer to define,
+# so windows of everyday words aren't sent to the LLM every 10s
+# looks for rare words (word_frequency), unusual capitalized words and acronyms mid-sentence, and the user's custom data titles
+import os
+import re
+import time
+from nltk.corpus import stopwords
+
+import Modules.word_frequency as word_frequency
+from Modules.custom_data_store import ensure_custom_data_store, load_custom_data_store
+from constants import CUSTOM_USER_DATA_PATH, CUSTOM_DATA_RELOAD_CHECK_INTERVAL, DEFINER_GATE_RARE_WORD_SCORE, \
+    DEFINER_GATE_PROPER_NOUN_SCORE, DEFINER_GATE_MIN_WORD_LENGTH
+import helpers.metrics as metrics
+
+# reasons check() gives, a window that passes gives the first rule that found a candidate
+PASS_CUSTOM_DATA = "custom_data"
+PASS_PROPER_NOUN = "proper_noun"
+PASS_RARE_WORD = "rare_word"
+SKIP_NO_CANDIDATES = "no_candidates"
+
+# words with letters in any language, keeping "don't" and "Bolívar's" whole
+WORD_PATTERN = re.compile(r"[^\W\d_]+(?:['’][^\W\d_]+)*")
+MAX_CUSTOM_DATA_TITLE_WORDS = 5
+
+
+def get_base_word(word):
+    # "people's" -> "people", "I'm" -> "I"
+    return re.split(r"['’]", word)[0]
+
+
+def normalize_phrase(text):
+    return " ".join(get_base_word(word).lower() for word in WORD_PATTERN.findall(text))
+
+
+def find_words(text):
+    """
+    Returns [(word, starts a sentence?)] for the words in text, with possessives and contractions cut off.
+    """
+    words = []
+    for match in WORD_PATTERN.finditer(text):
+        preceding = text[:match.start()].rstrip()
+        words.append((get_base_word(match.group()), preceding == "" or preceding[-1] in ".!?"))
+    return words
+
+
+def find_proper_noun_phrases(words):
+    # runs of capitalized words that don't start a sentence, "Bilderberg Meeting" and "Hypatia"
+    phrases = []
+    current = []
+    for word, sentence_start in words:
+        if word[0].isupper() and not sentence_start and word != "I":
+            current.append(word)
+            continue
+        if current:
+            phrases.append(current)
+        current = []
+    if current:
+        phrases.append(current)
+    return phrases
+
+
+class DefinerGate:
+
+    def __init__(self, name="definer_gate", custom_data_path=CUSTOM_USER_DATA_PATH,
+                 rare_word_score=DEFINER_GATE_RARE_WORD_SCORE, proper_noun_score=DEFINER_GATE_PROPER_NOUN_SCORE,
+                 min_word_length=DEFINER_GATE_MIN_WORD_LENGTH):
+        self.name = name
+        self.custom_data_path = custom_data_path
+        self.rare_word_score = rare_word_score
+        self.proper_noun_score = proper_noun_score
+        self.min_word_length = min_word_length
+        self.stopwords = set(stopwords.words("english"))
+        self.custom_data_titles = dict() # user id -> (store version, set of normalized custom data titles)
+        self.custom_data_last_checked = dict()
+
+        if word_frequency.idx_google_dict_word_freq is None:
+            word_frequency.load_word_freq_indices()
+
+    def get_custom_data_titles(self, user_id):
+        if user_id in self.custom_data_last_checked and \
+                time.time() - self.custom_data_last_checked[user_id] < CUSTOM_DATA_RELOAD_CHECK_INTERVAL:
+            return self.custom_data_titles[user_id][1]
+        self.custom_data_last_checked[user_id] = time.time()
+
+        # don't make folders for users without custom data, the CSE does that when they upload some
+        user_folder_path = os.path.join(self.custom_data_path, str(user_id))
+        if not os.path.isdir(user_folder_path):
+            self.custom_data_titles[user_id] = (None, set())
+            return self.custom_data_titles[user_id][1]
+
+        manifest = ensure_custom_data_store(user_folder_path)
+        if user_id not in self.custom_data_titles or self.custom_data_titles[user_id][0] != manifest["version"]:
+            titles = set()
+            if manifest["num_rows"] > 0 and "title" in manifest["columns"]:
+                df = load_custom_data_store(user_folder_path, manifest)
+                titles = {normalize_phrase(title) for title in df["title"].tolist() if isinstance(title, str)}
+                titles.discard("")
+            self.custom_data_titles[user_id] = (manifest["version"], titles)
+        return self.custom_data_titles[user_id][1]
+
+    def find_custom_data_entities(self, user_id, words):
+        titles = self.get_custom_data_titles(user_id)
+        if not titles:
+            return []
+        lowered = [word.lower() for word, _ in words]
+        found = []
+        for size in range(1, MAX_CUSTOM_DATA_TITLE_WORDS + 1):
+            for i in range(len(lowered) - size + 1):
+                phrase = " ".join(lowered[i:i + size])
+                if phrase in titles and phrase not in found:
+                    found.append(phrase)
+        return found
+
+    def find_proper_nouns(self, words):
+        found = []
+        for phrase in find_proper_noun_phrases(words):
+            # a run of several capitalized words is a name even if its words are common, like "Dyngus Day"
+            if len(phrase) > 1 or word_frequency.get_word_freq_index(phrase[0]) >= self.proper_noun_score:
+                found.append(" ".join(phrase))
+        acronyms = word_frequency.find_acronyms([word for word, _ in words])
+        found.extend(acronym for acronym in acronyms
+                     if acronym not in found and word_frequency.get_word_freq_index(acronym) >= self.proper_noun_score)
+        return found
+
+    def find_rare_words(self, words):
+        found = []
+        for word, _ in words:
+            word = word.lower()
+            if len(word) < self.min_word_length or word in self.stopwords or word in found:
+                continue
+            if word_frequency.get_word_freq_index(word) >= self.rare_word_score:
+                found.append(word)
+        return found
+
+    def check(self, user_id, text):
+        """
+        Returns (should_run, reason, candidates), where candidates are the words and phrases that made the window
+        worth sending to the definer.
+        """
+        words = find_words(text)
+        reason, candidates = PASS_CUSTOM_DATA, self.find_custom_data_entities(user_id, words)
+        if not candidates:
+            reason, candidates = PASS_PROPER_NOUN, self.find_proper_nouns(words)
+        if not candidates:
+            reason, candidates = PASS_RARE_WORD, self.find_rare_words(words)
+        if not candidates:
+            metrics.increment("{}.skipped".format(self.name))
+            return False, SKIP_NO_CANDIDATES, []
+
+        metrics.increment("{}.passed".format(self.name))
+        metrics.increment("{}.{}".format(self.name, reason))
+        return True, reason, candidates
@@ -0,0 +1,81 @@
+# what the definer's web searches found for an entity (url, image_url), shared by every user, so popular rare entities
+# aren't searched again for each user that mentions them
+# in-process tier in front of the database's entity_searches collection, which every process shares
+import re
+import asyncio
+
+from helpers.ttl_lru_cache import TTLLRUCache
+import helpers.metrics as metrics
+from constants import ENTITY_CACHE_MAX_SIZE, ENTITY_CACHE_TTL, ENTITY_CACHE_NOT_FOUND_TTL
+
+entity_cache = TTLLRUCache(ENTITY_CACHE_MAX_SIZE, ENTITY_CACHE_TTL)
+
+
+def normalize_entity_key(text):
+    # "zk-SNARKs", "ZK SNARKs" and "zk snarks + concept" are the same entity
+    text = re.sub(r"\+\s*(concept|person|organization|place|event|definition|wiki)\b", " ", text.lower())
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+
+def get_entity_cache_key(search_keyword):
+    # keyed on what was searched rather than the name, since the definer disambiguates names in the search keyword
+    # ("Mercury planet" vs "Mercury element")
+    return normalize_entity_key(search_keyword)
+
+
+class EntityCache:
+
+    def __init__(self, database_handler=None):
+        self.database_handler = database_handler
+        self.pending = dict() # cache key -> future of a search in progress, so concurrent users share it
+
+    def get(self, cache_key):
+        entity = entity_cache.get(cache_key)
+        if entity is not None:
+            metrics.increment("entity_cache.memory.hit")
+            return entity
+        metrics.increment("entity_cache.memory.miss")
+
+        if self.database_handler is None:
+            return None
+        entity = self.database_handler.find_cached_entity(cache_key)
+        if entity is not None:
+            metrics.increment("entity_cache.db.hit")
+            entity_cache.set(cache_key, entity)
+            return entity
+        metrics.increment("entity_cache.db.miss")
+        return None
+
+    def set(self, cache_key, entity):
+        # entities the searches found nothing for are retried sooner
+        ttl = ENTITY_CACHE_TTL if entity.get("url") else ENTITY_CACHE_NOT_FOUND_TTL
+        entity_cache.set(cache_key, entity, ttl=ttl)
+        if self.database_handler is not None:
+            self.database_handler.save_cached_entity(cache_key, entity, ttl)
+
+    async def get_or_search(self, search_keyword, search):
+        """
+        Returns the cached search result for search_keyword, or awaits search(search_keyword) and caches what it finds.
+        """
+        cache_key = get_entity_cache_key(search_keyword)
+        if not cache_key:
+            return await search(search_keyword)
+        entity = self.get(cache_key)
+        if entity is not None:
+            return entity
+
+        pending = self.pending.get(cache_key)
+        if pending is not None:
+            metrics.increment("entity_cache.pending.hit")
+            return await asyncio.shield(pending)
+
+        future = asyncio.ensure_future(search(search_keyword))
+        self.pending[cache_key] = future
+        try:
+            response = await asyncio.shield(future)
+        finally:
+            if self.pending.get(cache_key) is future:
+                del self.pending[cache_key]
+
+        self.set(cache_key, response)
+        return response
@@ -0,0 +1,49 @@
+# drops proactive insights that say nearly the same thing as one the user was recently shown, by comparing MiniLM
+# embeddings locally instead of asking the agents not to repeat themselves in their prompts
+import re
+import numpy as np
+
+from Modules.Summarizer import encode_texts
+from constants import INSIGHT_DUPLICATE_SIMILARITY, INSIGHT_DUPLICATE_WINDOW_MINUTES
+import helpers.metrics as metrics
+
+
+def get_insight_text(agent_insight):
+    # agents prefix their insights with "Insight:", which says nothing about what they're about
+    return re.sub(r"^\s*insight:\s*", "", agent_insight, flags=re.IGNORECASE).strip()
+
+
+def is_real_insight(insight):
+    return insight is not None and insight.get("agent_insight") not in (None, "", "null")
+
+
+class InsightDeduplicator:
+
+    def __init__(self, db_handler, similarity=INSIGHT_DUPLICATE_SIMILARITY, window_minutes=INSIGHT_DUPLICATE_WINDOW_MINUTES):
+        self.db_handler = db_handler
+        self.similarity = similarity
+        self.window_minutes = window_minutes
+
+    def filter_insights(self, user_id, insights):
+        """
+        Returns [(insight, embedding)] for the insights that aren't near duplicates of the user's recent insights or
+        of each other. Insights without any text are passed through with no embedding.
+        """
+        real_insights = [insight for insight in insights if is_real_insight(insight)]
+        kept = [(insight, None) for insight in insights if insight is not None and not is_real_insight(insight)]
+        if not real_insights:
+            return kept
+
+        embeddings = encode_texts([get_insight_text(insight["agent_insight"]) for insight in real_insights])
+        recent = self.db_handler.get_recent_nminutes_agent_insight_embeddings_for_user(user_id, n_minutes=self.window_minutes)
+        seen = [np.asarray(embedding, dtype=np.float32) for embedding in recent]
+
+        for insight, embedding in zip(real_insights, embeddings):
+            if seen and float(np.max(np.stack(seen) @ embedding)) >= self.similarity:
+                print("Dropping near duplicate insight from {}: {}".format(insight["agent_name"], insight["agent_insight"]))
+                metrics.increment("insights.duplicate")
+                continue
+            metrics.increment("insights.unique")
+            seen.append(embedding)
+            kept.append((insight, embedding))
+        return kept
@@ -0,0 +1,368 @@
+# single gateway for every LLM call the server makes
+# pooled keep-alive connections, priority classes, shared rate limits, per-model concurrency limits, retries with jittered backoff on 429/5xx, and timeouts
+import time
+import json
+import random
+import asyncio
+import threading
+import weakref
+from typing import Any, List, Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from langchain.chat_models.base import BaseChatModel
+from langchain.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain.schema import AIMessage, BaseMessage, ChatMessage, HumanMessage, SystemMessage, ChatResult, ChatGeneration
+
+from server_config import openai_api_key, use_azure_openai, azure_openai_api_key, azure_openai_api_base, azure_openai_api_gpt35_deployment, azure_openai_api_gpt4_deployment
+from constants import GPT_35_MODEL, GPT_4_MODEL, GPT_4_MAX_TOKENS, GPT_TEMPERATURE
+from constants import LLM_REQUEST_TIMEOUT, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY, LLM_MAX_CONCURRENT_REQUESTS_PER_MODEL, LLM_CONNECTION_POOL_SIZE
+from Modules.RateLimiter import rate_limiter, estimate_tokens
+from Modules.LLMScheduler import get_llm_priority, get_bucket_reserve, wait_for_turn, wait_for_turn_async, PRIORITY_NAMES
+import helpers.metrics as metrics
+
+OPENAI_CHAT_COMPLETIONS_URL = "https://api.openai.com/v1/chat/completions"
+AZURE_OPENAI_API_VERSION = "2023-08-01-preview"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# when set, requests are handed to this instead of the provider, e.g. a helpers.simulator.Simulator for offline benchmarks
+llm_transport = None
+
+
+def set_llm_transport(transport):
+    global llm_transport
+    llm_transport = transport
+
+
+class LLMGatewayError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def get_request_url_and_headers(model):
+    if use_azure_openai:
+        deployment_name = azure_openai_api_gpt4_deployment if model == GPT_4_MODEL else azure_openai_api_gpt35_deployment
+        url = "{}/openai/deployments/{}/chat/completions?api-version={}".format(
+            azure_openai_api_base.rstrip("/"), deployment_name, AZURE_OPENAI_API_VERSION)
+        headers = {"api-key": azure_openai_api_key, "Content-Type": "application/json"}
+    else:
+        url = OPENAI_CHAT_COMPLETIONS_URL
+        headers = {"Authorization": "Bearer {}".format(openai_api_key), "Content-Type": "application/json"}
+    return url, headers
+
+
+def make_request_body(messages, model, max_tokens, temperature, stop):
+    body = {"messages": messages, "max_tokens": max_tokens, "temperature": temperature}
+    # azure picks the model from the deployment in the url
+    if not use_azure_openai:
+        body["model"] = model
+    if stop:
+        body["stop"] = stop
+    return body
+
+
+def get_retry_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), LLM_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    # full jitter, so processes that got throttled together don't all retry together
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def get_rate_limit_key(model):
+    return "{}:{}".format("azure" if use_azure_openai else "openai", model)
+
+
+def record_queue_wait(priority, start_time):
+    # time from asking for a request to sending it - deferring to explicit work, rate limits and the concurrency limit
+    metrics.observe("llm.queue_wait." + PRIORITY_NAMES[priority], time.time() - start_time)
+
+
+def get_used_tokens(response):
+    return response.get("usage", {}).get("total_tokens")
+
+
+def get_message_content(response):
+    choice = response["choices"][0]
+    if choice.get("finish_reason") == "content_filter":
+        return "Microsoft content filter says hello"
+    return choice["message"].get("content") or ""
+
+
+### SYNC ###
+
+sync_session = None
+sync_lock = threading.Lock()
+sync_model_semaphores = dict()
+
+
+def get_sync_session():
+    global sync_session
+    if sync_session is None:
+        with sync_lock:
+            if sync_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=LLM_CONNECTION_POOL_SIZE, pool_maxsize=LLM_CONNECTION_POOL_SIZE)
+                session.mount("https://", adapter)
+                sync_session = session
+    return sync_session
+
+
+def get_sync_model_semaphore(model):
+    with sync_lock:
+        if model not in sync_model_semaphores:
+            sync_model_semaphores[model] = threading.BoundedSemaphore(LLM_MAX_CONCURRENT_REQUESTS_PER_MODEL)
+        return sync_model_semaphores[model]
+
+
+def post_chat_completion(url, headers, body, model):
+    # returns (status, response json or error, retry-after header). status is None if the request never got a response
+    try:
+        response = get_sync_session().post(url, headers=headers, json=body, timeout=LLM_REQUEST_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        return None, e, None
+    if response.status_code == 200:
+        return 200, response.json(), None
+    return response.status_code, response.text, response.headers.get("Retry-After")
+
+
+def chat_completion(messages, model=GPT_35_MODEL, max_tokens=256, temperature=0, stop=None):
+    """
+    Sends a chat completion request and returns the parsed response json.
+    Raises LLMGatewayError once the request fails with a non-retryable status or runs out of retries.
+    """
+    url, headers = get_request_url_and_headers(model)
+    body = make_request_body(messages, model, max_tokens, temperature, stop)
+    rate_limit_key = get_rate_limit_key(model)
+    estimated_tokens = estimate_tokens(messages, max_tokens)
+    priority = get_llm_priority()
+
+    post = llm_transport.post_chat_completion if llm_transport is not None else post_chat_completion
+
+    status, error = None, None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        queue_start_time = time.time()
+        wait_for_turn(priority)
+        rate_limiter.acquire(rate_limit_key, tokens=estimated_tokens, reserve=get_bucket_reserve(priority))
+        with get_sync_model_semaphore(model):
+            record_queue_wait(priority, queue_start_time)
+            start_time = time.time()
+            status, result, retry_after = post(url, headers, body, model)
+
+        if status == 200:
+            metrics.observe("llm.latency." + model, time.time() - start_time)
+            rate_limiter.correct_tokens(rate_limit_key, estimated_tokens, get_used_tokens(result))
+            return result
+        error = result
+
+        if status is not None and status not in RETRY_STATUS_CODES:
+            break
+        if attempt < LLM_MAX_RETRIES:
+            metrics.increment("llm.retries." + model)
+            time.sleep(get_retry_delay(attempt, retry_after))
+
+    metrics.increment("llm.failures." + model)
+    raise LLMGatewayError("LLM request to {} failed: {} {}".format(model, status, error), status)
+
+
+### ASYNC ###
+
+# aiohttp sessions and asyncio semaphores belong to one event loop, and some workers run more than one loop
+loop_sessions = weakref.WeakKeyDictionary()
+loop_model_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_async_session():
+    loop = asyncio.get_running_loop()
+    session = loop_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=LLM_CONNECTION_POOL_SIZE, keepalive_timeout=30)
+        session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=LLM_REQUEST_TIMEOUT))
+        loop_sessions[loop] = session
+    return session
+
+
+def get_async_model_semaphore(model):
+    loop = asyncio.get_running_loop()
+    semaphores = loop_model_semaphores.setdefault(loop, dict())
+    if model not in semaphores:
+        semaphores[model] = asyncio.Semaphore(LLM_MAX_CONCURRENT_REQUESTS_PER_MODEL)
+    return semaphores[model]
+
+
+async def close_async_session():
+    # call before a short-lived event loop finishes, so its pooled connections are closed cleanly
+    session = loop_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+async def apost_chat_completion(url, headers, body, model):
+    try:
+        async with get_async_session().post(url, headers=headers, json=body) as response:
+            if response.status == 200:
+                return 200, await response.json(), None
+            return response.status, await response.text(), response.headers.get("Retry-After")
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        return None, e, None
+
+
+async def apost_chat_completion_stream(url, headers, body, model, on_token):
+    # streams the completion, passing each piece of content to on_token as it arrives, then returns it put back
+    # together as one response like apost_chat_completion does
+    if llm_transport is not None:
+        # transports answer in one piece
+        status, result, retry_after = await llm_transport.apost_chat_completion(url, headers, dict(body, stream=False), model)
+        if status == 200:
+            await on_token(get_message_content(result))
+        return status, result, retry_after
+
+    content, finish_reason, streamed = "", None, False
+    try:
+        async with get_async_session().post(url, headers=headers, json=body) as response:
+            if response.status != 200:
+                return response.status, await response.text(), response.headers.get("Retry-After")
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                # azure sends a first chunk with no choices, only its prompt filter results
+                choices = json.loads(data).get("choices") or []
+                if not choices:
+                    continue
+                finish_reason = choices[0].get("finish_reason") or finish_reason
+                token = choices[0].get("delta", {}).get("content")
+                if token:
+                    content += token
+                    streamed = True
+                    await on_token(token)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        if streamed:
+            # a retry would send the start of the answer again
+            raise LLMGatewayError("LLM stream from {} broke off: {}".format(model, e))
+        return None, e, None
+
+    # streamed responses don't report usage, so it's estimated the same way the rate limiter does
+    prompt_tokens, completion_tokens = estimate_tokens(body["messages"]), len(content) // 4
+    result = {
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+    return 200, result, None
+
+
+async def achat_completion(messages, model=GPT_35_MODEL, max_tokens=256, temperature=0, stop=None, on_token=None):
+    """
+    Async version of chat_completion. If on_token is given, the completion is streamed and each piece of content
+    is awaited with on_token(token) as it arrives.
+    """
+    url, headers = get_request_url_and_headers(model)
+    body = make_request_body(messages, model, max_tokens, temperature, stop)
+    rate_limit_key = get_rate_limit_key(model)
+    estimated_tokens = estimate_tokens(messages, max_tokens)
+    priority = get_llm_priority()
+
+    if on_token is not None:
+        body["stream"] = True
+        post = lambda url, headers, body, model: apost_chat_completion_stream(url, headers, body, model, on_token)
+    else:
+        post = llm_transport.apost_chat_completion if llm_transport is not None else apost_chat_completion
+
+    status, error = None, None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        queue_start_time = time.time()
+        await wait_for_turn_async(priority)
+        await rate_limiter.acquire_async(rate_limit_key, tokens=estimated_tokens, reserve=get_bucket_reserve(priority))
+        async with get_async_model_semaphore(model):
+            record_queue_wait(priority, queue_start_time)
+            start_time = time.time()
+            status, result, retry_after = await post(url, headers, body, model)
+
+        if status == 200:
+            metrics.observe("llm.latency." + model, time.time() - start_time)
+            await rate_limiter.correct_tokens_async(rate_limit_key, estimated_tokens, get_used_tokens(result))
+            return result
+        error = result
+
+        if status is not None and status not in RETRY_STATUS_CODES:
+            break
+        if attempt < LLM_MAX_RETRIES:
+            metrics.increment("llm.retries." + model)
+            await asyncio.sleep(get_retry_delay(attempt, retry_after))
+
+    metrics.increment("llm.failures." + model)
+    raise LLMGatewayError("LLM request to {} failed: {} {}".format(model, status, error), status)
+
+
+### LANGCHAIN ###
+
+def convert_message_to_dict(message: BaseMessage):
+    if isinstance(message, ChatMessage):
+        role = message.role
+    elif isinstance(message, HumanMessage):
+        role = "user"
+    elif isinstance(message, AIMessage):
+        role = "assistant"
+    elif isinstance(message, SystemMessage):
+        role = "system"
+    else:
+        raise ValueError("Got unknown message type: {}".format(type(message)))
+    return {"role": role, "content": message.content}
+
+
+def make_chat_result(response, model):
+    message = AIMessage(content=get_message_content(response))
+    generation = ChatGeneration(message=message, generation_info={"finish_reason": response["choices"][0].get("finish_reason")})
+    return ChatResult(generations=[generation], llm_output={"token_usage": response.get("usage", {}), "model_name": model})
+
+
+class GatewayChatModel(BaseChatModel):
+    """
+    LangChain chat model that sends its requests through the gateway, so agents share its pooled connections and limits.
+    """
+    model_name: str = GPT_4_MODEL
+    temperature: float = GPT_TEMPERATURE
+    max_tokens: int = GPT_4_MAX_TOKENS
+    # stream async completions to the run's on_llm_new_token callbacks
+    streaming: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "llm-gateway"
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": self.model_name, "temperature": self.temperature, "max_tokens": self.max_tokens, "streaming": self.streaming}
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        response = chat_completion([convert_message_to_dict(message) for message in messages],
+                                   model=self.model_name, max_tokens=self.max_tokens, temperature=self.temperature, stop=stop)
+        return make_chat_result(response, self.model_name)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        on_token = None
+        if self.streaming and run_manager is not None:
+            on_token = lambda token: run_manager.on_llm_new_token(token)
+        response = await achat_completion([convert_message_to_dict(message) for message in messages],
+                                          model=self.model_name, max_tokens=self.max_tokens, temperature=self.temperature, stop=stop,
+                                          on_token=on_token)
+        return make_chat_result(response, self.model_name)
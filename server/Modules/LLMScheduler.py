@@ -0,0 +1,151 @@
+# priority classes for LLM work, so a wearer's explicit query isn't stuck behind background work for other users
+# explicit > cse/definer > proactive insights. while explicit work is running anywhere on the server, lower classes
+# hold off their next LLM request for a bounded time, and they can't drain the shared rate limit buckets below a reserve
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+
+from Modules.RateLimiter import rate_limiter
+from constants import LLM_PRIORITY_MAX_DEFER, LLM_PRIORITY_BUCKET_RESERVE, LLM_EXPLICIT_LEASE_TTL, LLM_PRIORITY_POLL_INTERVAL
+import helpers.metrics as metrics
+
+PRIORITY_EXPLICIT = 0
+PRIORITY_CSE = 1
+PRIORITY_PROACTIVE = 2
+PRIORITY_NAMES = {PRIORITY_EXPLICIT: "explicit", PRIORITY_CSE: "cse", PRIORITY_PROACTIVE: "proactive"}
+
+EXPLICIT_LEASES_KEY = "__explicit_leases__"
+
+# whether any process had explicit work the last time this process read the leases, reused for one poll interval so
+# concurrent callers don't all queue on the shared file lock
+explicit_work_waiting_cache = {"waiting": False, "checked_at": 0.0}
+explicit_work_waiting_lock = threading.Lock()
+
+# each worker process sets its own class, code that does another class of work overrides it with llm_priority()
+process_llm_priority = PRIORITY_CSE
+current_llm_priority = contextvars.ContextVar("current_llm_priority", default=None)
+
+
+def set_process_llm_priority(priority):
+    global process_llm_priority
+    process_llm_priority = priority
+
+
+def get_llm_priority():
+    priority = current_llm_priority.get()
+    return process_llm_priority if priority is None else priority
+
+
+def get_bucket_reserve(priority):
+    return LLM_PRIORITY_BUCKET_RESERVE.get(PRIORITY_NAMES[priority], 0)
+
+
+@contextmanager
+def llm_priority(priority):
+    token = current_llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_llm_priority.reset(token)
+
+
+def update_explicit_leases(update):
+    def update_state(state):
+        leases = state.setdefault(EXPLICIT_LEASES_KEY, dict())
+        # leases expire so a crashed explicit worker can't hold everyone else back
+        now = time.time()
+        for lease_id in [lease_id for lease_id, expires_at in leases.items() if expires_at < now]:
+            del leases[lease_id]
+        return update(leases)
+    return rate_limiter.backend.update_state(update_state)
+
+
+def is_explicit_work_waiting():
+    with explicit_work_waiting_lock:
+        if time.time() - explicit_work_waiting_cache["checked_at"] >= LLM_PRIORITY_POLL_INTERVAL:
+            explicit_work_waiting_cache["waiting"] = update_explicit_leases(lambda leases: len(leases) > 0)
+            explicit_work_waiting_cache["checked_at"] = time.time()
+        return explicit_work_waiting_cache["waiting"]
+
+
+async def is_explicit_work_waiting_async():
+    if time.time() - explicit_work_waiting_cache["checked_at"] < LLM_PRIORITY_POLL_INTERVAL:
+        return explicit_work_waiting_cache["waiting"]
+    # the leases live behind a file lock shared by every process, never wait on it on the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, is_explicit_work_waiting)
+
+
+@contextmanager
+def explicit_llm_work():
+    """
+    Marks the enclosed code as explicit work - LLM calls made in it get the explicit class, and other
+    classes in every process defer their requests until it's done.
+    """
+    lease_id = str(uuid.uuid4())
+    update_explicit_leases(lambda leases: leases.__setitem__(lease_id, time.time() + LLM_EXPLICIT_LEASE_TTL))
+    with explicit_work_waiting_lock:
+        explicit_work_waiting_cache.update(waiting=True, checked_at=time.time())
+    try:
+        with llm_priority(PRIORITY_EXPLICIT):
+            yield
+    finally:
+        update_explicit_leases(lambda leases: leases.pop(lease_id, None))
+        with explicit_work_waiting_lock:
+            explicit_work_waiting_cache["checked_at"] = 0.0
+
+
+@asynccontextmanager
+async def explicit_llm_work_async():
+    """
+    explicit_llm_work for coroutines, taking and giving back the lease in an executor thread, since the leases live
+    behind the file lock every process's LLM and search calls take.
+    """
+    loop = asyncio.get_running_loop()
+    lease_id = str(uuid.uuid4())
+    await loop.run_in_executor(None, update_explicit_leases, lambda leases: leases.__setitem__(lease_id, time.time() + LLM_EXPLICIT_LEASE_TTL))
+    with explicit_work_waiting_lock:
+        explicit_work_waiting_cache.update(waiting=True, checked_at=time.time())
+    try:
+        with llm_priority(PRIORITY_EXPLICIT):
+            yield
+    finally:
+        # shielded so a cancelled query still gives its lease back instead of holding everyone off until it expires
+        await asyncio.shield(loop.run_in_executor(None, update_explicit_leases, lambda leases: leases.pop(lease_id, None)))
+        with explicit_work_waiting_lock:
+            explicit_work_waiting_cache["checked_at"] = 0.0
+
+
+def wait_for_turn(priority):
+    # returns the seconds spent deferring to explicit work
+    max_defer = LLM_PRIORITY_MAX_DEFER.get(PRIORITY_NAMES[priority], 0)
+    if priority == PRIORITY_EXPLICIT or max_defer <= 0:
+        return 0
+    start_time = time.time()
+    deferred = False
+    while is_explicit_work_waiting() and (time.time() - start_time) < max_defer:
+        deferred = True
+        time.sleep(LLM_PRIORITY_POLL_INTERVAL)
+    return record_deferral(priority, start_time, deferred)
+
+
+async def wait_for_turn_async(priority):
+    max_defer = LLM_PRIORITY_MAX_DEFER.get(PRIORITY_NAMES[priority], 0)
+    if priority == PRIORITY_EXPLICIT or max_defer <= 0:
+        return 0
+    start_time = time.time()
+    deferred = False
+    while await is_explicit_work_waiting_async() and (time.time() - start_time) < max_defer:
+        deferred = True
+        await asyncio.sleep(LLM_PRIORITY_POLL_INTERVAL)
+    return record_deferral(priority, start_time, deferred)
+
+
+def record_deferral(priority, start_time, deferred):
+    if not deferred:
+        return 0
+    metrics.increment("llm.deferred." + PRIORITY_NAMES[priority])
+    return time.time() - start_time
@@ -0,0 +1,164 @@
+# token-bucket rate limiter shared by every server process, consulted before each OpenAI and Serper call
+# each "provider:model" key has a requests-per-minute bucket and, for LLMs, a tokens-per-minute bucket
+import os
+import json
+import time
+import fcntl
+import asyncio
+import threading
+
+from constants import RATE_LIMITS, RATE_LIMITER_STATE_PATH, RATE_LIMITER_MAX_SLEEP
+import helpers.metrics as metrics
+
+
+def estimate_tokens(messages, max_tokens=0):
+    # ~4 characters per token, plus what the completion may use. corrected with the real usage afterwards
+    prompt_chars = sum(len(message.get("content") or "") for message in messages)
+    return prompt_chars // 4 + max_tokens
+
+
+def refill_bucket(bucket, limit, now):
+    # buckets hold up to a minute of capacity and refill continuously
+    elapsed = max(0.0, now - bucket["updated_at"])
+    bucket["level"] = min(float(limit), bucket["level"] + elapsed * limit / 60.0)
+    bucket["updated_at"] = now
+
+
+def take_from_buckets(state, key, requests, tokens, now, reserve=0):
+    """
+    Takes requests and tokens from key's buckets if both have enough left above reserve, a fraction of their capacity.
+    Returns 0 on success, or the seconds until both buckets will have enough.
+    """
+    requests_per_minute, tokens_per_minute = RATE_LIMITS.get(key, (None, None))
+    wanted = [("requests", requests_per_minute, requests), ("tokens", tokens_per_minute, tokens)]
+    wanted = [(name, limit, amount) for name, limit, amount in wanted if limit]
+
+    buckets = state.setdefault(key, dict())
+    wait_time = 0.0
+    for name, limit, amount in wanted:
+        bucket = buckets.setdefault(name, {"level": float(limit), "updated_at": now})
+        refill_bucket(bucket, limit, now)
+        # a single call bigger than the whole bucket would wait forever, so it only waits for a full bucket
+        amount = min(amount, limit)
+        needed = min(amount + reserve * limit, limit)
+        if bucket["level"] < needed:
+            wait_time = max(wait_time, (needed - bucket["level"]) * 60.0 / limit)
+    if wait_time > 0:
+        return wait_time
+
+    for name, limit, amount in wanted:
+        buckets[name]["level"] -= min(amount, limit)
+    return 0
+
+
+def return_to_bucket(state, key, tokens, now):
+    tokens_per_minute = RATE_LIMITS.get(key, (None, None))[1]
+    bucket = state.get(key, dict()).get("tokens")
+    if not tokens_per_minute or bucket is None:
+        return
+    refill_bucket(bucket, tokens_per_minute, now)
+    # negative when a call used more than we estimated
+    bucket["level"] = min(float(tokens_per_minute), bucket["level"] + tokens)
+
+
+class InProcessRateLimiterBackend:
+    """
+    Keeps the buckets in this process only. For tests and scripts that run outside the server.
+    """
+
+    def __init__(self):
+        self.state = dict()
+        self.lock = threading.Lock()
+
+    def update_state(self, update):
+        with self.lock:
+            return update(self.state)
+
+
+class FileRateLimiterBackend:
+    """
+    Keeps the buckets in a small json file guarded by an exclusive file lock, so every process on the machine shares them.
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.thread_lock = threading.Lock()
+
+    def update_state(self, update):
+        with self.thread_lock:
+            fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), "r+") as state_file:
+                    contents = state_file.read()
+                    try:
+                        state = json.loads(contents) if contents else dict()
+                    except ValueError:
+                        state = dict()
+                    result = update(state)
+                    state_file.seek(0)
+                    state_file.truncate()
+                    json.dump(state, state_file)
+                return result
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+
+class RateLimiter:
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def try_acquire(self, key, requests, tokens, reserve):
+        return self.backend.update_state(lambda state: take_from_buckets(state, key, requests, tokens, time.time(), reserve))
+
+    async def try_acquire_async(self, key, requests, tokens, reserve):
+        # the file backend blocks on a lock shared with other processes, so it's never taken on the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.try_acquire, key, requests, tokens, reserve)
+
+    def acquire(self, key, requests=1, tokens=0, reserve=0):
+        # blocks until the call is allowed, returns the seconds spent waiting
+        if key not in RATE_LIMITS:
+            return 0
+        start_time = time.time()
+        wait_time = self.try_acquire(key, requests, tokens, reserve)
+        while wait_time > 0:
+            metrics.increment("rate_limiter.throttled." + key)
+            time.sleep(min(wait_time, RATE_LIMITER_MAX_SLEEP))
+            wait_time = self.try_acquire(key, requests, tokens, reserve)
+        return self.record_wait(key, start_time)
+
+    async def acquire_async(self, key, requests=1, tokens=0, reserve=0):
+        if key not in RATE_LIMITS:
+            return 0
+        start_time = time.time()
+        wait_time = await self.try_acquire_async(key, requests, tokens, reserve)
+        while wait_time > 0:
+            metrics.increment("rate_limiter.throttled." + key)
+            await asyncio.sleep(min(wait_time, RATE_LIMITER_MAX_SLEEP))
+            wait_time = await self.try_acquire_async(key, requests, tokens, reserve)
+        return self.record_wait(key, start_time)
+
+    def record_wait(self, key, start_time):
+        waited = time.time() - start_time
+        metrics.observe("rate_limiter.wait." + key, waited)
+        return waited
+
+    def correct_tokens(self, key, estimated_tokens, used_tokens):
+        # give back what a call didn't use, or take what it used beyond the estimate
+        if key in RATE_LIMITS and used_tokens is not None and used_tokens != estimated_tokens:
+            self.backend.update_state(lambda state: return_to_bucket(state, key, estimated_tokens - used_tokens, time.time()))
+
+    async def correct_tokens_async(self, key, estimated_tokens, used_tokens):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.correct_tokens, key, estimated_tokens, used_tokens)
+
+
+rate_limiter = RateLimiter(FileRateLimiterBackend(RATE_LIMITER_STATE_PATH))
+
+
+def use_in_process_rate_limiter():
+    # for tests and scripts that shouldn't share the server's buckets
+    rate_limiter.backend = InProcessRateLimiterBackend()
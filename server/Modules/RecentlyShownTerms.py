@@ -0,0 +1,49 @@
+import time
+
+
+def normalize_term(name):
+    return str(name).strip().casefold()
+
+
+class RecentlyShownTerms:
+    """
+    Per-user index of the entity names a user was recently shown, each expiring ttl seconds after it was shown.
+    If given a db_handler, the index is mirrored to the database so it survives restarts.
+    """
+
+    def __init__(self, ttl, db_handler=None):
+        self.ttl = ttl
+        self.db_handler = db_handler
+        self.shown_times = dict() # user_id -> {normalized term: time it was last shown}
+
+    def get_user_terms(self, user_id):
+        if user_id not in self.shown_times:
+            self.shown_times[user_id] = dict()
+            # warm start from the mirror the first time we see this user
+            if self.db_handler is not None:
+                for term in self.db_handler.get_recently_shown_terms_for_user(user_id):
+                    self.shown_times[user_id][term["name"]] = term["shown_at"]
+        return self.shown_times[user_id]
+
+    def add(self, user_id, names):
+        if not names:
+            return
+        now = time.time()
+        user_terms = self.get_user_terms(user_id)
+        normalized_names = [normalize_term(name) for name in names]
+        for name in normalized_names:
+            user_terms[name] = now
+        self.purge_expired(user_id)
+
+        if self.db_handler is not None:
+            self.db_handler.add_recently_shown_terms_for_user(user_id, normalized_names)
+
+    def contains(self, user_id, name):
+        shown_time = self.get_user_terms(user_id).get(normalize_term(name))
+        return shown_time is not None and (time.time() - shown_time) < self.ttl
+
+    def purge_expired(self, user_id):
+        user_terms = self.get_user_terms(user_id)
+        oldest_valid_time = time.time() - self.ttl
+        for name in [name for name, shown_time in user_terms.items() if shown_time < oldest_valid_time]:
+            del user_terms[name]
@@ -1,7 +1,13 @@
 import json
 import openai
+import numpy as np
 from Modules.QueryLLM import *
-from constants import LLM_FILTER_THRESHOLD, RELEVANCE_FILTER_TIME
+from constants import LLM_FILTER_THRESHOLD, RELEVANCE_FILTER_TIME, RELEVANCE_FILTER_DESCRIPTION_CHARS, MIRROR_RECENTLY_SHOWN_TERMS
+from constants import RELEVANCE_SCORE_CACHE_MAX_SIZE, RELEVANCE_SCORE_CACHE_TTL, RELEVANCE_SCORE_CONTEXT_SIMILARITY
+from Modules.Summarizer import encode_texts
+from helpers.ttl_lru_cache import TTLLRUCache
+import helpers.metrics as metrics
+from Modules.RecentlyShownTerms import RecentlyShownTerms, normalize_term
 # from server.Prompts.relevance_filter_prompt import relevance_filter_prompt
 
 relevance_filter_prompt = (
@@ -174,32 +180,63 @@ class RelevanceFilter:
     def __init__(self, db_handler):
         print("RelevanceFilter initialized")
         self.db_handler = db_handler
-        self.banned_terms = ["LOL", "AI", "Caden Pierce", "Alex Israel", "Professor", "God", "Jesus", "Google", "David Newman", "Patty", "Earth", "North America", "United States", "Special Boat Service", "League of Legends"]
+        self.banned_terms = {normalize_term(term) for term in ["LOL", "AI", "Caden Pierce", "Alex Israel", "Professor", "God", "Jesus", "Google", "David Newman", "Patty", "Earth", "North America", "United States", "Special Boat Service", "League of Legends"]}
+        self.recently_shown_terms = RecentlyShownTerms(RELEVANCE_FILTER_TIME, db_handler if MIRROR_RECENTLY_SHOWN_TERMS else None)
+        # (user_id, term) -> score and the embedding of the context it was scored in
+        self.relevance_score_cache = TTLLRUCache(RELEVANCE_SCORE_CACHE_MAX_SIZE, RELEVANCE_SCORE_CACHE_TTL, name="relevance_score_cache")
 
     def should_display_result_based_on_context(self, user_id, cse_outputs, context):
-        valid_outputs = []
-        
-        terms_defined_in_last_n_seconds = self.db_handler.get_defined_terms_from_last_nseconds_for_user_device(
-            user_id, n=RELEVANCE_FILTER_TIME
-        )
-
-        # print(f"===========================CONTEXT: {context}==============================")
-        # print(f"===========================TERMS DEFINED IN LAST N SECONDS: {terms_defined_in_last_n_seconds}==============================")
-        # print(f"===========================CSE OUTPUTS: {cse_outputs}==============================")
+        cse_outputs_filtered = self.remove_recently_shown_and_banned_terms(user_id, cse_outputs)
+        if not cse_outputs_filtered:
+            return []
+
+        return self.score_relevance(user_id, cse_outputs_filtered, context)
 
-        # Collect all banned terms from the last N seconds and the predefined banned terms
-        terms_to_filter = [term["name"] for term in terms_defined_in_last_n_seconds] + self.banned_terms
-        # print(f"===========================TERMS TO FILTER: {terms_to_filter}==============================")
+    def remove_recently_shown_and_banned_terms(self, user_id, cse_outputs):
+        # print(f"===========================CSE OUTPUTS: {cse_outputs}==============================")
 
-        # Filter the cse_outputs based on the combined banned terms
-        cse_outputs_filtered = [cse_output for cse_output in cse_outputs if cse_output["name"] not in terms_to_filter]
+        # Filter the cse_outputs based on the terms shown in the last N seconds and the predefined banned terms
+        cse_outputs_filtered = [cse_output for cse_output in cse_outputs
+                                if normalize_term(cse_output["name"]) not in self.banned_terms
+                                and not self.recently_shown_terms.contains(user_id, cse_output["name"])]
         # print(f"===========================CSE OUTPUTS FILTERED: {cse_outputs_filtered}==============================")
-        if not cse_outputs_filtered:
-            return []
+        return cse_outputs_filtered
+
+    def record_shown_terms(self, user_id, names):
+        self.recently_shown_terms.add(user_id, names)
+
+    def score_relevance(self, user_id, cse_outputs, context):
+        # returns the names of the entities that scored at least LLM_FILTER_THRESHOLD
+        # scores are reused until the conversation drifts away from the context they were given in
+        context_embedding = encode_texts([context])[0]
+
+        entity_scores = dict()
+        unscored_outputs = list()
+        for cse_output in cse_outputs:
+            cached_score = self.relevance_score_cache.get((user_id, normalize_term(cse_output["name"])))
+            if cached_score is not None and float(np.dot(cached_score["context_embedding"], context_embedding)) >= RELEVANCE_SCORE_CONTEXT_SIMILARITY:
+                entity_scores[cse_output["name"]] = cached_score["score"]
+            else:
+                if cached_score is not None:
+                    metrics.increment("relevance_score_cache.stale")
+                unscored_outputs.append(cse_output)
+
+        if not unscored_outputs:
+            metrics.increment("relevance_score_cache.llm_calls_saved")
+        else:
+            for entity_name, score in self.llm_score_entities(unscored_outputs, context).items():
+                entity_scores[entity_name] = score
+                self.relevance_score_cache.set((user_id, normalize_term(entity_name)), {"score": score, "context_embedding": context_embedding})
 
+        # valid_outputs.extend(entities_filtered)
+        final_entities = [entity for entity in entity_scores.keys() if entity_scores[entity] >= LLM_FILTER_THRESHOLD]
+        # print(f"===========================CSE OUTPUTS FILTERED: {final_entities}==============================")
+
+        return final_entities
 
-        # print(f"===========================ENTITIES: {cse_outputs_filtered}==============================")
-        entities_filtered = self.llm_relevance_filter(cse_outputs_filtered, context)
+    def llm_score_entities(self, cse_outputs, context):
+        # print(f"===========================ENTITIES: {cse_outputs}==============================")
+        entities_filtered = self.llm_relevance_filter(cse_outputs, context)
         try:
             entities_filtered_dict = json.loads(entities_filtered)
             # print(f"===========================ENTITIES FILTERED: {str(entities_filtered_dict)}==============================")
@@ -211,17 +248,22 @@ class RelevanceFilter:
             # print("Successfully parsed the JSON string.")
         # print(f"===========================ENTITIES FILTERED: {str(entities_filtered)}==============================")
 
-        # valid_outputs.extend(entities_filtered)
-        final_entities = [entity for entity in entities_filtered_dict.keys() if entities_filtered_dict[entity] >= LLM_FILTER_THRESHOLD]
-        # print(f"===========================CSE OUTPUTS FILTERED: {final_entities}==============================")
-
-        return final_entities
+        # scores sometimes come back as strings
+        entity_scores = dict()
+        for entity_name, score in entities_filtered_dict.items():
+            try:
+                entity_scores[entity_name] = int(score)
+            except (TypeError, ValueError):
+                print(f"RelevanceFilter.py: Bad score for {entity_name}: {score}")
+        return entity_scores
 
     def llm_relevance_filter(self, entities, context):
 
+        # entities are scored before they're summarized, so only send the start of long descriptions
         llm_entities_input = dict()
         for entity in entities:
-            llm_entities_input[entity["name"]] = entity["summary"]
+            description = entity["summary"]
+            llm_entities_input[entity["name"]] = description[:RELEVANCE_FILTER_DESCRIPTION_CHARS] if description != None else None
  
         # Combine context and result for input
         input_text = relevance_filter_prompt(context, str(llm_entities_input))
@@ -0,0 +1,110 @@
+# per-user conversation context for agent prompts: the last few minutes verbatim, and an extractive summary of
+# what came before that's updated incrementally, so prompts don't re-send minutes of raw transcript every cycle
+import re
+import time
+import threading
+import numpy as np
+
+from Modules.Summarizer import encode_texts, select_summary_sentences
+from constants import ROLLING_CONTEXT_VERBATIM_SECONDS, ROLLING_CONTEXT_LOOKBACK_SECONDS, ROLLING_CONTEXT_SUMMARY_SENTENCES, PROMPT_TRANSCRIPT_TOKEN_BUDGET
+from helpers.prompt_tokens import count_tokens, fit_to_token_budget
+from logger_config import logger
+import helpers.metrics as metrics
+
+SUMMARY_HEADER = "[Summary of earlier conversation] "
+RECENT_HEADER = "[Recent transcript] "
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in re.split(r"(?<=[.?!])\s+", text) if len(sentence.split()) >= 4]
+
+
+class RollingContext:
+    """
+    One user's rolling context. Transcripts older than verbatim_seconds are folded into a summary of at most
+    summary_sentences sentences, picked from the summary so far plus the newly folded sentences the same way the
+    SBERT summarizer picks them. Sentences older than lookback_seconds drop out of the summary.
+    """
+
+    def __init__(self, verbatim_seconds=ROLLING_CONTEXT_VERBATIM_SECONDS, lookback_seconds=ROLLING_CONTEXT_LOOKBACK_SECONDS,
+                 summary_sentences=ROLLING_CONTEXT_SUMMARY_SENTENCES):
+        self.verbatim_seconds = verbatim_seconds
+        self.lookback_seconds = lookback_seconds
+        self.summary_sentences = summary_sentences
+        self.summary = [] # (timestamp, sentence), oldest first
+        self.summary_embeddings = None
+        self.summarized_until = 0
+        self.recent_text = ""
+        self.updated_at = 0
+
+    def update(self, transcripts, now=None):
+        now = time.time() if now is None else now
+        self.updated_at = now
+        verbatim_start = now - self.verbatim_seconds
+
+        to_fold = [t for t in transcripts if self.summarized_until < t['timestamp'] < verbatim_start and now - t['timestamp'] < self.lookback_seconds]
+        self.recent_text = " ".join(t['text'] for t in transcripts if t['timestamp'] >= verbatim_start).strip()
+
+        # drop what's fallen out of the lookback
+        keep = [i for i, (timestamp, _) in enumerate(self.summary) if now - timestamp < self.lookback_seconds]
+        if len(keep) < len(self.summary):
+            self.summary = [self.summary[i] for i in keep]
+            self.summary_embeddings = self.summary_embeddings[keep] if keep else None
+
+        new_sentences = [(t['timestamp'], sentence) for t in to_fold for sentence in split_sentences(t['text'])]
+        if to_fold:
+            self.summarized_until = max(t['timestamp'] for t in to_fold)
+        if not new_sentences:
+            return
+
+        # only the new sentences are embedded, the summary's embeddings are kept from when they were folded in
+        new_embeddings = encode_texts([sentence for _, sentence in new_sentences])
+        candidates = self.summary + new_sentences
+        embeddings = new_embeddings if self.summary_embeddings is None else np.vstack([self.summary_embeddings, new_embeddings])
+        selected = select_summary_sentences(list(range(len(candidates))), embeddings, self.summary_sentences)
+        self.summary = [candidates[i] for i in selected]
+        self.summary_embeddings = embeddings[selected]
+
+    def build(self, token_budget=PROMPT_TRANSCRIPT_TOKEN_BUDGET):
+        """
+        The context as prompt text within token_budget. Recent transcript comes first, the summary gets what's left,
+        losing its oldest sentences first.
+        """
+        recent = fit_to_token_budget(self.recent_text, token_budget - count_tokens(RECENT_HEADER))
+        remaining = token_budget - count_tokens(RECENT_HEADER + recent) - count_tokens(SUMMARY_HEADER)
+
+        summary = [sentence for _, sentence in self.summary]
+        while summary and count_tokens(" ".join(summary)) > remaining:
+            summary.pop(0)
+
+        if not summary:
+            return recent
+        return "{}{}\n\n{}{}".format(SUMMARY_HEADER, " ".join(summary), RECENT_HEADER, recent)
+
+
+# one per user, in each process that builds agent prompts
+rolling_contexts = dict()
+# prompts are built in executor threads, and a user's context must not be updated by two at once
+rolling_contexts_lock = threading.Lock()
+
+
+def get_rolling_context_for_user(db_handler, user_id, raw_seconds, token_budget=PROMPT_TRANSCRIPT_TOKEN_BUDGET):
+    """
+    The user's context for agent prompts, in place of the last raw_seconds of raw transcript.
+    """
+    now = time.time()
+    transcripts = db_handler.get_transcripts_from_last_nseconds_for_user(user_id, n=ROLLING_CONTEXT_LOOKBACK_SECONDS)
+    with rolling_contexts_lock:
+        for stale_user_id in [u for u, context in rolling_contexts.items() if now - context.updated_at > ROLLING_CONTEXT_LOOKBACK_SECONDS]:
+            del rolling_contexts[stale_user_id]
+        rolling_context = rolling_contexts.setdefault(user_id, RollingContext())
+        rolling_context.update(transcripts, now=now)
+        context = rolling_context.build(token_budget)
+
+    # what the context saves over sending the raw transcript
+    raw_tokens = count_tokens(db_handler.stringify_transcripts([t for t in transcripts if now - t['timestamp'] < raw_seconds]))
+    context_tokens = count_tokens(context)
+    metrics.observe("rolling_context.tokens", context_tokens)
+    metrics.increment("rolling_context.tokens_saved", max(0, raw_tokens - context_tokens))
+    logger.info("Rolling context for user {}: {} tokens instead of {} raw".format(user_id, context_tokens, raw_tokens))
+    return context
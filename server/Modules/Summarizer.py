@@ -1,9 +1,81 @@
 import os
+import re
+import json
+import threading
+from hashlib import sha256
+import numpy as np
+from sklearn.cluster import KMeans
 
 # OpenAI imports
 import openai
 from summarizer.sbert import SBertSummarizer
 from Modules.QueryLLM import *
+import Modules.word_frequency as word_frequency
+from helpers.ttl_lru_cache import TTLLRUCache
+import helpers.metrics as metrics
+from constants import SUMMARY_CACHE_MAX_SIZE, SUMMARY_CACHE_TTL, SUMMARY_CACHE_CONTEXT_WORDS
+
+# one SBERT summarizer model per process, shared by every Summarizer and loaded the first time it's used
+shared_sbert_summarizer = None
+shared_sbert_summarizer_lock = threading.Lock()
+
+
+def get_shared_sbert_summarizer():
+    global shared_sbert_summarizer
+    if shared_sbert_summarizer is None:
+        with shared_sbert_summarizer_lock:
+            if shared_sbert_summarizer is None:
+                shared_sbert_summarizer = SBertSummarizer('paraphrase-MiniLM-L6-v2')
+    return shared_sbert_summarizer
+
+
+def encode_texts(texts):
+    # unit length MiniLM embeddings from the shared summarizer model, so a dot product is the cosine similarity
+    embeddings = np.asarray(get_shared_sbert_summarizer().model(texts), dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+# in-process tier of the entity summary cache, in front of the database's cache collection
+summary_cache = TTLLRUCache(SUMMARY_CACHE_MAX_SIZE, SUMMARY_CACHE_TTL, name="summary_cache.memory")
+
+
+def get_context_bucket(context, num_words=SUMMARY_CACHE_CONTEXT_WORDS):
+    # a coarse version of the context - its rarest few words - so a transcript that grows by a few
+    # common words still maps to the same cached summary
+    words = set(re.findall(r"[a-z']+", context.lower()))
+    try:
+        ranked_words = sorted(words, key=lambda word: (-word_frequency.get_word_freq_index(word), word))
+    except TypeError:
+        # word frequency indices aren't loaded in this process, longest words are the next best guess at rare ones
+        ranked_words = sorted(words, key=lambda word: (-len(word), word))
+    return " ".join(sorted(ranked_words[:num_words]))
+
+
+def get_summary_cache_key(entity_description, context):
+    content = entity_description + " c: " + get_context_bucket(context)
+    return sha256(content.encode("utf-8")).hexdigest()
+
+
+def select_summary_sentences(sentences, sentence_embeddings, num_sentences, random_state=12345):
+    # same selection SBertSummarizer makes: keep the first sentence, then the sentence closest to each k-means centroid
+    if len(sentences) <= num_sentences:
+        return sentences
+    if num_sentences <= 1:
+        return sentences[:1]
+
+    # the first sentence is always kept, so only the rest are clustered
+    rest_embeddings = sentence_embeddings[1:]
+    kmeans = KMeans(n_clusters=num_sentences - 1, random_state=random_state, n_init=10).fit(rest_embeddings)
+    selected = set()
+    for centroid in kmeans.cluster_centers_:
+        distances = np.linalg.norm(rest_embeddings - centroid, axis=1)
+        for idx in np.argsort(distances):
+            if int(idx) + 1 not in selected:
+                selected.add(int(idx) + 1)
+                break
+    return [sentences[0]] + [sentences[idx] for idx in sorted(selected)]
+
 
 summarizer_prompt = """You are an expert at summarizing text in a way that is contextually relevant to the current conversation. You are an intelligent agent that is a sybsytem of the intelligent agent called. "Convoscope". You are the summarization worker agent of "Definer" agent. "Convoscope" is a tool that listens to a user's live conversation and enhances their conversation by providing them with real time "Insights". The "Definer" agent defines rare words, concepts, places, concepts, etc. live in conversation. You are the summarizer part of the "Definer" agent. You will be given text to summarize and a context of the transcripts of the current conversation. You will also be given a description of an entity. You should generaet a contextually relevant description of that entity. The description should aim to lead the user to deeper understanding, broader perspectives, new ideas, more accurate information, better replies, and enhanced conversations. Make sure the definition doesn't tell the user things they already know - exact pertinent and relevant information from the definition in your super short summary.
 
@@ -32,30 +104,139 @@ Conversational Context (DO NOT include this in the summary, just use it to help
 Summary in 8 words or less:\n
 """
 
+batch_summarizer_prompt = """You are an expert at summarizing text in a way that is contextually relevant to the current conversation. You are the summarizer part of the "Definer" agent of "Convoscope", a tool that listens to a user's live conversation and enhances their conversation by providing them with real time "Insights". You will be given descriptions of several entities and a context of the transcripts of the current conversation. You should generate a contextually relevant summary of each entity. The summaries should aim to lead the user to deeper understanding, broader perspectives, new ideas, more accurate information, better replies, and enhanced conversations. Make sure the summaries don't tell the user things they already know.
+
+Please summarize each "entity description" below to 8 words or less, extracting the most important information about the entity.
+
+    * Extract only the most important information about the entitiy, as summaries must be 8 words or less. 
+    * The summary should be easy to parse very quickly. 
+    * Leave out filler words. 
+    * Don't write the name of the entity. 
+    * Use less than 8 words for each summary. Be concise, brief, and succinct.
+    * Do not hallucinate, do not make things up. Use the source text.
+
+You will be given a "Conversational Context", which is the transcript from the live conversation. Use this to make the summaries contextually relevant and useful. The "Conversational Context" is not a source of truth, it's there to inform you of what is happening in the conversation.
+
+Entity descriptions to summarize, as a JSON object keyed by entity id:
+```
+{}
+```
+
+Conversational Context (DO NOT include this in the summaries, just use it to help you make contextually relevant summaries of the entity descriptions above):
+```
+{}
+```
+
+Output a JSON object with exactly the same keys, mapping each entity id to its summary of 8 words or less. Only output the JSON object, nothing else!
+"""
+
+
+def parse_batch_summaries(response, entity_ids):
+    # the model sometimes wraps the JSON in a code block or adds a sentence around it
+    start_idx = response.find("{")
+    end_idx = response.rfind("}")
+    if start_idx == -1 or end_idx == -1:
+        raise ValueError("No JSON object in batch summary response")
+    parsed = json.loads(response[start_idx:end_idx + 1])
+
+    summaries = dict()
+    for entity_id in entity_ids:
+        summary = parsed.get(entity_id)
+        if isinstance(summary, str) and summary.strip():
+            summaries[entity_id] = summary.strip()
+    return summaries
+
+
 class Summarizer:
 
     def __init__(self, database_handler):
         self.database_handler = database_handler
-        self.model = SBertSummarizer('paraphrase-MiniLM-L6-v2')
+
+    @property
+    def model(self):
+        return get_shared_sbert_summarizer()
 
     def summarize_entity(self, entity_description: str, context: str = "", chars_to_use=1250):
         # shorten entity_description if too long
         entity_description = entity_description[:min(
             chars_to_use, len(entity_description))]
 
-        # Check cache for summary first
-        #cache_key = entity_description + ' c: ' + context
-        #summary = self.database_handler.find_cached_summary(cache_key)
-        #if summary:
-        #    print("$$$ SUMMARY: FOUND CACHED SUMMARY")
-        #    return summary
+        # Check cache for summary first, in memory then in the database
+        cache_key = get_summary_cache_key(entity_description, context)
+        summary = self.find_cached_summary(cache_key)
+        if summary is not None:
+            return summary
 
         # Summary does not exist. Get it with OpenAI
-        # print("$$$ SUMMARY: SUMMARIZING WITH OPENAI")
         summary = self.summarize_entity_with_openai(entity_description, context)
-        self.database_handler.save_cached_summary(entity_description, summary)
+        self.save_cached_summary(cache_key, summary)
         return summary
 
+    def summarize_entities(self, entity_descriptions: dict, context: str = "", chars_to_use=1250):
+        """
+        Batch version of summarize_entity, takes {entity name: description} and returns {entity name: summary}.
+        Every entity that isn't cached is summarized in one LLM call, falling back to one call per entity if that fails.
+        """
+        summaries = dict()
+        pending = dict()
+        for entity_name, entity_description in entity_descriptions.items():
+            entity_description = entity_description[:min(
+                chars_to_use, len(entity_description))]
+            cache_key = get_summary_cache_key(entity_description, context)
+            summary = self.find_cached_summary(cache_key)
+            if summary is not None:
+                summaries[entity_name] = summary
+            else:
+                pending[entity_name] = (entity_description, cache_key)
+
+        if len(pending) > 1:
+            # entity names can be anything, so the prompt uses short ids instead
+            entity_names_by_id = {str(i + 1): entity_name for i, entity_name in enumerate(pending)}
+            prompt_entities = {entity_id: pending[entity_name][0] for entity_id, entity_name in entity_names_by_id.items()}
+            try:
+                response = one_off_query(prompt=batch_summarizer_prompt.format(json.dumps(prompt_entities), context), max_tokens=30 * len(pending) + 20)
+                batch_summaries = parse_batch_summaries(response, entity_names_by_id.keys())
+            except Exception as e:
+                print("Error summarizing {} entities in one call, summarizing them one at a time: {}".format(len(pending), e))
+                batch_summaries = dict()
+            metrics.increment("summarizer.batch_calls")
+
+            for entity_id, summary in batch_summaries.items():
+                entity_name = entity_names_by_id[entity_id]
+                summaries[entity_name] = summary
+                self.save_cached_summary(pending[entity_name][1], summary)
+
+        # anything the batch call didn't return gets its own call
+        for entity_name, (entity_description, cache_key) in pending.items():
+            if entity_name in summaries:
+                continue
+            if len(pending) > 1:
+                metrics.increment("summarizer.batch_fallbacks")
+            summary = self.summarize_entity_with_openai(entity_description, context)
+            summaries[entity_name] = summary
+            self.save_cached_summary(cache_key, summary)
+
+        return summaries
+
+    def find_cached_summary(self, cache_key):
+        summary = summary_cache.get(cache_key)
+        if summary is not None:
+            return summary
+
+        if self.database_handler is not None:
+            summary = self.database_handler.find_cached_summary(cache_key)
+            if summary:
+                metrics.increment("summary_cache.db.hit")
+                summary_cache.set(cache_key, summary)
+                return summary
+            metrics.increment("summary_cache.db.miss")
+        return None
+
+    def save_cached_summary(self, cache_key, summary):
+        summary_cache.set(cache_key, summary)
+        if self.database_handler is not None:
+            self.database_handler.save_cached_summary(cache_key, summary)
+
     def summarize_entity_with_openai(self, entity_description: str, context: str = ""):
             prompt = summarizer_prompt.format(entity_description, context)
             response = one_off_query(prompt=prompt)
@@ -63,3 +244,20 @@ class Summarizer:
 
     def summarize_description_with_bert(self, description, num_sentences=3):
         return self.model(description, num_sentences=num_sentences)
+
+    def summarize_descriptions_with_bert(self, descriptions, num_sentences=3):
+        # batch version of summarize_description_with_bert - embeds the sentences of every description in one pass
+        sentences_per_description = [self.model.sentence_handler(description, min_length=40, max_length=600) for description in descriptions]
+        all_sentences = [sentence for sentences in sentences_per_description for sentence in sentences]
+        if not all_sentences:
+            return ["" for _ in descriptions]
+
+        all_embeddings = np.asarray(self.model.model(all_sentences))
+
+        summaries = []
+        offset = 0
+        for sentences in sentences_per_description:
+            sentence_embeddings = all_embeddings[offset:offset + len(sentences)]
+            offset += len(sentences)
+            summaries.append(" ".join(select_summary_sentences(sentences, sentence_embeddings, num_sentences)))
+        return summaries
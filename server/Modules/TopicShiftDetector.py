@@ -0,0 +1,72 @@
+# local check for whether a user's conversation has moved on since the proactive agents last ran for them,
+# so the meta agent isn't sent the same 240s of transcript every cycle
+import time
+import numpy as np
+
+from Modules.Summarizer import encode_texts
+from constants import TOPIC_SHIFT_THRESHOLD, TOPIC_SHIFT_MIN_INTERVAL, TOPIC_SHIFT_MAX_INTERVAL, TOPIC_SHIFT_WINDOW_WORDS, TOPIC_SHIFT_CHUNK_WORDS
+import helpers.metrics as metrics
+
+# reasons should_run() gives
+RUN_FIRST = "first"
+RUN_DRIFT = "drift"
+RUN_MAX_INTERVAL = "max_interval"
+SKIP_MIN_INTERVAL = "min_interval"
+SKIP_NO_DRIFT = "no_drift"
+
+
+def embed_window(text, window_words=TOPIC_SHIFT_WINDOW_WORDS, chunk_words=TOPIC_SHIFT_CHUNK_WORDS):
+    """
+    Unit length embedding of the newest window_words words of text. MiniLM only reads the first ~128 tokens of
+    an input, so the window is embedded in chunks and the chunks averaged.
+    """
+    words = text.split()[-window_words:]
+    if not words:
+        return None
+    chunks = [" ".join(words[i:i + chunk_words]) for i in range(0, len(words), chunk_words)]
+    embedding = encode_texts(chunks).mean(axis=0)
+    return embedding / max(np.linalg.norm(embedding), 1e-12)
+
+
+class TopicShiftDetector:
+    """
+    Remembers the transcript window each user's proactive agents last ran on, and only lets them run again once
+    the newest window has drifted far enough from it (1 - cosine similarity over threshold). Never runs more
+    often than every min_interval seconds, and always runs after max_interval seconds.
+    """
+
+    def __init__(self, name="proactive.topic_shift", threshold=TOPIC_SHIFT_THRESHOLD,
+                 min_interval=TOPIC_SHIFT_MIN_INTERVAL, max_interval=TOPIC_SHIFT_MAX_INTERVAL):
+        self.name = name
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.last_runs = dict() # user_id -> (run time, window embedding)
+
+    def should_run(self, user_id, text, now=None):
+        """
+        Returns (should run, reason, drift, window embedding). Call mark_run() with the embedding if the run goes ahead.
+        """
+        now = time.time() if now is None else now
+        last_run = self.last_runs.get(user_id)
+        if last_run is not None and now - last_run[0] < self.min_interval:
+            return self.record(False, SKIP_MIN_INTERVAL, None, None)
+
+        embedding = embed_window(text)
+        if last_run is None or last_run[1] is None or embedding is None:
+            return self.record(True, RUN_FIRST, None, embedding)
+
+        drift = 1.0 - float(np.dot(embedding, last_run[1]))
+        metrics.observe(self.name + ".drift", drift)
+        if drift >= self.threshold:
+            return self.record(True, RUN_DRIFT, drift, embedding)
+        if now - last_run[0] >= self.max_interval:
+            return self.record(True, RUN_MAX_INTERVAL, drift, embedding)
+        return self.record(False, SKIP_NO_DRIFT, drift, embedding)
+
+    def record(self, should_run, reason, drift, embedding):
+        metrics.increment("{}.{}.{}".format(self.name, "run" if should_run else "skipped", reason))
+        return should_run, reason, drift, embedding
+
+    def mark_run(self, user_id, embedding, now=None):
+        self.last_runs[user_id] = (time.time() if now is None else now, embedding)
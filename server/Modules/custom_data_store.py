@@ -0,0 +1,167 @@
+# compiles a user's custom data csvs into one columnar numpy artifact, so reloads don't re-parse every csv
+# the manifest records the mtime, size and hash of every source csv, and the artifact is only rebuilt when those change
+import os
+import json
+from hashlib import sha256
+import numpy as np
+import pandas as pd
+
+from helpers.file_lock import file_lock, make_temp_path
+
+CUSTOM_DATA_STORE_FILE_NAME = "custom_data_store.npz"
+CUSTOM_DATA_STORE_MANIFEST_FILE_NAME = "custom_data_store_manifest.json"
+# the CSE, the ingestion worker and the definer all compile stores, one at a time per user
+CUSTOM_DATA_STORE_LOCK_FILE_NAME = "custom_data_store.lock"
+CUSTOM_DATA_COLUMNS = ["title", "description", "url", "image_url"]
+
+
+def hash_file(file_path):
+    file_hash = sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_next_custom_data_file_path(user_folder_path):
+    # user csvs are saved as data1.csv, data2.csv, ...
+    existing_files = [f for f in os.listdir(
+        user_folder_path) if f.startswith('data') and f.endswith('.csv')]
+    existing_numbers = [int(f[4:-4]) for f in existing_files if f[4:-4].isdigit()]
+    next_file_num = 1 if not existing_numbers else max(
+        existing_numbers) + 1
+    return os.path.join(user_folder_path, f'data{next_file_num}.csv')
+
+
+def load_store_manifest(user_folder_path):
+    manifest_path = os.path.join(user_folder_path, CUSTOM_DATA_STORE_MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print("Could not read custom data store manifest {}, rebuilding: {}".format(manifest_path, e))
+        return None
+
+
+def save_store_manifest(user_folder_path, manifest):
+    manifest_path = os.path.join(user_folder_path, CUSTOM_DATA_STORE_MANIFEST_FILE_NAME)
+    tmp_path = make_temp_path(manifest_path)
+    try:
+        with open(tmp_path, 'w', encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def fingerprint_sources(user_folder_path, previous_sources=None):
+    """
+    Returns {csv file name: {"mtime", "size", "sha256"}} for every csv in the user folder.
+    Files whose mtime and size match previous_sources keep their old hash instead of being re-read.
+    """
+    previous_sources = previous_sources or dict()
+    sources = dict()
+    for file_name in sorted(os.listdir(user_folder_path)):
+        if not file_name.endswith('.csv'):
+            continue
+        file_path = os.path.join(user_folder_path, file_name)
+        stat = os.stat(file_path)
+        previous = previous_sources.get(file_name)
+        if previous is not None and previous["mtime"] == stat.st_mtime_ns and previous["size"] == stat.st_size:
+            sources[file_name] = previous
+        else:
+            sources[file_name] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "sha256": hash_file(file_path)}
+    return sources
+
+
+def get_sources_version(sources):
+    # changes whenever any source csv is added, removed or has different content
+    content = "\n".join("{}:{}".format(file_name, sources[file_name]["sha256"]) for file_name in sorted(sources))
+    return sha256(content.encode("utf-8")).hexdigest()
+
+
+def encode_column(values):
+    # utf-8 buffer plus offsets, with a mask marking missing values
+    is_null = np.array([value is None or (isinstance(value, float) and np.isnan(value)) for value in values], dtype=bool)
+    encoded = [b'' if null else str(value).encode("utf-8") for value, null in zip(values, is_null)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(value) for value in encoded])
+    buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return buffer, offsets, is_null
+
+
+def decode_column(buffer, offsets, is_null):
+    raw = buffer.tobytes()
+    return [np.nan if is_null[i] else raw[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(is_null))]
+
+
+def compile_custom_data_store(user_folder_path, sources):
+    dfs = [pd.read_csv(os.path.join(user_folder_path, file_name)) for file_name in sources]
+    df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=["title", "description", "url"])
+    df = df.dropna(subset=['title'])
+
+    arrays = dict()
+    columns = [column for column in CUSTOM_DATA_COLUMNS if column in df]
+    for column in columns:
+        buffer, offsets, is_null = encode_column(df[column].tolist())
+        arrays[column + "_buffer"] = buffer
+        arrays[column + "_offsets"] = offsets
+        arrays[column + "_null"] = is_null
+
+    # np.savez adds .npz to names that don't already end with it
+    store_path = os.path.join(user_folder_path, CUSTOM_DATA_STORE_FILE_NAME)
+    tmp_path = make_temp_path(store_path, suffix=".tmp.npz")
+    try:
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, store_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    manifest = {"version": get_sources_version(sources), "sources": sources, "columns": columns, "num_rows": len(df.index)}
+    save_store_manifest(user_folder_path, manifest)
+    print("Compiled custom data store for {} from {} csv files ({} rows)".format(user_folder_path, len(sources), len(df.index)))
+    return manifest
+
+
+def ensure_custom_data_store(user_folder_path):
+    """
+    Rebuilds the store if any source csv changed since it was compiled, and returns its manifest.
+    When nothing changed this only stats the source files.
+    """
+    with file_lock(os.path.join(user_folder_path, CUSTOM_DATA_STORE_LOCK_FILE_NAME)):
+        return ensure_custom_data_store_locked(user_folder_path)
+
+
+def ensure_custom_data_store_locked(user_folder_path):
+    # another process may have compiled while we waited for the lock, so the manifest is only read once we hold it
+    manifest = load_store_manifest(user_folder_path)
+    previous_sources = manifest["sources"] if manifest else None
+    sources = fingerprint_sources(user_folder_path, previous_sources)
+
+    store_path = os.path.join(user_folder_path, CUSTOM_DATA_STORE_FILE_NAME)
+    if manifest and os.path.exists(store_path) and manifest["version"] == get_sources_version(sources):
+        if sources != previous_sources:
+            # files were touched but their content is the same, remember the new mtimes so they aren't hashed again
+            manifest["sources"] = sources
+            save_store_manifest(user_folder_path, manifest)
+        return manifest
+
+    return compile_custom_data_store(user_folder_path, sources)
+
+
+def load_custom_data_store(user_folder_path, manifest):
+    if manifest["num_rows"] == 0:
+        return pd.DataFrame(columns=manifest["columns"])
+
+    store_path = os.path.join(user_folder_path, CUSTOM_DATA_STORE_FILE_NAME)
+    # shared, so a compile can't swap the store out from under us, and only the columns actually in it in case it's
+    # already newer than the manifest we were given
+    with file_lock(os.path.join(user_folder_path, CUSTOM_DATA_STORE_LOCK_FILE_NAME), shared=True), np.load(store_path) as arrays:
+        data = {column: decode_column(arrays[column + "_buffer"], arrays[column + "_offsets"], arrays[column + "_null"])
+                for column in manifest["columns"] if column + "_buffer" in arrays}
+    return pd.DataFrame(data)
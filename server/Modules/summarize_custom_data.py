@@ -0,0 +1,78 @@
+# summarization stage of custom data ingestion
+# reads custom data in bounded chunks, then summarizes batches of rows across a pool of worker processes
+# so the embedder can consume summarized rows as a stream instead of waiting on one core
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import pandas as pd
+
+from constants import SUMMARIZE_CUSTOM_DATA, SUMMARIZE_CUSTOM_DATA_WORKERS, CUSTOM_DATA_CSV_CHUNK_SIZE
+
+# each worker process loads its own summarizer once, in _init_summarization_worker
+worker_summarizer = None
+
+
+def read_custom_data_in_chunks(csv_path, chunksize=CUSTOM_DATA_CSV_CHUNK_SIZE):
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        yield chunk
+
+
+def split_dataframe_in_chunks(df, chunksize=CUSTOM_DATA_CSV_CHUNK_SIZE):
+    for start_idx in range(0, len(df.index), chunksize):
+        yield df.iloc[start_idx:start_idx + chunksize]
+
+
+def _init_summarization_worker():
+    global worker_summarizer
+    from Modules.Summarizer import Summarizer
+    worker_summarizer = Summarizer(None)
+
+
+def summarize_row_batch(rows):
+    """
+    Sets row['summary'] for every row, embedding the sentences of the whole batch in one pass.
+    Falls back to the raw description if summarization fails.
+    """
+    if worker_summarizer is None:
+        _init_summarization_worker()
+
+    descriptions = [str(row['description']) for row in rows]
+    try:
+        summaries = worker_summarizer.summarize_descriptions_with_bert(descriptions)
+    except Exception as e:
+        print("Error summarizing batch of {} rows, using raw descriptions: {}".format(len(rows), e))
+        summaries = descriptions
+
+    for row, description, summary in zip(rows, descriptions, summaries):
+        row['summary'] = summary if summary else description
+    return rows
+
+
+def summarize_row_batches(row_batches, num_workers=SUMMARIZE_CUSTOM_DATA_WORKERS):
+    """
+    Takes an iterable of row batches (lists of row dicts) and yields the same batches, in order, with 'summary' set.
+    At most 2 * num_workers batches are in flight so memory stays bounded no matter how big the input is.
+    """
+    if not SUMMARIZE_CUSTOM_DATA:
+        for rows in row_batches:
+            for row in rows:
+                row['summary'] = str(row['description'])
+            yield rows
+        return
+
+    if num_workers <= 1:
+        for rows in row_batches:
+            yield summarize_row_batch(rows)
+        return
+
+    max_in_flight = 2 * num_workers
+    # spawn, as forking a process that already holds torch state is unsafe
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context, initializer=_init_summarization_worker) as executor:
+        in_flight = deque()
+        for rows in row_batches:
+            in_flight.append(executor.submit(summarize_row_batch, rows))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
@@ -1,13 +1,21 @@
 import os
 import sys
+import shutil
+import uuid
 from txtai.embeddings import Embeddings
 from txtai.pipeline import Similarity
-from Modules.Summarizer import Summarizer
-from constants import SUMMARIZE_CUSTOM_DATA
-import pandas as pd
+from Modules.summarize_custom_data import summarize_row_batches, read_custom_data_in_chunks, split_dataframe_in_chunks
+from Modules.custom_data_store import ensure_custom_data_store, load_custom_data_store, get_next_custom_data_file_path
+from helpers.file_lock import file_lock, make_temp_path
+from constants import SUMMARIZE_CUSTOM_DATA, EMBEDDING_BATCH_SIZE, SUMMARIZE_CUSTOM_DATA_WORKERS
+from hashlib import sha256
 import json
 
-summarizer = Summarizer(None)
+EMBEDDINGS_FILE_NAME = "custom_data_embeddings.txtai"
+# maps each indexed title to the content hash and stored (summarized) description it was embedded with
+EMBEDDINGS_MANIFEST_FILE_NAME = "custom_data_embeddings_manifest.json"
+# the CSE and the ingestion worker both update a user's index, one at a time
+EMBEDDINGS_LOCK_FILE_NAME = "custom_data_embeddings.lock"
 
 # utils
 def estimate_df_line_number(df_path):
@@ -19,21 +27,67 @@ def estimate_df_line_number(df_path):
         # get average size of 3 lines, assuming 1 byte encoding
         line_size = (len(f.readline()) + len(f.readline()) +
                      len(f.readline())) / 3
-        linecount = full_size // line_size + 1   # ~count of lines
+        linecount = full_size // line_size + 1 if line_size else 1   # ~count of lines
     return linecount
 
 
-def stream(dataset):
-    global stream_index
-    for idx, row in dataset.iterrows():
-        title = str(row['title'])
-
-        try:
-            description = summarizer.summarize_description_with_bert(str(row['description'])) if SUMMARIZE_CUSTOM_DATA else str(
-                row['description'])
-        except:
-            #print("Error summarizing entity: {}".format(row['title']))
-            description = str(row['description'])
+def hash_row(row):
+    # the summarize flag is part of the hash so toggling it rebuilds every row
+    content = "\x1f".join([str(row['title']), str(row['description']), str(row['url']), str(SUMMARIZE_CUSTOM_DATA)])
+    return sha256(content.encode("utf-8")).hexdigest()
+
+
+def load_embeddings_manifest(user_folder_path):
+    manifest_path = os.path.join(user_folder_path, EMBEDDINGS_MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print("Could not read embeddings manifest {}, rebuilding: {}".format(manifest_path, e))
+        return {}
+
+
+def save_embeddings_manifest(user_folder_path, manifest):
+    manifest_path = os.path.join(user_folder_path, EMBEDDINGS_MANIFEST_FILE_NAME)
+    tmp_path = make_temp_path(manifest_path)
+    try:
+        with open(tmp_path, 'w', encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def find_changed_rows(df, manifest):
+    """
+    Returns the rows of df whose content hash differs from the one stored in the manifest, with the hash attached.
+    Duplicate titles share one id in the index, so only the last row for a title is kept.
+    """
+    rows = dict()
+    for row in df.to_dict("records"):
+        row['title'] = str(row['title'])
+        row['hash'] = hash_row(row)
+        rows[row['title']] = row
+
+    return [row for title, row in rows.items() if manifest.get(title, {}).get("hash") != row['hash']]
+
+
+def get_stored_custom_data_titles(user_folder_path):
+    # titles in every csv the user has stored, compiling the store first if they changed
+    manifest = ensure_custom_data_store(user_folder_path)
+    if manifest["num_rows"] == 0 or "title" not in manifest["columns"]:
+        return set()
+    df = load_custom_data_store(user_folder_path, manifest)
+    return set(str(title) for title in df["title"].tolist())
+
+
+def stream(rows):
+    for row in rows:
+        title = row['title']
+        description = row['summary']
 
         #print("Title: {}".format(title))
         #print("-- Description: {}".format(description))
@@ -47,6 +101,44 @@ def stream(dataset):
         yield title, text, tags
 
 
+def swap_in_embeddings(version_path, embeddings_path):
+    """
+    Points embeddings_path at the index saved in version_path. embeddings_path is a symlink, replaced in one rename,
+    so readers see either the old index or the new one and never a half-swapped directory.
+    """
+    if os.path.exists(embeddings_path) and not os.path.islink(embeddings_path):
+        # an index saved before it was versioned, make it a version of its own first
+        legacy_path = "{}.{}".format(embeddings_path, uuid.uuid4().hex)
+        os.replace(embeddings_path, legacy_path)
+        os.symlink(os.path.basename(legacy_path), embeddings_path)
+
+    previous_path = os.path.realpath(embeddings_path) if os.path.islink(embeddings_path) else None
+    tmp_link_path = embeddings_path + ".link.tmp"
+    if os.path.lexists(tmp_link_path):
+        os.remove(tmp_link_path)
+    os.symlink(os.path.basename(version_path), tmp_link_path)
+    os.replace(tmp_link_path, embeddings_path)
+
+    # the previous version is kept for readers still loading it, anything older goes
+    keep = {os.path.realpath(version_path), previous_path}
+    folder_path = os.path.dirname(embeddings_path) or "."
+    version_prefix = os.path.basename(embeddings_path) + "."
+    for file_name in os.listdir(folder_path):
+        path = os.path.join(folder_path, file_name)
+        if file_name.startswith(version_prefix) and not file_name.endswith(".tmp") and os.path.realpath(path) not in keep:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def report_progress(done, total, progress_callback=None):
+    percent_embedded = (done / total) * 100 if total else 100
+    print("Embedding progress: {}/{} rows ({}% complete)".format(done, total, round(percent_embedded, 1)))
+    if progress_callback is not None:
+        progress_callback(done, total)
+
+
 def semantic_search(embeddings, query):
     return [(result["score"], result["text"], result["tags"]) for result in embeddings.search(f"select id, text, score, tags from txtai where similar('{query}')", limit=10)]
 
@@ -56,103 +148,121 @@ def ranksearch(query):
     return [(score, results[x]) for x, score in similarity(query, results)]
 
 
-# def convert_id(row):
-#     global mapper
-#     page_title = row["page_title"]
-#     wikidata_id = mapper.title_to_id(str(page_title).replace(" ", "_"))
-#     return wikidata_id
+def process(chunks, embeddings, manifest, total_rows, progress_callback=None):
+    # only new or changed rows get summarized and embedded - the summarization stage runs ahead of the embedder
+    progress = {"skipped": 0, "embedded": 0, "titles": set()}
 
+    def changed_row_batches():
+        for chunk in chunks:
+            progress["titles"].update(str(title) for title in chunk['title'].tolist())
+            changed_rows = find_changed_rows(chunk, manifest)
+            progress["skipped"] += len(chunk.index) - len(changed_rows)
+            for start_idx in range(0, len(changed_rows), EMBEDDING_BATCH_SIZE):
+                yield changed_rows[start_idx:start_idx + EMBEDDING_BATCH_SIZE]
 
-def process(df, embeddings):
-    # df['timestamp'] = pd.to_datetime(df['timestamp'],format='%Y-%m-%dT%H:%M:%SZ')
+    # a pool of summarization workers isn't worth its startup cost for a single batch
+    num_workers = SUMMARIZE_CUSTOM_DATA_WORKERS if total_rows > EMBEDDING_BATCH_SIZE else 1
 
-    # print("\n\n")
-    # print("BEFORE")
-    # print(df)
+    print("Starting making embeddings for up to {} rows...".format(total_rows))
+    for batch in summarize_row_batches(changed_row_batches(), num_workers=num_workers):
+        embeddings.upsert(stream(batch))
 
-    # add a column which is the wikidata id
-    # print("Generating wikidata id column")
-    # df['wikidata_id'] = df.apply(lambda row: convert_id(row), axis=1)
+        for row in batch:
+            manifest[row['title']] = {"hash": row['hash'], "description": row['summary']}
 
-    # filter the chunk down to just pages which are included in the top n qrank
-    # df = df[df["wikidata_id"].isin(qrank["Entity"])]
-    # print("AFTER")
-    # print(df)
-    # print("\n\n")
+        progress["embedded"] += len(batch)
+        report_progress(min(progress["skipped"] + progress["embedded"], total_rows), total_rows, progress_callback)
 
-    # dataset = df['abstract'].tolist()
+    print("Embedded {} new or changed rows, reused {} unchanged rows".format(progress["embedded"], progress["skipped"]))
+    report_progress(total_rows, total_rows, progress_callback)
+    return progress["embedded"], progress["titles"]
 
-    # Create embeddings model, backed by sentence-transformers & transformers,
-    # enable content storage
-    print("Starting making embeddings...")
-    embeddings.upsert(stream(df))
-    # insert into csv
-    # add_csv(dataset)
-    # top_wiki_name += dataset
-    # print("Done making embeddings.")
 
-    return embeddings
-
-    # Create similarity instance for re-ranking
-    # similarity = Similarity("valhalla/distilbart-mnli-12-3")
-
-    # queries = ["what a wonderful world", "Donald Trump", "big war in the 60s",
-    # "hippy music festival 1969", "opposite of day", "dog"] for query in queries:
-    # print("Running similiarity search.") print(ranksearch(query)[:2])
+def update_embeddings_from_chunks(chunks, user_id, total_rows, progress_callback=None):
+    user_folder_path = os.path.join('custom_data', str(user_id))
+    os.makedirs(user_folder_path, exist_ok=True)
+    # two updates at once would each start from the same manifest and drop the other's rows
+    with file_lock(os.path.join(user_folder_path, EMBEDDINGS_LOCK_FILE_NAME)):
+        return update_embeddings_from_chunks_locked(chunks, user_folder_path, total_rows, progress_callback=progress_callback)
 
 
-# mapper = WikiMapper("index_enwiki_latest_ossg.db")
+def update_embeddings_from_chunks_locked(chunks, user_folder_path, total_rows, progress_callback=None):
+    embeddings_path = os.path.join(user_folder_path, EMBEDDINGS_FILE_NAME)
 
+    embeddings = Embeddings(
+        {"path": "sentence-transformers/paraphrase-MiniLM-L3-v2", "content": True})
 
-# Load HF dataset
-# dataset = load_dataset("ag_news", split="train")
+    # start from the existing index so unchanged rows keep their stored summary and vector
+    manifest = load_embeddings_manifest(user_folder_path)
+    if manifest and os.path.exists(embeddings_path):
+        embeddings.load(embeddings_path)
+    else:
+        manifest = dict()
+
+    num_embedded, input_titles = process(chunks, embeddings, manifest, total_rows, progress_callback=progress_callback)
+
+    # rows that are in neither this input nor any of the user's stored csvs anymore were deleted, so stop matching them.
+    # the input alone isn't enough - earlier uploads live in their own csvs
+    live_titles = input_titles | get_stored_custom_data_titles(user_folder_path)
+    removed_titles = [title for title in manifest if title not in live_titles]
+    if removed_titles:
+        embeddings.delete(removed_titles)
+        for title in removed_titles:
+            del manifest[title]
+        print("Removed {} deleted rows from the embeddings index".format(len(removed_titles)))
+
+    if num_embedded == 0 and not removed_titles:
+        return embeddings
+
+    # save the new index as a new version next to the live one and swap it in, so readers never load a half-written
+    # index. the manifest is written last - the CSE reloads the index when it changes
+    version_path = "{}.{}".format(embeddings_path, uuid.uuid4().hex)
+    embeddings.save(version_path)
+    swap_in_embeddings(version_path, embeddings_path)
+    save_embeddings_manifest(user_folder_path, manifest)
 
-def update_embeddings(df, user_id):
-    # print("Loading CSV...")
-    # df = pd.read_csv('enwiki-20220901-pages-articles-multistream.csv', quotechar='|', index_col = False, nrows=NUMERO)
-    user_folder_path = os.path.join('custom_data', str(user_id))
-    # load the qrank top n csv to compare
-    # qrank = pd.read_csv("qrank_top_n_pandas_hundredthousand_2.csv")
-    # qrank = pd.read_csv("qrank_top_n_pandas_tenthousand_2.csv")
+    return embeddings
 
-    embeddings = Embeddings(
-        {"path": "sentence-transformers/paraphrase-MiniLM-L3-v2", "content": True})
-    # top_wiki_name = []
 
-    # chunk through the CSV so we don't load ~86Gb at once
-    # chunksize = 10 ** 4
-    # curr_line_idx = 0
-    # total_lines_to_proc = estimate_df_line_number(csv_path)
-    # i = 0
+def update_embeddings(df, user_id, progress_callback=None):
+    return update_embeddings_from_chunks(split_dataframe_in_chunks(df), user_id, len(df.index), progress_callback=progress_callback)
 
-    populated_embeddings = process(df, embeddings)
 
-    # for chunk in pd.read_csv(csv_path, quotechar='|', index_col = False, chunksize=chunksize):
-    # for chunk in pd.read_csv(csv_path, chunksize=chunksize):
-    #     curr_line_idx += len(chunk.index)
-    #     curr_percent_embedded = (curr_line_idx / total_lines_to_proc) * 100
-    #     print("Embedding progress: {}% complete".format(curr_percent_embedded))
-    #     print("Loaded CSV chunk.")
-    #     proc_finished_flag = process(chunk)
-    #     print("Processed CSV chunk.")
-    #     i += 1
+def update_embeddings_from_csv(csv_path, user_id, progress_callback=None):
+    # reads the csv a chunk at a time so large uploads are never fully in memory
+    total_rows = int(estimate_df_line_number(csv_path))
+    return update_embeddings_from_chunks(read_custom_data_in_chunks(csv_path), user_id, total_rows, progress_callback=progress_callback)
 
-    #     if proc_finished_flag:
-    #         break
 
-    populated_embeddings.save(
-        f"{user_folder_path}/custom_data_embeddings.txtai"
-    )
+def ingest_custom_data_csv(csv_path, user_id, progress_callback=None, data_file_path=None, save_data_file_path=None):
+    """
+    Embeds an uploaded csv, then moves it into the user's folder and recompiles their custom data store.
+    save_data_file_path(path) is called with where the csv will be moved before it's moved, so a job interrupted after
+    the move can pass it back as data_file_path and pick up from there. Returns where the csv ended up.
+    """
+    user_folder_path = os.path.join('custom_data', str(user_id))
+    os.makedirs(user_folder_path, exist_ok=True)
 
-    return populated_embeddings
+    if os.path.exists(csv_path):
+        if data_file_path is None or os.path.exists(data_file_path):
+            data_file_path = get_next_custom_data_file_path(user_folder_path)
+            if save_data_file_path is not None:
+                save_data_file_path(data_file_path)
+        update_embeddings_from_csv(csv_path, user_id, progress_callback=progress_callback)
+        shutil.move(csv_path, data_file_path)
+    elif data_file_path is not None and os.path.exists(data_file_path):
+        # an interrupted run already moved it, embedding again only redoes whatever it didn't finish
+        update_embeddings_from_csv(data_file_path, user_id, progress_callback=progress_callback)
+    else:
+        raise FileNotFoundError("Custom data upload {} is gone".format(csv_path))
 
-    # top_df = pd.DataFrame({'title':top_wiki_name})
-    # top_df.to_csv("test.csv")
+    ensure_custom_data_store(user_folder_path)
+    return data_file_path
 
 
 if __name__ == "__main__":
     os.makedirs(os.path.join('custom_data', str(
         sys.argv[1])), exist_ok=True)
-    embeddings = update_embeddings(pd.read_csv(sys.argv[2]), sys.argv[1])
+    embeddings = update_embeddings_from_csv(sys.argv[2], sys.argv[1])
     search_results = semantic_search(embeddings, "wearable augmentation and memory")
     print(search_results)
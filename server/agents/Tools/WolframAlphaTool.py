@@ -1,6 +1,10 @@
+import asyncio
 import wolframalpha
 from server_config import wolframalpha_api_key
 
+# when set, queries are handed to this instead of Wolfram Alpha, e.g. a helpers.simulator.Simulator
+wolfram_transport = None
+
 
 class WolframAlphaTool:
     def __init__(self):
@@ -11,6 +15,16 @@ class WolframAlphaTool:
             self.client = None
 
     def query(self, query: str) -> str:
+        if wolfram_transport is not None:
+            return wolfram_transport.wolfram_query(query, self.request_answer)
+        return self.request_answer(query)
+
+    async def a_query(self, query: str) -> str:
+        if wolfram_transport is not None:
+            return await wolfram_transport.wolfram_query_async(query, self.arequest_answer)
+        return await self.arequest_answer(query)
+
+    def request_answer(self, query: str) -> str:
         if self.client is None:
             return None
 
@@ -19,11 +33,13 @@ class WolframAlphaTool:
         
         return answer
 
-    async def a_query(self, query: str) -> str:
+    async def arequest_answer(self, query: str) -> str:
         if self.client is None:
             return None
 
-        response = self.client.query(query)
-        answer = next(response.results).text
-        
-        return answer
+        # newer clients are async themselves, older ones only block, so those run in a thread
+        if hasattr(self.client, "aquery"):
+            response = await self.client.aquery(query)
+            return next(response.results).text
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.request_answer, query)
@@ -1,4 +1,5 @@
 from agents.agent_utils import format_list_data
+from helpers.prompt_tokens import fit_to_token_budget, log_prompt_tokens
 
 expert_agent_prompt_blueprint = """
 ## General Context
@@ -128,12 +129,13 @@ def expert_agent_prompt_maker(
     expert_agent_prompt = expert_agent_prompt_blueprint.format(
         **expert_agent_config,
         final_command=final_command,
-        conversation_transcript=conversation_transcript,
+        conversation_transcript=fit_to_token_budget(conversation_transcript),
         insights_history=insights_history,
         format_instructions=format_instructions,
     )
 
     # print("expert_agent_prompt", expert_agent_prompt)
+    log_prompt_tokens("expert_agent." + expert_agent_config["agent_name"], expert_agent_prompt)
 
     return expert_agent_prompt
 
@@ -1,10 +1,15 @@
 from DatabaseHandler import DatabaseHandler
 import time
 import traceback
+import uuid
 from agents.wake_words import *
-from agents.explicit_meta_agent import run_explicit_meta_agent_async
+from agents.explicit_meta_agent import run_explicit_meta_agent_async, get_explicit_meta_agent, FinalAnswerStreamer
 import asyncio
 from helpers.time_function_decorator import time_function
+from Modules.LLMScheduler import explicit_llm_work_async, set_process_llm_priority, PRIORITY_EXPLICIT
+from agents.explicit_speculation import ExplicitQuerySpeculator
+from constants import SPECULATIVE_EXPLICIT_QUERIES, EXPLICIT_MAX_CONCURRENT_QUERIES
+import helpers.metrics as metrics
 
 dbHandler = DatabaseHandler(parent_handler=False)
 
@@ -16,6 +21,7 @@ force_query_time = 16
 def stringify_history(insight_history):
     history = ""
     for c in insight_history:
+        if c.get('partial'): continue
         history += "User: {}\nLLM:{}\n\n".format(c['query'], c['insight'])
     return history
 
@@ -31,10 +37,22 @@ def explicit_agent_processing_loop():
     #lock = threading.Lock()
 
     print("START AGENT INSIGHT PROCESSING LOOP")
+    set_process_llm_priority(PRIORITY_EXPLICIT)
+    # build the agent graph now instead of on the first query
+    get_explicit_meta_agent()
+    asyncio.run(explicit_agent_processing_loop_async())
+
+
+async def explicit_agent_processing_loop_async():
+    # agent runs are tasks of their own, so a slow answer for one wearer doesn't hold up wake word scanning for the rest
+    query_slots = asyncio.Semaphore(EXPLICIT_MAX_CONCURRENT_QUERIES)
+    user_locks = dict() # user_id -> lock, so one user's queries are answered one at a time and in order
+    running_queries = set()
+    speculator = ExplicitQuerySpeculator(query_slots)
     while True:
         if not dbHandler.ready:
             print("dbHandler not ready")
-            time.sleep(0.1)
+            await asyncio.sleep(0.1)
             continue
 
         try:
@@ -61,32 +79,72 @@ def explicit_agent_processing_loop():
                 if latest_transcript and (current_time > latest_transcript['timestamp'] + pause_query_time):
                     is_query_ready = True
 
-                if not is_query_ready: continue
+                if not is_query_ready:
+                    # start answering what we've heard of the query so far, the answer is kept if the query doesn't change
+                    # but not while their last query is still being answered, it'd run out of turn and without its answer in the history
+                    user_lock = user_locks.get(user['user_id'])
+                    if SPECULATIVE_EXPLICIT_QUERIES and not (user_lock is not None and user_lock.locked()):
+                        query = get_explicit_query_for_user(user, current_time)
+                        speculator.update(user['user_id'], query, lambda: get_chat_history_for_user(user))
+                    continue
                 
                 dbHandler.reset_wake_word_time_for_user(user['user_id'])
 
-                # Because last_wake_word_time is set when the wake word is found, and NOT when the wake word actually occured,
-                # we need to add a high number such as force_query_time to offset that inaccuracy
-                num_seconds_to_get = round(current_time - last_wake_word_time) + force_query_time
-                text = dbHandler.get_transcripts_from_last_nseconds_for_user_as_string(user_id=user['user_id'], n=num_seconds_to_get)#, transcript_list=user['final_transcripts'])
-
-                # Pull query out of the text
-                query = get_explicit_query_from_transcript(text)
+                query = get_explicit_query_for_user(user, current_time)
                 if query is None: 
-                    print("THE QUERY IS NOTHING?!?! TEXT: " + text)
+                    print("THE QUERY IS NOTHING?!?! USER: " + user['user_id'])
+                    speculator.discard(user['user_id'])
                     continue
                 
-                asyncio.run(call_explicit_agent(user, query))
+                user_lock = user_locks.setdefault(user['user_id'], asyncio.Lock())
+                task = asyncio.ensure_future(run_explicit_query(user, query, speculator.take(user['user_id'], query), user_lock, query_slots))
+                running_queries.add(task)
+                task.add_done_callback(running_queries.discard)
 
         except Exception as e:
             print("Exception in EXPLITT QUERY STUFF..:")
             print(e)
             traceback.print_exc()
-        time.sleep(0.1)
+        finally:
+            metrics.log_metrics_if_due("explicit_agent_process")
+        await asyncio.sleep(0.1)
+
+
+async def run_explicit_query(user, query, speculative_run, user_lock, query_slots):
+    queued_time = time.time()
+    try:
+        async with user_lock:
+            if speculative_run is not None:
+                # the speculative run already holds a slot
+                metrics.observe("explicit.slot_wait", time.time() - queued_time)
+                await call_explicit_agent(user, query, speculative_run)
+                return
+            async with query_slots:
+                metrics.observe("explicit.slot_wait", time.time() - queued_time)
+                await call_explicit_agent(user, query)
+    except Exception as e:
+        print("Exception in explicit query for user {}:".format(user['user_id']))
+        print(e)
+        traceback.print_exc()
+
+
+def get_explicit_query_for_user(user, current_time):
+    # Because last_wake_word_time is set when the wake word is found, and NOT when the wake word actually occured,
+    # we need to add a high number such as force_query_time to offset that inaccuracy
+    num_seconds_to_get = round(current_time - user['last_wake_word_time']) + force_query_time
+    text = dbHandler.get_transcripts_from_last_nseconds_for_user_as_string(user_id=user['user_id'], n=num_seconds_to_get)#, transcript_list=user['final_transcripts'])
+
+    # Pull query out of the text
+    return get_explicit_query_from_transcript(text)
+
+
+def get_chat_history_for_user(user):
+    insight_history = dbHandler.get_explicit_insights_history_for_user(user['user_id'], device_id=None, should_consume=False, include_consumed=True)
+    return stringify_history(insight_history)
 
 
 @time_function()
-async def call_explicit_agent(user_obj, query):
+async def call_explicit_agent(user_obj, query, speculative_run=None):
     user = user_obj
 
     print("Run EXPLICIT QUERY STUFF with... user_id: '{}' ... text: '{}'".format(
@@ -95,20 +153,46 @@ async def call_explicit_agent(user_obj, query):
     query_uuid = dbHandler.add_explicit_query_for_user(user['user_id'], query)
 
     # Set up prompt for Meta Agent
-    insight_history = dbHandler.get_explicit_insights_history_for_user(user['user_id'], device_id=None, should_consume=False, include_consumed=True)
-    chat_history = stringify_history(insight_history)
+    chat_history = get_chat_history_for_user(user)
     
     insightGenerationStartTime = time.time()
+
+    # the answer is shown as it's written, and replaced by the complete one under the same uuid at the end
+    insight_uuid = str(uuid.uuid4())
+    first_word_time = None
+    last_partial_insight = None
+    finalized = False
+    def save_partial_insight(partial_insight):
+        nonlocal first_word_time, last_partial_insight
+        if finalized:
+            return
+        last_partial_insight = partial_insight
+        if first_word_time is None:
+            first_word_time = time.time()
+            metrics.observe("explicit.time_to_first_word", first_word_time - insightGenerationStartTime)
+        dbHandler.add_explicit_insight_result_for_user(user['user_id'], query, partial_insight, insight_uuid=insight_uuid, partial=True)
+
     try:
         print(" RUN THE INSIGHT FOR EXPLICIT ")
-        insight = await run_explicit_meta_agent_async(chat_history, query)
+        if speculative_run is not None:
+            # already started on this exact query while the wearer was still talking
+            speculative_run.streamer.set_on_partial_answer(save_partial_insight)
+            insight = await speculative_run.task
+        else:
+            # explicit queries go ahead of every other user's background LLM work
+            async with explicit_llm_work_async():
+                insight = await run_explicit_meta_agent_async(chat_history, query, callbacks=[FinalAnswerStreamer(save_partial_insight)])
         
         print("========== 200 IQ INSIGHT ===========")
         print(insight)
         print("=====================================")
         
         #save this insight to the DB for the user
-        dbHandler.add_explicit_insight_result_for_user(user['user_id'], query, insight)
+        dbHandler.add_explicit_insight_result_for_user(user['user_id'], query, insight, insight_uuid=insight_uuid)
+        finalized = True
+        if first_word_time is None:
+            # nothing was streamed, the first words shown are the complete answer
+            metrics.observe("explicit.time_to_first_word", time.time() - insightGenerationStartTime)
     except Exception as e:
         print("Exception in agent.run()...:")
         print(e)
@@ -117,11 +201,18 @@ async def call_explicit_agent(user_obj, query):
         # TODO: Use GPT to generate a random funny error message
         fallback_insight = "Hmm, not sure about that one, bud."
 
-        dbHandler.add_explicit_insight_result_for_user(user['user_id'], query, fallback_insight)
+        dbHandler.add_explicit_insight_result_for_user(user['user_id'], query, fallback_insight, insight_uuid=insight_uuid)
+        finalized = True
         dbHandler.reset_wake_word_time_for_user(user['user_id'])
+    finally:
+        # cancelled runs skip both saves above, and a partial answer left behind would be re-sent on every poll
+        if not finalized and last_partial_insight is not None:
+            finalized = True
+            dbHandler.add_explicit_insight_result_for_user(user['user_id'], query, last_partial_insight, insight_uuid=insight_uuid)
 
     dbHandler.reset_wake_word_time_for_user(user['user_id'])
 
     insightGenerationEndTime = time.time()
+    metrics.observe("explicit.answer_latency", insightGenerationEndTime - insightGenerationStartTime)
     print("=== insightGeneration completed in {} seconds ===".format(
         round(insightGenerationEndTime - insightGenerationStartTime, 2)))
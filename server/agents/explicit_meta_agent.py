@@ -6,11 +6,21 @@ from langchain.agents.tools import Tool
 from server_config import openai_api_key
 from langchain.agents import AgentType
 import asyncio
+import time
+import contextvars
+from functools import lru_cache
+from langchain.callbacks.base import BaseCallbackHandler, AsyncCallbackHandler
 from Modules.LangchainSetup import *
 from helpers.time_function_decorator import time_function
+import helpers.metrics as metrics
+from constants import EXPLICIT_STREAM_UPDATE_INTERVAL
 
 
 llm = get_langchain_gpt4()
+# the meta agent streams, so its final answer can be shown while it's still being written
+streaming_llm = get_langchain_gpt4(streaming=True)
+
+FINAL_ANSWER_PREFIX = "Final Answer:"
 
 #explictly respond to user queries
 explicit_meta_agent_prompt_blueprint = """You are a highly intelligent, skilled, and helpful assistant that helps answer user queries that they make during their conversations.
@@ -33,27 +43,119 @@ Actions should ONLY be for using tools or returning the final answer. If you hav
 """
 
 
+# the transcript of the query being answered. the agent graph is built once per process, so the expert agents
+# read the transcript from here when they run instead of having it baked into their prompts
+explicit_transcript = contextvars.ContextVar("explicit_transcript", default="")
+# callbacks for the expert agents' LLM calls, which the meta agent's run callbacks don't reach
+expert_agent_callbacks = contextvars.ContextVar("expert_agent_callbacks", default=None)
+
+
+class FirstLLMCallTimer(BaseCallbackHandler):
+    """
+    Records how long after the query came in the first LLM request was made, i.e. the overhead before any answering starts.
+    """
+
+    def __init__(self, start_time=None):
+        self.start_time = time.time() if start_time is None else start_time
+        self.time_to_first_llm_call = None
+
+    def record_llm_call(self):
+        if self.time_to_first_llm_call is None:
+            self.time_to_first_llm_call = time.time() - self.start_time
+            metrics.observe("explicit.time_to_first_llm_call", self.time_to_first_llm_call)
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.record_llm_call()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.record_llm_call()
+
+
+class LLMTokenCounter(BaseCallbackHandler):
+    """
+    Counts the LLM calls and tokens of one agent run, so we know what a speculative run cost if it's thrown away.
+    """
+
+    def __init__(self):
+        self.calls_started = 0
+        self.calls_finished = 0
+        self.total_tokens = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.calls_started += 1
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.calls_started += 1
+
+    def on_llm_end(self, response, **kwargs):
+        self.calls_finished += 1
+        token_usage = (response.llm_output or {}).get("token_usage", {})
+        self.total_tokens += token_usage.get("total_tokens", 0)
+
+
+class FinalAnswerStreamer(AsyncCallbackHandler):
+    """
+    Follows the meta agent's streamed output and passes the final answer so far to on_partial_answer(text) as it's
+    written, at most every EXPLICIT_STREAM_UPDATE_INTERVAL seconds. on_partial_answer can be set after the run has
+    started, e.g. once a speculative run is committed - it's then sent the answer so far right away.
+    """
+
+    def __init__(self, on_partial_answer=None):
+        self.on_partial_answer = on_partial_answer
+        self.llm_output = ""
+        self.partial_answer = None
+        self.last_sent_time = 0
+
+    async def on_chat_model_start(self, serialized, messages, **kwargs):
+        # only the last call of the run has the final answer
+        self.llm_output = ""
+
+    async def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_output = ""
+
+    async def on_llm_new_token(self, token, **kwargs):
+        self.llm_output += token
+        index = self.llm_output.find(FINAL_ANSWER_PREFIX)
+        if index == -1:
+            return
+        self.partial_answer = self.llm_output[index + len(FINAL_ANSWER_PREFIX):].strip()
+        if self.partial_answer and time.time() - self.last_sent_time >= EXPLICIT_STREAM_UPDATE_INTERVAL:
+            self.send_partial_answer()
+
+    def set_on_partial_answer(self, on_partial_answer):
+        self.on_partial_answer = on_partial_answer
+        if self.partial_answer:
+            self.send_partial_answer()
+
+    def send_partial_answer(self):
+        if self.on_partial_answer is None:
+            return
+        self.last_sent_time = time.time()
+        self.on_partial_answer(self.partial_answer)
+
+
 # makes the wrapper fnction for expert agents when they're run as tools - a function factory so we don't have weird scope issues
 @time_function()
-def make_expert_agent_run_wrapper_function(agent, agent_explicit_prompt, is_async=True):
+def make_expert_agent_run_wrapper_function(agent, expert_agent, is_async=True):
+    def make_prompt(command):
+        agent_explicit_prompt = expert_agent_prompt_maker(expert_agent, explicit_transcript.get())
+        return agent_explicit_prompt + '\n[Extra Instructions]\n' + command
+
     def run_expert_agent_wrapper(command):
-        return agent.run(agent_explicit_prompt + '\n[Extra Instructions]\n' + command)
+        return agent.run(make_prompt(command), callbacks=expert_agent_callbacks.get())
 
     async def run_expert_agent_wrapper_async(command):
-        return await agent.arun(agent_explicit_prompt + '\n[Extra Instructions]\n' + command)
+        return await agent.arun(make_prompt(command), callbacks=expert_agent_callbacks.get())
 
     return run_expert_agent_wrapper_async if is_async else run_expert_agent_wrapper
 
 
 # generate expert agents as tools (each one has a search engine, later make the tools each agent has programmatic)
 @time_function()
-def make_expert_agents_as_tools(transcript):
+def make_expert_agents_as_tools():
     tools = []
     expert_agents_list = list(expert_agent_config_list.values())
     for expert_agent in expert_agents_list:
-        # make the expert agent with it own special prompt
-        expert_agent_explicit_prompt = expert_agent_prompt_maker(expert_agent, transcript)
-
         agent_tools = []
 
         if "Search_Engine" in expert_agent['tools']:
@@ -65,12 +167,10 @@ def make_expert_agents_as_tools(transcript):
         new_expert_agent = initialize_agent(agent_tools, llm, agent=AgentType.CHAT_ZERO_SHOT_REACT_DESCRIPTION, verbose=True)
 
         # use function factory to make expert agent runner wrapper
-        run_expert_agent_wrapper = make_expert_agent_run_wrapper_function(new_expert_agent, expert_agent_explicit_prompt)
-
         expert_agent_as_tool = Tool(
             name=expert_agent['agent_name'],
-            func=run_expert_agent_wrapper,
-            coroutine=run_expert_agent_wrapper,
+            func=make_expert_agent_run_wrapper_function(new_expert_agent, expert_agent, is_async=False),
+            coroutine=make_expert_agent_run_wrapper_function(new_expert_agent, expert_agent),
             description="Use this tool when: " + expert_agent['proactive_tool_description']
         )
     
@@ -79,31 +179,41 @@ def make_expert_agents_as_tools(transcript):
 
 
 @time_function()
-def get_explicit_meta_agent(transcript):
-    expert_agents_as_tools = make_expert_agents_as_tools(transcript)
+def build_explicit_meta_agent():
+    expert_agents_as_tools = make_expert_agents_as_tools()
     print("EXPERT AGENTS AS TOOLS")
     print(expert_agents_as_tools)
     explicit_meta_agent = initialize_agent(
             expert_agents_as_tools, 
-            llm, 
+            streaming_llm, 
             agent=AgentType.CHAT_ZERO_SHOT_REACT_DESCRIPTION, 
             max_iterations=10, 
             verbose=True)
     return explicit_meta_agent
 
 
+# the meta agent and its expert agents don't depend on the query, so they're built once per process
+@lru_cache(maxsize=None)
+def get_explicit_meta_agent():
+    return build_explicit_meta_agent()
+
+
 @time_function()
 def run_explicit_meta_agent(context, query):
+    start_time = time.time()
     prompt = explicit_meta_agent_prompt_blueprint.format(conversation_context=context, query=query)
-    transcript = "{}\nQuery: {}".format(context, query)
-    return get_explicit_meta_agent(transcript).run(prompt)
+    explicit_transcript.set("{}\nQuery: {}".format(context, query))
+    return get_explicit_meta_agent().run(prompt, callbacks=[FirstLLMCallTimer(start_time)])
 
 
 @time_function()
-async def run_explicit_meta_agent_async(context, query):
+async def run_explicit_meta_agent_async(context, query, callbacks=None, expert_callbacks=None):
+    start_time = time.time()
     prompt = explicit_meta_agent_prompt_blueprint.format(conversation_context=context, query=query)
-    transcript = "{}\nQuery: {}".format(context, query)
-    return await (get_explicit_meta_agent(transcript).arun(prompt))
+    # set in this task's context only, so concurrent queries each see their own transcript
+    explicit_transcript.set("{}\nQuery: {}".format(context, query))
+    expert_agent_callbacks.set(expert_callbacks)
+    return await get_explicit_meta_agent().arun(prompt, callbacks=[FirstLLMCallTimer(start_time)] + (callbacks or []))
 
 
 if __name__ == '__main__':
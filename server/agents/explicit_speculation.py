@@ -0,0 +1,92 @@
+import re
+import time
+import asyncio
+
+from agents.explicit_meta_agent import run_explicit_meta_agent_async, LLMTokenCounter, FinalAnswerStreamer
+from Modules.LLMScheduler import explicit_llm_work_async
+from constants import EXPLICIT_SPECULATION_MIN_WORDS, EXPLICIT_SPECULATION_MIN_RESTART_INTERVAL
+import helpers.metrics as metrics
+
+
+def normalize_query(query):
+    # the transcriber keeps revising punctuation and casing, which shouldn't count as the query changing
+    return " ".join(re.findall(r"[a-z0-9']+", query.lower()))
+
+
+class SpeculativeRun:
+
+    def __init__(self, query, task, token_counter, streamer):
+        self.query = normalize_query(query)
+        self.task = task
+        self.token_counter = token_counter
+        # holds on to the streamed answer until the run is committed and there's somewhere to show it
+        self.streamer = streamer
+        self.started_at = time.time()
+
+
+class ExplicitQuerySpeculator:
+    """
+    Starts the explicit agent on a wearer's partial query while they're still talking, restarting it as the query
+    grows. When the query is final, a run on that same query is handed over instead of starting from scratch.
+    """
+
+    def __init__(self, query_slots):
+        self.query_slots = query_slots # shared with final runs, so speculation can't go past the concurrency cap
+        self.in_flight = dict() # user_id -> SpeculativeRun
+
+    def update(self, user_id, query, get_chat_history):
+        if query is None or len(normalize_query(query).split()) < EXPLICIT_SPECULATION_MIN_WORDS:
+            return
+
+        current = self.in_flight.get(user_id)
+        if current is not None:
+            if current.query == normalize_query(query):
+                return
+            # don't restart on every word, the query will likely have grown again by the time a run gets anywhere
+            if time.time() - current.started_at < EXPLICIT_SPECULATION_MIN_RESTART_INTERVAL:
+                return
+            self.discard(user_id)
+            metrics.increment("explicit.speculation.restarted")
+
+        token_counter = LLMTokenCounter()
+        streamer = FinalAnswerStreamer()
+        # the expert agents' LLM calls are counted too, but only the meta agent's output has the answer to stream
+        task = asyncio.ensure_future(self.run(get_chat_history(), query, [token_counter, streamer], [token_counter]))
+        self.in_flight[user_id] = SpeculativeRun(query, task, token_counter, streamer)
+        metrics.increment("explicit.speculation.started")
+
+    async def run(self, chat_history, query, callbacks, expert_callbacks):
+        async with self.query_slots:
+            async with explicit_llm_work_async():
+                return await run_explicit_meta_agent_async(chat_history, query, callbacks=callbacks, expert_callbacks=expert_callbacks)
+
+    def take(self, user_id, query):
+        """
+        Returns the speculative run for this user's final query, or None if there's no usable one.
+        """
+        current = self.in_flight.get(user_id)
+        if current is None:
+            return None
+        failed = current.task.done() and (current.task.cancelled() or current.task.exception() is not None)
+        if current.query != normalize_query(query) or failed:
+            self.discard(user_id)
+            return None
+
+        del self.in_flight[user_id]
+        metrics.increment("explicit.speculation.committed")
+        return current
+
+    def discard(self, user_id):
+        current = self.in_flight.pop(user_id, None)
+        if current is None:
+            return
+        current.task.cancel()
+        # everything a thrown away run used is wasted, including calls cut off mid-request that the provider may still bill
+        metrics.increment("explicit.speculation.discarded")
+        metrics.increment("explicit.speculation.wasted_tokens", current.token_counter.total_tokens)
+        metrics.increment("explicit.speculation.cancelled_llm_calls",
+                          current.token_counter.calls_started - current.token_counter.calls_finished)
+
+    def discard_all(self):
+        for user_id in list(self.in_flight.keys()):
+            self.discard(user_id)
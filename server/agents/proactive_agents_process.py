@@ -4,29 +4,74 @@ import math
 import uuid
 import asyncio
 import logging
+from functools import partial
 
 #custom
 from DatabaseHandler import DatabaseHandler
-from agents.proactive_meta_agent import run_proactive_meta_agent_and_experts
+from agents.proactive_meta_agent import run_proactive_meta_agent_and_experts_async
+from agents.proactive_work import ProactiveWorkTracker
 from server_config import openai_api_key
 from logger_config import logger
+from constants import PROACTIVE_AGENTS_MAX_AGE, PROACTIVE_AGENTS_MAX_CONCURRENT, TOPIC_SHIFT_GATE, INSIGHTS_HISTORY_IN_PROMPT
+from Modules.TopicShiftDetector import TopicShiftDetector
+from Modules.RollingContext import get_rolling_context_for_user
+from Modules.InsightDeduplicator import InsightDeduplicator
+from Modules.LLMScheduler import set_process_llm_priority, PRIORITY_PROACTIVE
+import helpers.metrics as metrics
 
 def proactive_agents_processing_loop():
     print("START MULTI AGENT PROCESSING LOOP")
+    set_process_llm_priority(PRIORITY_PROACTIVE)
+    asyncio.run(proactive_agents_processing_loop_async())
+
+
+async def generate_insights_for_user(dbHandler, insight_deduplicator, user_id, transcript_to_use, insights_history):
+    insightGenerationStartTime = time.time()
+    try:
+        #run proactive meta agent, get insights
+        insights = await run_proactive_meta_agent_and_experts_async(transcript_to_use, insights_history)
+        print("insights: {}".format(insights))
+        # [{'agent_name': 'Statistician', 'agent_insight': "Insight: Brain's processing limit challenges full Wikipedia integration. Neuralink trials show promising BCI advancements."},
+        # {'agent_name': 'FactChecker', 'agent_insight': 'null'},
+        # {'agent_name': 'DevilsAdvocate', 'agent_insight': 'Insight: Is more information always beneficial, or could it lead to cognitive overload?'}]
+
+        # near duplicates of what the user was recently shown are dropped here rather than by prompting the agents
+        # in a thread, so encoding doesn't stall the other users' in-flight tasks
+        unique_insights = await asyncio.get_running_loop().run_in_executor(None, insight_deduplicator.filter_insights, user_id, insights)
+        for insight, embedding in unique_insights:
+            #save this insight to the DB for the user
+            dbHandler.add_agent_insight_result_for_user(user_id, insight["agent_name"], insight["agent_insight"], insight["reference_url"], embedding=embedding)
+
+    except Exception as e:
+        print("Exception in agent.run()...:")
+        print(e)
+        traceback.print_exc()
+        return
+    insightGenerationEndTime = time.time()
+    print("=== insightGeneration completed in {} seconds ===".format(
+        round(insightGenerationEndTime - insightGenerationStartTime, 2)))
+
+
+async def proactive_agents_processing_loop_async():
     dbHandler = DatabaseHandler(parent_handler=False)
-    loop = asyncio.get_event_loop()
+    # each user's insights run as their own task, superseded by newer transcript windows and dropped once stale
+    tracker = ProactiveWorkTracker("agents", PROACTIVE_AGENTS_MAX_AGE, 240, max_concurrent=PROACTIVE_AGENTS_MAX_CONCURRENT)
+    # only run the meta agent again once the conversation has moved on
+    topic_shift_detector = TopicShiftDetector()
+    insight_deduplicator = InsightDeduplicator(dbHandler)
 
     while True:
         if not dbHandler.ready:
             print("dbHandler not ready")
-            time.sleep(0.1)
+            await asyncio.sleep(0.1)
             continue
         
         #wait for some transcripts to load in
-        time.sleep(15)
+        await asyncio.sleep(15)
 
         try:
             pLoopStartTime = time.time()
+            cycle_tasks = []
             # Check for new transcripts
             print("RUNNING MULTI-AGENT LOOP")
             newTranscripts = dbHandler.get_recent_transcripts_from_last_nseconds_for_all_users(n=240)
@@ -34,45 +79,43 @@ def proactive_agents_processing_loop():
                 if len(transcript['text']) < 400: # Around 75-100 words, no point to generate insight below this
                     print("Transcript too short, skipping...")
                     continue
+
+                # embedding windows and summaries runs in a thread so it doesn't stall the users' in-flight tasks
+                loop = asyncio.get_running_loop()
+                if TOPIC_SHIFT_GATE:
+                    should_run, reason, drift, window_embedding = await loop.run_in_executor(
+                        None, topic_shift_detector.should_run, transcript['user_id'], transcript['text'])
+                    if not should_run:
+                        print("Conversation hasn't moved on ({}), skipping insights for user {}...".format(reason, transcript['user_id']))
+                        continue
+
                 print("Run Insights generation with... user_id: '{}' ... text: '{}'".format(
                     transcript['user_id'], transcript['text']))
-                insightGenerationStartTime = time.time()
               
                 # TODO: Test this quick n' dirty way of preventing proactive from running on explicit queries
-                transcript_to_use = transcript['text']
+                # recent transcript verbatim plus a summary of what came before, instead of the whole 240s raw
+                transcript_to_use = await loop.run_in_executor(
+                    None, partial(get_rolling_context_for_user, dbHandler, transcript['user_id'], raw_seconds=240))
                 explicit_history = dbHandler.get_explicit_query_history_for_user(user_id=transcript['user_id'], device_id=None, should_consume=False, include_consumed=True)
                 for hist_item in explicit_history:
-                    transcript_to_use.replace(hist_item['query'], ' ... ')
-
-                try:
-                    # insights_history = dbHandler.get_agent_insights_history_for_user(transcript['user_id'])
-                    insights_history = dbHandler.get_recent_nminutes_agent_insights_history_for_user(transcript['user_id'])
-                    print("insights_history: {}".format(insights_history))
-                    # [{'agent_name': 'Statistician', 'agent_insight': "Insight: Brain's processing limit challenges full Wikipedia integration. Neuralink trials show promising BCI advancements."}, ...]
-
-                    logger.log(level=logging.DEBUG, msg="Insights history: {}".format(insights_history))
-
-                    #run proactive meta agent, get insights
-                    insights = run_proactive_meta_agent_and_experts(transcript_to_use, insights_history)
-                    print("insights: {}".format(insights))
-                    # [{'agent_name': 'Statistician', 'agent_insight': "Insight: Brain's processing limit challenges full Wikipedia integration. Neuralink trials show promising BCI advancements."},
-                    # {'agent_name': 'FactChecker', 'agent_insight': 'null'},
-                    # {'agent_name': 'DevilsAdvocate', 'agent_insight': 'Insight: Is more information always beneficial, or could it lead to cognitive overload?'}]
-
-                    for insight in insights:
-                        if insight is None:
-                            continue
-                        #save this insight to the DB for the user
-                        dbHandler.add_agent_insight_result_for_user(transcript['user_id'], insight["agent_name"], insight["agent_insight"], insight["reference_url"])
-
-                except Exception as e:
-                    print("Exception in agent.run()...:")
-                    print(e)
-                    traceback.print_exc()
-                    continue
-                insightGenerationEndTime = time.time()
-                print("=== insightGeneration completed in {} seconds ===".format(
-                    round(insightGenerationEndTime - insightGenerationStartTime, 2)))
+                    transcript_to_use = transcript_to_use.replace(hist_item['query'], ' ... ')
+
+                # insights_history = dbHandler.get_agent_insights_history_for_user(transcript['user_id'])
+                # only the newest few, repeats are filtered out after the agents run
+                insights_history = dbHandler.get_recent_nminutes_agent_insights_history_for_user(transcript['user_id'])[:INSIGHTS_HISTORY_IN_PROMPT]
+                insights_history = [{"agent_name": insight["agent_name"], "agent_insight": insight["agent_insight"]} for insight in insights_history]
+                print("insights_history: {}".format(insights_history))
+                # [{'agent_name': 'Statistician', 'agent_insight': "Insight: Brain's processing limit challenges full Wikipedia integration. Neuralink trials show promising BCI advancements."}, ...]
+
+                logger.log(level=logging.DEBUG, msg="Insights history: {}".format(insights_history))
+
+                task = tracker.submit(transcript['user_id'], transcript['timestamp'],
+                                      partial(generate_insights_for_user, dbHandler, insight_deduplicator, transcript['user_id'], transcript_to_use, insights_history))
+                if TOPIC_SHIFT_GATE and tracker.has_work_for(transcript['user_id'], transcript['timestamp']):
+                    topic_shift_detector.mark_run(transcript['user_id'], window_embedding)
+                cycle_tasks.append(task)
+            # users' work runs concurrently, the cycle is reported once all of it is done
+            tracker.record_cycle(cycle_tasks, pLoopStartTime)
         except Exception as e:
             print("Exception in Insight generator...:")
             print(e)
@@ -82,5 +125,6 @@ def proactive_agents_processing_loop():
             pLoopEndTime = time.time()
             # print("=== processing_loop completed in {} seconds overall ===".format(
             #     round(pLoopEndTime - pLoopStartTime, 2)))
+            metrics.log_metrics_if_due("proactive_agents")
 
-        time.sleep(15)
+        await asyncio.sleep(15)
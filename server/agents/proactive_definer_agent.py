@@ -84,12 +84,7 @@ proactive_rare_word_agent_query_parser = PydanticOutputParser(
 )
 
 
-def run_proactive_definer_agent(
-    conversation_context: str, definitions_history: list = []
-):
-    # start up GPT4 connection
-    llm = get_langchain_gpt4()
-
+def make_proactive_definer_agent_prompt(conversation_context: str, definitions_history: list):
     extract_proactive_rare_word_agent_query_prompt = PromptTemplate(
         template=proactive_rare_word_agent_prompt_blueprint,
         input_variables=[
@@ -115,8 +110,27 @@ def run_proactive_definer_agent(
     )
 
     # print("Proactive meta agent query prompt string", proactive_rare_word_agent_query_prompt_string)
+    return proactive_rare_word_agent_query_prompt_string
+
+
+def run_proactive_definer_agent(
+    conversation_context: str, definitions_history: list = []
+):
+    return asyncio.get_event_loop().run_until_complete(
+        run_proactive_definer_agent_async(conversation_context, definitions_history)
+    )
+
+
+async def run_proactive_definer_agent_async(
+    conversation_context: str, definitions_history: list = [], entity_cache=None
+):
+    # start up GPT4 connection
+    llm = get_langchain_gpt4()
+
+    proactive_rare_word_agent_query_prompt_string = make_proactive_definer_agent_prompt(conversation_context, definitions_history)
 
-    response = llm(
+    # async all the way down, so a definer run that gets cancelled or times out stops at its next request
+    response = await llm.apredict_messages(
         [HumanMessage(content=proactive_rare_word_agent_query_prompt_string)]
     )
 
@@ -125,20 +139,26 @@ def run_proactive_definer_agent(
     try:
         res = proactive_rare_word_agent_query_parser.parse(response.content)
         # we still have unknown_entities to search for but we will do them next time
-        res = search_entities(res.entities)
+        res = await search_entities_async(res.entities, entity_cache=entity_cache)
         return res
     except OutputParserException:
         return None
 
 
 def search_entities(entities: list[Entity]):
+    return asyncio.get_event_loop().run_until_complete(search_entities_async(entities))
+
+
+async def search_entities_async(entities: list[Entity], entity_cache=None):
     search_tasks = []
     for entity in entities:
-        search_tasks.append(search_url_for_entity_async(entity.search_keyword))
+        if entity_cache is not None:
+            # entities other users already had searched skip both searches
+            search_tasks.append(entity_cache.get_or_search(entity.search_keyword, search_url_for_entity_async))
+        else:
+            search_tasks.append(search_url_for_entity_async(entity.search_keyword))
 
-    loop = asyncio.get_event_loop()
-    responses = asyncio.gather(*search_tasks)
-    responses = loop.run_until_complete(responses)
+    responses = await asyncio.gather(*search_tasks)
 
     entity_objs = []
     for entity, response in zip(entities, responses):
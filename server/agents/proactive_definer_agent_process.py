@@ -3,30 +3,72 @@ import traceback
 import asyncio
 import uuid
 import logging
+from functools import partial
 
 #custom
 from DatabaseHandler import DatabaseHandler
-from agents.proactive_definer_agent import run_proactive_definer_agent
+from agents.proactive_definer_agent import run_proactive_definer_agent_async
+from agents.proactive_work import ProactiveWorkTracker
+from Modules.EntityCache import EntityCache
+from Modules.DefinerGate import DefinerGate
 from logger_config import logger
+from constants import PROACTIVE_DEFINER_MAX_AGE, PROACTIVE_DEFINER_MAX_CONCURRENT, DEFINER_GATE
+from Modules.LLMScheduler import set_process_llm_priority, PRIORITY_CSE
+import helpers.metrics as metrics
 
 def proactive_definer_processing_loop():
     print("START DEFINER PROCESSING LOOP")
+    set_process_llm_priority(PRIORITY_CSE)
+    asyncio.run(proactive_definer_processing_loop_async())
+    print("EXITING DEFINER PROCESS")
+
+
+async def define_entities_for_user(dbHandler, entity_cache, user_id, text, definition_history):
+    entityDefinerStartTime = time.time()
+    try:
+        # run proactive meta agent, get definition
+        entities = await run_proactive_definer_agent_async(text, definitions_history=definition_history, entity_cache=entity_cache)
+        
+        if entities is not None:
+            entities = [entity for entity in entities if entity is not None]
+
+            #save entities to the DB for the user
+            print("Adding entities in proactive definer process:")
+            print(entities)
+            dbHandler.add_agent_proactive_definition_results_for_user(user_id, entities)
+
+    except Exception as e:
+        print("Exception in entity definer:")
+        print(e)
+        traceback.print_exc()
+        return
+    entityDefinerEndTime = time.time()
+    print("=== definer loop completed in {} seconds ===".format(
+        round(entityDefinerEndTime - entityDefinerStartTime, 2)))
+
+
+async def proactive_definer_processing_loop_async():
     dbHandler = DatabaseHandler(parent_handler=False)
+    # each user's definitions run as their own task, superseded by newer transcript windows and dropped once stale
+    tracker = ProactiveWorkTracker("definer", PROACTIVE_DEFINER_MAX_AGE, 20, max_concurrent=PROACTIVE_DEFINER_MAX_CONCURRENT)
+    entity_cache = EntityCache(dbHandler)
+    definer_gate = DefinerGate() if DEFINER_GATE else None
 
     #wait for some transcripts to load in
-    time.sleep(15)
+    await asyncio.sleep(15)
 
     while True:
         if not dbHandler.ready:
             print("dbHandler not ready")
-            time.sleep(0.1)
+            await asyncio.sleep(0.1)
             continue
         
         #delay between loops
-        time.sleep(10)
+        await asyncio.sleep(10)
 
         try:
             pLoopStartTime = time.time()
+            cycle_tasks = []
             # Check for new transcripts
             print("RUNNING DEFINER LOOP")
             newTranscripts = dbHandler.get_recent_transcripts_from_last_nseconds_for_all_users(n=20)
@@ -35,37 +77,29 @@ def proactive_definer_processing_loop():
                 if len(transcript['text']) < 60: #80: # Around 20-30 words, like on a sentence level
                     print("Transcript too short, skipping...")
                     continue
+
+                if definer_gate is not None:
+                    # in a thread, checking custom data can hash csvs and load the store, which would stall the users' in-flight tasks
+                    should_run, reason, candidates = await asyncio.get_running_loop().run_in_executor(
+                        None, definer_gate.check, transcript['user_id'], transcript['text'])
+                    if not should_run:
+                        print("Nothing rare to define, skipping definer for user {}...".format(transcript['user_id']))
+                        continue
+                    print("Definer gate passed ({}): {}".format(reason, candidates))
+
                 print("Run rare entity definition with... user_id: '{}' ... text: '{}'".format(
                     transcript['user_id'], transcript['text']))
-                entityDefinerStartTime = time.time()
-              
-
-                try:
-                    # definition_history = dbHandler.get_definer_history_for_user(transcript['user_id'])
-                    definition_history = dbHandler.get_recent_nminutes_definer_history_for_user(transcript['user_id'], n_minutes=90)
-
-                    logger.log(level=logging.DEBUG, msg="Definer history: {}".format(
-                        definition_history))
-
-                    # run proactive meta agent, get definition
-                    entities = run_proactive_definer_agent(transcript['text'], definitions_history=definition_history)
-                    
-                    if entities is not None:
-                        entities = [entity for entity in entities if entity is not None]
-
-                        #save entities to the DB for the user
-                        print("Adding entities in proactive definer process:")
-                        print(entities)
-                        dbHandler.add_agent_proactive_definition_results_for_user(transcript['user_id'], entities)
-
-                except Exception as e:
-                    print("Exception in entity definer:")
-                    print(e)
-                    traceback.print_exc()
-                    continue
-                entityDefinerEndTime = time.time()
-                print("=== definer loop completed in {} seconds ===".format(
-                    round(entityDefinerEndTime - entityDefinerStartTime, 2)))
+
+                # definition_history = dbHandler.get_definer_history_for_user(transcript['user_id'])
+                definition_history = dbHandler.get_recent_nminutes_definer_history_for_user(transcript['user_id'], n_minutes=90)
+
+                logger.log(level=logging.DEBUG, msg="Definer history: {}".format(
+                    definition_history))
+
+                cycle_tasks.append(tracker.submit(transcript['user_id'], transcript['timestamp'],
+                                                  partial(define_entities_for_user, dbHandler, entity_cache, transcript['user_id'], transcript['text'], definition_history)))
+            # users' work runs concurrently, the cycle is reported once all of it is done
+            tracker.record_cycle(cycle_tasks, pLoopStartTime)
         except Exception as e:
             print("Exception in entity definer...:")
             print(e)
@@ -75,4 +109,4 @@ def proactive_definer_processing_loop():
             pLoopEndTime = time.time()
             # print("=== processing_loop completed in {} seconds overall ===".format(
             #     round(pLoopEndTime - pLoopStartTime, 2)))
-    print("EXITING DEFINER PROCESS")
+            metrics.log_metrics_if_due("proactive_definer")
@@ -16,6 +16,7 @@ from langchain.output_parsers import PydanticOutputParser
 from langchain.schema import OutputParserException
 from pydantic import BaseModel, Field
 from helpers.time_function_decorator import time_function
+from helpers.prompt_tokens import fit_to_token_budget, log_prompt_tokens
 import asyncio
 
 from Modules.LangchainSetup import *
@@ -57,13 +58,16 @@ def make_expert_agents_prompts():
 
 @time_function()
 def run_proactive_meta_agent_and_experts(conversation_context: str, insights_history: list):
-    #run proactive agent to find out which expert agents we should run
-    proactive_meta_agent_response = run_proactive_meta_agent(conversation_context, insights_history)
+    #sync entry point for scripts, the proactive worker runs the async version for many users at once
+    return asyncio.run(run_proactive_meta_agent_and_experts_async(conversation_context, insights_history))
+
 
-    # print(proactive_meta_agent_response)
+async def run_proactive_meta_agent_and_experts_async(conversation_context: str, insights_history: list):
+    #run proactive agent to find out which expert agents we should run
+    proactive_meta_agent_response = await run_proactive_meta_agent_async(conversation_context, insights_history)
 
     #do nothing else if proactive meta agent didn't specify an agent to run
-    if proactive_meta_agent_response == []:
+    if not proactive_meta_agent_response:
         return []
 
     #parse insights history into a dict of agent_name: [agent_insights] so expert agent won't repeat the same insights
@@ -72,37 +76,28 @@ def run_proactive_meta_agent_and_experts(conversation_context: str, insights_his
         insights_history_dict[insight["agent_name"]].append(
             insight["agent_insight"])
 
-    # print("insights_history_dict", insights_history_dict)
-
     #get the configs of any expert agents we should run
-    experts_to_run_configs = list()
-    for expert_to_run in proactive_meta_agent_response:
-        experts_to_run_configs.append(expert_agent_config_list[expert_to_run])
+    experts_to_run_configs = [expert_agent_config_list[expert_to_run] for expert_to_run in proactive_meta_agent_response]
 
     #run all the agents in parralel
-    loop = asyncio.get_event_loop()
     agents_to_run_tasks = [expert_agent_arun_wrapper(expert_agent_config, conversation_context, insights_history_dict[expert_agent_config["agent_name"]]) for expert_agent_config in experts_to_run_configs]
-    insights_tasks = asyncio.gather(*agents_to_run_tasks)
-    insights = loop.run_until_complete(insights_tasks)
-    return insights
+    return await asyncio.gather(*agents_to_run_tasks)
 
 
-@time_function()
-def run_proactive_meta_agent(conversation_context: str, insights_history: list):
-    #get expert agents descriptions
-    expert_agents_descriptions_prompt = make_expert_agents_prompts()
+class ProactiveMetaAgentQuery(BaseModel):
+    """
+    Proactive meta agent that determines which agents to run
+    """
+    agents_list: list = Field(
+        description="the agents to run given the conversation context")
 
-    #start up GPT4 connection
-    llm = get_langchain_gpt4(temperature=0.2)
 
-    class ProactiveMetaAgentQuery(BaseModel):
-        """
-        Proactive meta agent that determines which agents to run
-        """
-        agents_list: list = Field(
-            description="the agents to run given the conversation context")
+proactive_meta_agent_query_parser = PydanticOutputParser(pydantic_object=ProactiveMetaAgentQuery)
 
-    proactive_meta_agent_query_parser = PydanticOutputParser(pydantic_object=ProactiveMetaAgentQuery)
+
+def make_proactive_meta_agent_prompt(conversation_context: str, insights_history: list):
+    #get expert agents descriptions
+    expert_agents_descriptions_prompt = make_expert_agents_prompts()
 
     extract_proactive_meta_agent_query_prompt = PromptTemplate(
         template=proactive_meta_agent_prompt_blueprint,
@@ -117,17 +112,37 @@ def run_proactive_meta_agent(conversation_context: str, insights_history: list):
         insights_history="None"
 
     proactive_meta_agent_query_prompt_string = extract_proactive_meta_agent_query_prompt.format_prompt(
-            conversation_context=conversation_context, 
+            conversation_context=fit_to_token_budget(conversation_context), 
             expert_agents_descriptions_prompt=expert_agents_descriptions_prompt,
             insights_history=insights_history
         ).to_string()
 
     # print("Proactive meta agent query prompt string", proactive_meta_agent_query_prompt_string)
+    log_prompt_tokens("proactive_meta_agent", proactive_meta_agent_query_prompt_string)
+    return proactive_meta_agent_query_prompt_string
 
-    response = llm([HumanMessage(content=proactive_meta_agent_query_prompt_string)])
+
+def parse_proactive_meta_agent_response(response):
     try:
         expert_agents_to_run_list = proactive_meta_agent_query_parser.parse(response.content).agents_list
         return expert_agents_to_run_list
     except OutputParserException:
         return None
 
+
+@time_function()
+def run_proactive_meta_agent(conversation_context: str, insights_history: list):
+    #start up GPT4 connection
+    llm = get_langchain_gpt4(temperature=0.2)
+
+    response = llm([HumanMessage(content=make_proactive_meta_agent_prompt(conversation_context, insights_history))])
+    return parse_proactive_meta_agent_response(response)
+
+
+@time_function()
+async def run_proactive_meta_agent_async(conversation_context: str, insights_history: list):
+    llm = get_langchain_gpt4(temperature=0.2)
+
+    response = await llm.apredict_messages([HumanMessage(content=make_proactive_meta_agent_prompt(conversation_context, insights_history))])
+    return parse_proactive_meta_agent_response(response)
+
@@ -0,0 +1,135 @@
+import time
+import asyncio
+
+import helpers.metrics as metrics
+from constants import PROACTIVE_SUPERSEDE_OVERLAP
+
+
+USER_COUNT_BUCKETS = (1, 5, 10, 25, 50, 100)
+
+
+def get_user_count_bucket(user_count):
+    for bucket in USER_COUNT_BUCKETS:
+        if user_count <= bucket:
+            return "le_{}".format(bucket)
+    return "gt_{}".format(USER_COUNT_BUCKETS[-1])
+
+
+class ProactiveWorkTracker:
+    """
+    Runs proactive work (definitions, insights) for each user as asyncio tasks with a deadline derived from the
+    timestamp of the newest transcript the work runs on, and dropped once its deadline passes, since it would be shown
+    too late to help. Work for a user is only cancelled when a newer transcript window for that user no longer covers
+    most of the window it's running on. Otherwise it's left to finish and the newest window waits behind it, at most
+    one per user.
+    At most max_concurrent users' work runs at once, the rest waits for a slot (and can go stale waiting).
+    """
+
+    def __init__(self, kind, max_age, window_seconds, max_concurrent=None, supersede_overlap=PROACTIVE_SUPERSEDE_OVERLAP):
+        self.kind = kind
+        self.max_age = max_age
+        self.window_seconds = window_seconds
+        self.supersede_overlap = supersede_overlap
+        self.max_concurrent = max_concurrent
+        self.slots = None # made on first use, in the loop the work runs on
+        self.in_flight = dict() # user_id -> (transcript timestamp, task)
+        self.queued = dict() # user_id -> (transcript timestamp, work) to start once the in-flight work is done
+        self.cycle_recorders = set()
+
+    def get_deadline(self, transcript_timestamp):
+        return transcript_timestamp + self.max_age
+
+    def get_overlap(self, old_timestamp, new_timestamp):
+        # fraction of the old transcript window the new one still covers
+        return max(0.0, self.window_seconds - (new_timestamp - old_timestamp)) / self.window_seconds
+
+    def submit(self, user_id, transcript_timestamp, work):
+        """
+        Starts work() - a coroutine function - for this user's transcript window. Returns its task, or None if the
+        work was shed because it's already stale, the same window is still being worked on, or it was queued behind
+        work on a window it mostly overlaps.
+        """
+        current = self.in_flight.get(user_id)
+        if current is not None:
+            current_timestamp, current_task = current
+            if current_timestamp >= transcript_timestamp:
+                return None
+            if self.get_overlap(current_timestamp, transcript_timestamp) >= self.supersede_overlap:
+                queued = self.queued.get(user_id)
+                if queued is None or queued[0] < transcript_timestamp:
+                    if queued is not None:
+                        metrics.increment("proactive.{}.replaced_in_queue".format(self.kind))
+                    self.queued[user_id] = (transcript_timestamp, work)
+                    metrics.increment("proactive.{}.queued".format(self.kind))
+                return None
+            current_task.cancel()
+            self.queued.pop(user_id, None)
+            metrics.increment("proactive.{}.cancelled".format(self.kind))
+
+        return self.start(user_id, transcript_timestamp, work)
+
+    def start(self, user_id, transcript_timestamp, work):
+        if time.time() >= self.get_deadline(transcript_timestamp):
+            metrics.increment("proactive.{}.shed".format(self.kind))
+            return None
+
+        task = asyncio.ensure_future(self.run(user_id, transcript_timestamp, work))
+        self.in_flight[user_id] = (transcript_timestamp, task)
+        return task
+
+    def has_work_for(self, user_id, transcript_timestamp):
+        # whether work on this window is running or queued for the user
+        return any(entry is not None and entry[0] == transcript_timestamp
+                   for entry in (self.in_flight.get(user_id), self.queued.get(user_id)))
+
+    async def run_in_slot(self, work):
+        if self.max_concurrent is None:
+            return await work()
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_concurrent)
+        async with self.slots:
+            return await work()
+
+    async def run(self, user_id, transcript_timestamp, work):
+        try:
+            result = await asyncio.wait_for(self.run_in_slot(work), timeout=self.get_deadline(transcript_timestamp) - time.time())
+            metrics.increment("proactive.{}.completed".format(self.kind))
+            return result
+        except asyncio.TimeoutError:
+            print("Dropping stale {} work for user {}".format(self.kind, user_id))
+            metrics.increment("proactive.{}.shed".format(self.kind))
+            return None
+        finally:
+            current = self.in_flight.get(user_id)
+            if current is not None and current[1] is asyncio.current_task():
+                del self.in_flight[user_id]
+                # the newest window that arrived while this ran gets its turn
+                queued = self.queued.pop(user_id, None)
+                if queued is not None:
+                    self.start(user_id, queued[0], queued[1])
+
+    def record_cycle(self, tasks, start_time):
+        """
+        Reports how long one scheduling cycle's tasks take to finish against how many users were in it, without waiting.
+        """
+        tasks = [task for task in tasks if task is not None]
+        if not tasks:
+            return
+        recorder = asyncio.ensure_future(self.wait_for_cycle(tasks, start_time))
+        self.cycle_recorders.add(recorder)
+        recorder.add_done_callback(self.cycle_recorders.discard)
+
+    async def wait_for_cycle(self, tasks, start_time):
+        await asyncio.gather(*tasks, return_exceptions=True)
+        cycle_time = time.time() - start_time
+        metrics.observe("proactive.{}.cycle_time".format(self.kind), cycle_time)
+        metrics.observe("proactive.{}.cycle_users".format(self.kind), len(tasks))
+        metrics.observe("proactive.{}.cycle_time.users_{}".format(self.kind, get_user_count_bucket(len(tasks))), cycle_time)
+        print("=== {} cycle for {} users completed in {} seconds ===".format(self.kind, len(tasks), round(cycle_time, 2)))
+
+    async def cancel_all(self):
+        self.queued.clear()
+        tasks = [task for _, task in self.in_flight.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
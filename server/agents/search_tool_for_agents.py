@@ -7,10 +7,14 @@ from server_config import serper_api_key
 from Modules.Summarizer import Summarizer
 from langchain.agents.tools import Tool
 from helpers.time_function_decorator import time_function
+from Modules.RateLimiter import rate_limiter
 import asyncio
 import aiohttp
 
 
+# when set, searches, scrapes and url checks are handed to this instead of the network, e.g. a helpers.simulator.Simulator
+search_transport = None
+
 # ban some sites that we can never scrape
 banned_sites = ["calendar.google.com", "researchgate.net"]
 # custom search tool, we copied the serper integration on langchain but we prefer all the data to be displayed in one json message
@@ -68,14 +72,21 @@ def scrape_page(url: str):
 def serper_search(
     search_term: str, search_type: str = "search", **kwargs: Any
 ) -> dict:
-    headers = {
-        "X-API-KEY": serper_api_key or "",
-        "Content-Type": "application/json",
-    }
     params = {
         "q": search_term,
         **{key: value for key, value in kwargs.items() if value is not None},
     }
+    if search_transport is not None:
+        return search_transport.serper_search(search_type, params)
+    return request_serper_search(search_type, params)
+
+
+def request_serper_search(search_type: str, params: dict) -> dict:
+    headers = {
+        "X-API-KEY": serper_api_key or "",
+        "Content-Type": "application/json",
+    }
+    rate_limiter.acquire("serper:search")
     response = requests.post(
         f"https://google.serper.dev/{search_type}", headers=headers, params=params
     )
@@ -108,21 +119,26 @@ def parse_snippets(results: dict) -> List[str]:
         for attribute, value in kg.get("attributes", {}).items():
             snippets.append(f"{title} {attribute}: {value}.")
 
-    for result in results[result_key_for_type[search_type]][:k]:
-        if "snippet" in result:
-            page = scrape_page(result["link"])
-            if ('title' not in result) or (result['title'] is None):
-                result['title'] = ""
-            if page is None:
-                snippets.append(
-                    f"Title: {result['title']}\nPossible answers: {result['snippet']}\n")
-            else:
-                summarized_page = summarizer.summarize_description_with_bert(
-                    page, num_sentences=num_sentences)
-                if len(summarized_page) == 0:
-                    summarized_page = "None"
-                snippets.append(
-                    f"Title: {result['title']}\nSource:{result['link']}\nSnippet: {result['snippet']}\nSummarized Page: {summarized_page}")
+    snippet_results = [result for result in results[result_key_for_type[search_type]][:k] if "snippet" in result]
+    pages = [scrape_page(result["link"]) for result in snippet_results]
+
+    # summarize every scraped page with one batched embedding pass
+    scraped_pages = [page for page in pages if page is not None]
+    summarized_pages = iter(summarizer.summarize_descriptions_with_bert(
+        scraped_pages, num_sentences=num_sentences) if scraped_pages else [])
+
+    for result, page in zip(snippet_results, pages):
+        if ('title' not in result) or (result['title'] is None):
+            result['title'] = ""
+        if page is None:
+            snippets.append(
+                f"Title: {result['title']}\nPossible answers: {result['snippet']}\n")
+        else:
+            summarized_page = next(summarized_pages)
+            if len(summarized_page) == 0:
+                summarized_page = "None"
+            snippets.append(
+                f"Title: {result['title']}\nSource:{result['link']}\nSnippet: {result['snippet']}\nSummarized Page: {summarized_page}")
 
     if len(snippets) == 0:
         return ["No good Google Search Result was found"]
@@ -166,44 +182,58 @@ async def scrape_page_async(url: str, summarize_page = False, num_sentences = 3)
         return None
     else:
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.84 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
-                'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3',
-                'Accept-Encoding': 'none',
-                'Accept-Language': 'en-US,en;q=0.8',
-                'Connection': 'keep-alive',
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, timeout=30) as response:
-                    response.raise_for_status()
-                    content = await response.text()
-
-                    soup = BeautifulSoup(content, 'html.parser')
-                    text = " ".join([t.get_text() for t in soup.find_all(
-                        ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'])])
-                    text = text.replace('|', '')
-
-                    if summarize_page:
-                        return summarizer.summarize_description_with_bert(text, num_sentences=num_sentences)
-                    return text
+            if search_transport is not None:
+                text = await search_transport.scrape_page_async(url)
+            else:
+                text = await request_page_text_async(url)
+
+            if summarize_page:
+                return summarizer.summarize_description_with_bert(text, num_sentences=num_sentences)
+            return text
         except Exception as e:
             print(f"Failed to fetch {url}. Error: {e}")
             return None
 
 
+async def request_page_text_async(url: str) -> str:
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.84 Safari/537.36',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
+        'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3',
+        'Accept-Encoding': 'none',
+        'Accept-Language': 'en-US,en;q=0.8',
+        'Connection': 'keep-alive',
+    }
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url, headers=headers, timeout=30) as response:
+            response.raise_for_status()
+            content = await response.text()
+
+            soup = BeautifulSoup(content, 'html.parser')
+            text = " ".join([t.get_text() for t in soup.find_all(
+                ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'])])
+            return text.replace('|', '')
+
+
 @time_function()
 async def serper_search_async(
     search_term: str, search_type: str = "search", **kwargs: Any
 ) -> dict:
-    headers = {
-        "X-API-KEY": serper_api_key or "",
-        "Content-Type": "application/json",
-    }
     params = {
         "q": search_term,
         **{key: value for key, value in kwargs.items() if value is not None},
     }
+    if search_transport is not None:
+        return await search_transport.serper_search_async(search_type, params)
+    return await request_serper_search_async(search_type, params)
+
+
+async def request_serper_search_async(search_type: str, params: dict) -> dict:
+    headers = {
+        "X-API-KEY": serper_api_key or "",
+        "Content-Type": "application/json",
+    }
+    await rate_limiter.acquire_async("serper:search")
     async with aiohttp.ClientSession() as session:
         async with session.post(f"https://google.serper.dev/{search_type}", headers=headers, json=params) as response:
             response.raise_for_status()
@@ -238,9 +268,19 @@ async def parse_snippets_async(results: dict, scrape_pages: bool = False, summar
     if scrape_pages:
         tasks = []
         for result in results[result_key_for_type[search_type]][:k]:
-            task = asyncio.create_task(scrape_page_async(result["link"], summarize_page=summarize_pages, num_sentences=num_sentences))
+            task = asyncio.create_task(scrape_page_async(result["link"]))
             tasks.append(task)
         summarized_pages = await asyncio.gather(*tasks)
+
+        # summarize all the scraped pages with one batched embedding pass, off the event loop
+        if summarize_pages:
+            scraped_idxs = [i for i, page in enumerate(summarized_pages) if page]
+            if scraped_idxs:
+                loop = asyncio.get_running_loop()
+                page_summaries = await loop.run_in_executor(
+                    None, summarizer.summarize_descriptions_with_bert, [summarized_pages[i] for i in scraped_idxs], num_sentences)
+                for i, page_summary in zip(scraped_idxs, page_summaries):
+                    summarized_pages[i] = page_summary
         for i, page in enumerate(summarized_pages):
             result = results[result_key_for_type[search_type]][i]
             if page:
@@ -371,6 +411,12 @@ async def asearch_google_knowledge_graph(
 import requests
 
 def can_embed_url(url: str):
+    if search_transport is not None:
+        return search_transport.can_embed_url(url)
+    return request_can_embed_url(url)
+
+
+def request_can_embed_url(url: str):
     response = requests.head(url)
 
     # Check the headers for 'X-Frame-Options' or 'Content-Security-Policy'
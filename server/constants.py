@@ -1,13 +1,87 @@
 CUSTOM_USER_DATA_PATH = "./custom_data"
 IMAGE_PATH = "images/cse"
 SUMMARIZE_CUSTOM_DATA = True
+EMBEDDING_BATCH_SIZE = 256 # custom data rows summarized and upserted into the embeddings index at a time
+SUMMARIZE_CUSTOM_DATA_WORKERS = 4 # processes summarizing custom data in parallel during ingestion
+CUSTOM_DATA_CSV_CHUNK_SIZE = 2000 # custom data csv rows read into memory at a time during ingestion
+CUSTOM_DATA_RELOAD_CHECK_INTERVAL = 10 # seconds between checks for changed custom data files of a loaded user
+CUSTOM_DATA_UPLOADS_PATH = "./custom_data_uploads" # uploaded csvs wait here until their ingestion job runs
+CUSTOM_DATA_JOB_PROGRESS_INTERVAL = 1 # minimum seconds between progress updates written to an ingestion job
 USE_GPU_FOR_INFERENCING = True
 DEFINE_RARE_WORDS = False
 LLM_FILTER_THRESHOLD = 6
 RELEVANCE_FILTER_TIME = 120 # number of seconds the relevance filter looks back
+RELEVANCE_FILTER_DESCRIPTION_CHARS = 300 # characters of an unsummarized entity description the relevance filter scores on
+MIRROR_RECENTLY_SHOWN_TERMS = True # mirror the relevance filter's recently shown terms to the database so they survive restarts
+RELEVANCE_SCORE_CACHE_MAX_SIZE = 4096 # (user, entity) relevance scores kept in memory
+RELEVANCE_SCORE_CACHE_TTL = 10 * 60 # seconds a relevance score can be reused at most, even if the context hasn't drifted
+RELEVANCE_SCORE_CONTEXT_SIMILARITY = 0.8 # cosine similarity to the scoring context below which a cached relevance score is stale
+SUMMARY_CACHE_MAX_SIZE = 2048 # entity summaries kept in each process' in-memory cache
+SUMMARY_CACHE_TTL = 60 * 60 # seconds a cached entity summary stays valid, in memory and in the database
+ENTITY_CACHE_MAX_SIZE = 4096 # searched entities kept in each process' in-memory cache
+ENTITY_CACHE_TTL = 7 * 24 * 60 * 60 # seconds a searched entity's url and image are reused, in memory and in the database
+ENTITY_CACHE_NOT_FOUND_TTL = 60 * 60 # seconds before an entity the searches found nothing for is searched again
+SUMMARY_CACHE_CONTEXT_WORDS = 5 # rarest context words that make up the context part of a summary cache key
 
+GPT_35_MODEL = "gpt-3.5-turbo"
 GPT_4_MODEL = "gpt-4-1106-preview"
 GPT_4_MAX_TOKENS = 2048
 GPT_TEMPERATURE = 0.5
 
+LLM_REQUEST_TIMEOUT = 60 # seconds before an LLM request is abandoned and retried
+LLM_MAX_RETRIES = 4 # retries of an LLM request that got rate limited, a 5xx, or timed out
+LLM_RETRY_BASE_DELAY = 1 # seconds, doubled on every retry and jittered
+LLM_RETRY_MAX_DELAY = 20 # seconds, the most we ever wait between retries
+LLM_MAX_CONCURRENT_REQUESTS_PER_MODEL = 8 # in-flight requests per model in each process
+LLM_CONNECTION_POOL_SIZE = 16 # keep-alive connections to the LLM provider in each process
+
+# (requests per minute, tokens per minute) shared by all server processes, keyed by "provider:model". None means unlimited
+RATE_LIMITS = {
+    "openai:gpt-3.5-turbo": (3500, 160000),
+    "openai:gpt-4-1106-preview": (500, 150000),
+    "azure:gpt-3.5-turbo": (720, 120000),
+    "azure:gpt-4-1106-preview": (480, 80000),
+    "serper:search": (300, None),
+}
+RATE_LIMITER_STATE_PATH = "./rate_limiter_state.json" # file the processes share their rate limit buckets through
+RATE_LIMITER_MAX_SLEEP = 1 # seconds a throttled caller sleeps before checking the buckets again
+
+# LLM work classes are explicit > cse (cse, definer, relevance filter, summarizer) > proactive
+LLM_PRIORITY_MAX_DEFER = {"cse": 3, "proactive": 30} # most seconds a class holds off its LLM requests while explicit work runs
+LLM_PRIORITY_BUCKET_RESERVE = {"cse": 0.1, "proactive": 0.3} # fraction of each rate limit bucket a class leaves for the classes above it
+LLM_EXPLICIT_LEASE_TTL = 120 # seconds after which explicit work that never finished stops holding back other classes
+LLM_PRIORITY_POLL_INTERVAL = 0.25 # seconds between checks for whether explicit work is done
+
+EXPLICIT_MAX_CONCURRENT_QUERIES = 8 # explicit agent runs (final and speculative) the explicit worker runs at once
+EXPLICIT_STREAM_UPDATE_INTERVAL = 0.3 # seconds between updates of a partial explicit answer while it's streamed
+SPECULATIVE_EXPLICIT_QUERIES = True # start answering an explicit query before the wearer has finished asking it
+EXPLICIT_SPECULATION_MIN_WORDS = 3 # words after the wake word before a speculative answer is started
+EXPLICIT_SPECULATION_MIN_RESTART_INTERVAL = 1.5 # seconds between restarts of a speculative answer as the query grows
+
+PROACTIVE_DEFINER_MAX_AGE = 30 # seconds after the newest transcript it ran on that a definition is still worth showing
+PROACTIVE_AGENTS_MAX_AGE = 90 # seconds after the newest transcript it ran on that a proactive insight is still worth showing
+PROACTIVE_SUPERSEDE_OVERLAP = 0.5 # fraction of a user's in-flight transcript window a newer one has to still cover for the in-flight work to be left to finish
+ROLLING_CONTEXT_VERBATIM_SECONDS = 90 # newest seconds of a user's transcript that agent prompts get word for word
+ROLLING_CONTEXT_LOOKBACK_SECONDS = 15 * 60 # seconds of older transcript that the rolling summary covers
+ROLLING_CONTEXT_SUMMARY_SENTENCES = 8 # sentences kept in a user's rolling summary of older transcript
+PROMPT_TRANSCRIPT_TOKEN_BUDGET = 1000 # tokens of conversation context an agent prompt gets at most
+
+INSIGHT_DUPLICATE_SIMILARITY = 0.85 # cosine similarity to a recent insight at which a new proactive insight is dropped as a repeat
+INSIGHT_DUPLICATE_WINDOW_MINUTES = 30 # minutes of a user's insights a new one is checked against
+INSIGHTS_HISTORY_IN_PROMPT = 3 # newest insights still listed in agent prompts, 0 for none
+
+TOPIC_SHIFT_GATE = True # only run the proactive meta agent for a user once their conversation has drifted from the last run
+TOPIC_SHIFT_THRESHOLD = 0.15 # drift (1 - cosine similarity of MiniLM window embeddings) since the last run that counts as a new topic
+TOPIC_SHIFT_MIN_INTERVAL = 30 # seconds between proactive meta agent runs for a user at least, however much the topic drifts
+TOPIC_SHIFT_MAX_INTERVAL = 180 # seconds between proactive meta agent runs for a user at most, even if the topic hasn't drifted
+TOPIC_SHIFT_WINDOW_WORDS = 150 # newest transcript words that are compared against the last run's
+TOPIC_SHIFT_CHUNK_WORDS = 50 # words per embedded chunk of the window, MiniLM truncates long inputs
+DEFINER_GATE = True # only send a transcript window to the definer LLM when it has a rare word, an unusual proper noun or a custom data entity in it
+DEFINER_GATE_RARE_WORD_SCORE = 0.45 # word_frequency rarity (0 common, 1 rare) at which a lowercase word is worth defining
+DEFINER_GATE_PROPER_NOUN_SCORE = 0.2 # lower rarity that's enough for capitalized words mid-sentence and acronyms
+DEFINER_GATE_MIN_WORD_LENGTH = 4 # shorter lowercase words are never counted as rare, they're mostly transcription noise
+PROACTIVE_DEFINER_MAX_CONCURRENT = 16 # users the definer worker defines entities for at once
+PROACTIVE_AGENTS_MAX_CONCURRENT = 8 # users the proactive agents worker generates insights for at once
+
 TIME_EVERYTHING = False
+METRICS_LOG_INTERVAL = 60 # seconds between metrics snapshots written to the log by each process
@@ -0,0 +1,26 @@
+import os
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(lock_path, shared=False):
+    """
+    Holds an flock on lock_path (created if missing) for the enclosed code, so processes on the machine that
+    write the same files take turns. Not reentrant - don't take the same lock again inside it.
+    """
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def make_temp_path(final_path, suffix=".tmp"):
+    # a temp file of its own next to final_path, so writers never share one and os.replace stays on one filesystem
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(final_path) or ".", prefix=os.path.basename(final_path) + ".", suffix=suffix)
+    os.close(fd)
+    return tmp_path
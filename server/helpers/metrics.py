@@ -0,0 +1,57 @@
+# in-process counters and timings, so each worker can report cache hit rates, LLM calls saved, queue waits, etc.
+# every process keeps its own, and logs a snapshot every METRICS_LOG_INTERVAL seconds from its main loop
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+from logger_config import logger
+from constants import METRICS_LOG_INTERVAL
+
+metrics_lock = threading.Lock()
+counters = defaultdict(int)
+timings = dict()
+last_log_time = time.time()
+
+
+def increment(name, amount=1):
+    with metrics_lock:
+        counters[name] += amount
+
+
+def observe(name, value):
+    # keeps count, total and max of a measured value, e.g. a latency in seconds
+    with metrics_lock:
+        timing = timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        timing["count"] += 1
+        timing["total"] += value
+        timing["max"] = max(timing["max"], value)
+
+
+def get_counter(name):
+    with metrics_lock:
+        return counters.get(name, 0)
+
+
+def get_hit_rate(name):
+    hits = get_counter(name + ".hit")
+    misses = get_counter(name + ".miss")
+    return hits / (hits + misses) if (hits + misses) else None
+
+
+def snapshot():
+    with metrics_lock:
+        timings_snapshot = {name: {"count": timing["count"],
+                                   "mean": round(timing["total"] / timing["count"], 4),
+                                   "max": round(timing["max"], 4)}
+                            for name, timing in timings.items()}
+        return {"counters": dict(counters), "timings": timings_snapshot}
+
+
+def log_metrics_if_due(process_name="", force=False):
+    global last_log_time
+    if not force and (time.time() - last_log_time) < METRICS_LOG_INTERVAL:
+        return
+    last_log_time = time.time()
+    logger.info("Metrics for {} (pid {}): {}".format(process_name, os.getpid(), json.dumps(snapshot())))
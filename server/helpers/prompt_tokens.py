@@ -0,0 +1,23 @@
+# token estimates and budgets for the prompts agents are sent
+from constants import PROMPT_TRANSCRIPT_TOKEN_BUDGET
+from logger_config import logger
+import helpers.metrics as metrics
+
+
+def count_tokens(text):
+    # same ~4 characters per token estimate the rate limiter uses
+    return len(text) // 4
+
+
+def fit_to_token_budget(text, token_budget=PROMPT_TRANSCRIPT_TOKEN_BUDGET):
+    # keeps the newest part of the text that fits, the end of a transcript is what an agent needs most
+    if count_tokens(text) <= token_budget:
+        return text
+    return "..." + text[-token_budget * 4:].split(" ", 1)[-1]
+
+
+def log_prompt_tokens(prompt_name, prompt):
+    tokens = count_tokens(prompt)
+    metrics.observe("prompt_tokens." + prompt_name, tokens)
+    logger.info("{} prompt: {} tokens".format(prompt_name, tokens))
+    return tokens
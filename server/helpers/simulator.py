@@ -0,0 +1,288 @@
+# local stand-in for the LLM provider, Serper search, page scraping and Wolfram Alpha, so the pipeline can be
+# benchmarked without network access or api keys
+#   record:    calls the real services and saves every response (and how long it took) to a cassette file
+#   replay:    answers every request from the cassette, deterministically - a request that wasn't recorded is an error
+#   synthetic: makes up well-formed responses after a random delay drawn from a per-service latency distribution
+import re
+import ast
+import json
+import math
+import time
+import random
+import asyncio
+import threading
+from hashlib import sha256
+
+import Modules.LLMGateway as llm_gateway
+import agents.search_tool_for_agents as search_tool
+import agents.Tools.WolframAlphaTool as wolfram_tool
+
+SIMULATOR_MODES = ("record", "replay", "synthetic")
+
+
+class LatencyDistribution:
+    """
+    Log-normal latency, set by its median and 95th percentile in seconds, like real api latencies with their long tail.
+    """
+
+    def __init__(self, median, p95):
+        self.mu = math.log(median)
+        self.sigma = max(math.log(p95 / median), 0.0) / 1.645
+
+    def sample(self, rng):
+        return rng.lognormvariate(self.mu, self.sigma)
+
+
+DEFAULT_LATENCIES = {
+    "llm": LatencyDistribution(0.8, 2.0),
+    "llm:" + llm_gateway.GPT_4_MODEL: LatencyDistribution(3.0, 8.0),
+    "search": LatencyDistribution(0.5, 1.2),
+    "scrape": LatencyDistribution(0.8, 2.5),
+    "embed_check": LatencyDistribution(0.2, 0.6),
+    "wolfram": LatencyDistribution(1.0, 2.5),
+}
+
+
+class Cassette:
+    """
+    Recorded responses keyed by a hash of the request. Identical requests are replayed in the order they were recorded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.replay_positions = dict()
+        try:
+            with open(path) as cassette_file:
+                self.entries = json.load(cassette_file)
+        except FileNotFoundError:
+            self.entries = dict()
+
+    @staticmethod
+    def get_key(kind, request):
+        return sha256(json.dumps([kind, request], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def add(self, kind, request, response, latency):
+        with self.lock:
+            self.entries.setdefault(self.get_key(kind, request), []).append({"response": response, "latency": latency})
+
+    def get(self, kind, request):
+        key = self.get_key(kind, request)
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise KeyError("No recorded {} response for request: {}".format(kind, json.dumps(request, default=str)[:200]))
+            position = self.replay_positions.get(key, 0)
+            self.replay_positions[key] = position + 1
+            # once a key's recordings run out, keep replaying the last one
+            return entries[min(position, len(entries) - 1)]
+
+    def save(self):
+        with self.lock:
+            with open(self.path, "w") as cassette_file:
+                json.dump(self.entries, cassette_file)
+
+
+### SYNTHETIC RESPONSES ###
+
+def get_between(text, start, end):
+    start_idx = text.find(start)
+    end_idx = text.find(end, start_idx + len(start))
+    if start_idx == -1 or end_idx == -1:
+        return ""
+    return text[start_idx + len(start):end_idx]
+
+
+def synthesize_llm_content(prompt, rng):
+    # well-formed answers for the prompts the server sends, so every stage after the LLM call runs like it would live
+    if "Rare Entities (REs)" in prompt:
+        transcript = get_between(prompt, "<Transcript start>", "<Transcript end>")
+        candidates = sorted(set(re.findall(r"\b[A-Z][a-z]{5,}\b", transcript)))
+        names = rng.sample(candidates, min(len(candidates), rng.randint(0, 2)))
+        return json.dumps({"entities": [{"name": name, "definition": "Synthetic definition of " + name, "search_keyword": name} for name in names]})
+
+    if "output a list of the expert agents" in prompt:
+        agent_names = re.findall(r"- Name: (.+)", prompt)
+        return json.dumps({"agents_list": rng.sample(agent_names, min(len(agent_names), rng.randint(0, 2)))})
+
+    if "as a JSON object keyed by entity id" in prompt:
+        entity_ids = json.loads(get_between(prompt, "```\n", "\n```") or "{}").keys()
+        return json.dumps({entity_id: "Synthetic summary of entity " + entity_id for entity_id in entity_ids})
+
+    if "Entity Scores" in prompt:
+        try:
+            entities = ast.literal_eval(get_between(prompt, "<Entity>", "</Entity>"))
+        except (ValueError, SyntaxError):
+            entities = dict()
+        return json.dumps({name: rng.randint(1, 10) for name in entities})
+
+    if "Final Answer: the final answer" in prompt:
+        # langchain chat zero shot agents, answered right away
+        return "Thought: I now know the final answer\nFinal Answer: Synthetic answer."
+
+    if "action_input" in prompt:
+        # langchain structured chat agents, answered right away
+        if "agent_insight" in prompt:
+            action_input = {"agent_insight": "Insight: synthetic insight number {}".format(rng.randint(0, 10**6)), "reference_url": ""}
+        else:
+            action_input = "Synthetic answer."
+        return "```json\n" + json.dumps({"action": "Final Answer", "action_input": action_input}) + "\n```"
+
+    return "Synthetic response."
+
+
+def synthesize_chat_completion(body, rng):
+    prompt = "\n".join(message.get("content") or "" for message in body["messages"])
+    content = synthesize_llm_content(prompt, rng)
+    prompt_tokens, completion_tokens = len(prompt) // 4, len(content) // 4
+    return {
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def synthesize_serper_search(search_type, params, rng):
+    query = params.get("q", "")
+    slug = re.sub(r"[^a-z0-9]+", "_", query.lower()).strip("_") or "result"
+    if search_type == "images":
+        return {"images": [{"title": query, "imageUrl": "https://example.com/images/{}_{}.jpg".format(slug, i)} for i in range(3)]}
+    return {
+        "knowledgeGraph": {"title": query, "type": "Thing", "description": "Synthetic description of " + query + ".",
+                           "descriptionSource": "Wikipedia", "descriptionLink": "https://en.wikipedia.org/wiki/" + slug},
+        "organic": [{"title": "{} - result {}".format(query, i), "link": "https://example.com/{}/{}".format(slug, i),
+                     "snippet": "Synthetic snippet {} about {}.".format(i, query)} for i in range(3)],
+    }
+
+
+def synthesize_page_text(url, rng):
+    words = re.findall(r"[a-z]+", url.lower())
+    sentences = ["This synthetic page about {} has sentence number {}.".format(" ".join(words[-2:]), i) for i in range(rng.randint(5, 15))]
+    return " ".join(sentences)
+
+
+class Simulator:
+    """
+    Stand-in for every outbound service call. install() hands the LLM gateway, the search tool and the Wolfram Alpha tool
+    to it, uninstall() gives them back to the real services (and saves the cassette when recording).
+    """
+
+    def __init__(self, mode, cassette_path=None, latencies=None, seed=0, replay_latency=False):
+        if mode not in SIMULATOR_MODES:
+            raise ValueError("Simulator mode must be one of {}".format(SIMULATOR_MODES))
+        if mode != "synthetic" and cassette_path is None:
+            raise ValueError("Simulator needs a cassette_path to {}".format(mode))
+        self.mode = mode
+        self.cassette = Cassette(cassette_path) if cassette_path is not None else None
+        self.latencies = dict(DEFAULT_LATENCIES, **(latencies or dict()))
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        # replay responses instantly, or after as long as they took when recorded
+        self.replay_latency = replay_latency
+
+    def install(self):
+        llm_gateway.set_llm_transport(self)
+        search_tool.search_transport = self
+        wolfram_tool.wolfram_transport = self
+
+    def uninstall(self):
+        llm_gateway.set_llm_transport(None)
+        search_tool.search_transport = None
+        wolfram_tool.wolfram_transport = None
+        if self.mode == "record":
+            self.cassette.save()
+
+    def get_latency(self, kind):
+        distribution = self.latencies.get(kind) or self.latencies[kind.split(":")[0]]
+        with self.rng_lock:
+            return distribution.sample(self.rng)
+
+    def synthesize(self, synthesize_response, *args):
+        with self.rng_lock:
+            return synthesize_response(*args, self.rng)
+
+    def respond(self, kind, request, send, synthesize):
+        if self.mode == "replay":
+            entry = self.cassette.get(kind, request)
+            if self.replay_latency:
+                time.sleep(entry["latency"])
+            return entry["response"]
+        if self.mode == "record":
+            start_time = time.time()
+            response = send()
+            self.cassette.add(kind, request, response, time.time() - start_time)
+            return response
+        time.sleep(self.get_latency(kind))
+        return synthesize()
+
+    async def respond_async(self, kind, request, send, synthesize):
+        if self.mode == "replay":
+            entry = self.cassette.get(kind, request)
+            if self.replay_latency:
+                await asyncio.sleep(entry["latency"])
+            return entry["response"]
+        if self.mode == "record":
+            start_time = time.time()
+            response = await send()
+            self.cassette.add(kind, request, response, time.time() - start_time)
+            return response
+        await asyncio.sleep(self.get_latency(kind))
+        return synthesize()
+
+    ### LLM GATEWAY ###
+
+    def post_chat_completion(self, url, headers, body, model):
+        if self.mode == "record":
+            # only successful responses are recorded, failures go back to the gateway's retries as they are
+            start_time = time.time()
+            status, result, retry_after = llm_gateway.post_chat_completion(url, headers, body, model)
+            if status == 200:
+                self.cassette.add("llm:" + model, {"model": model, "body": body}, result, time.time() - start_time)
+            return status, result, retry_after
+        response = self.respond("llm:" + model, {"model": model, "body": body}, None,
+                                lambda: self.synthesize(synthesize_chat_completion, body))
+        return 200, response, None
+
+    async def apost_chat_completion(self, url, headers, body, model):
+        if self.mode == "record":
+            start_time = time.time()
+            status, result, retry_after = await llm_gateway.apost_chat_completion(url, headers, body, model)
+            if status == 200:
+                self.cassette.add("llm:" + model, {"model": model, "body": body}, result, time.time() - start_time)
+            return status, result, retry_after
+        response = await self.respond_async("llm:" + model, {"model": model, "body": body}, None,
+                                            lambda: self.synthesize(synthesize_chat_completion, body))
+        return 200, response, None
+
+    ### SEARCH TOOL ###
+
+    def serper_search(self, search_type, params):
+        return self.respond("search", {"search_type": search_type, "params": params},
+                            lambda: search_tool.request_serper_search(search_type, params),
+                            lambda: self.synthesize(synthesize_serper_search, search_type, params))
+
+    async def serper_search_async(self, search_type, params):
+        return await self.respond_async("search", {"search_type": search_type, "params": params},
+                                        lambda: search_tool.request_serper_search_async(search_type, params),
+                                        lambda: self.synthesize(synthesize_serper_search, search_type, params))
+
+    async def scrape_page_async(self, url):
+        return await self.respond_async("scrape", {"url": url},
+                                        lambda: search_tool.request_page_text_async(url),
+                                        lambda: self.synthesize(synthesize_page_text, url))
+
+    def can_embed_url(self, url):
+        return self.respond("embed_check", {"url": url},
+                            lambda: search_tool.request_can_embed_url(url),
+                            lambda: True)
+
+    ### WOLFRAM ALPHA ###
+
+    def wolfram_query(self, query, request_answer):
+        return self.respond("wolfram", {"query": query},
+                            lambda: request_answer(query),
+                            lambda: "42")
+
+    async def wolfram_query_async(self, query, arequest_answer):
+        return await self.respond_async("wolfram", {"query": query},
+                                        lambda: arequest_answer(query),
+                                        lambda: "42")
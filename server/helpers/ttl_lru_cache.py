@@ -0,0 +1,47 @@
+import time
+import threading
+from collections import OrderedDict
+
+import helpers.metrics as metrics
+
+
+class TTLLRUCache:
+    """
+    In-process LRU cache whose entries also expire ttl seconds after they were set.
+    If given a name, hits and misses are counted in helpers.metrics as "<name>.hit" and "<name>.miss".
+    """
+
+    def __init__(self, max_size, ttl, name=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[1] < time.time():
+                del self.items[key]
+                item = None
+            if item is not None:
+                self.items.move_to_end(key)
+
+        if self.name is not None:
+            metrics.increment(self.name + (".hit" if item is not None else ".miss"))
+        return item[0] if item is not None else default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            self.items[key] = (value, expires_at)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def __len__(self):
+        return len(self.items)
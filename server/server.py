@@ -7,6 +7,7 @@ from pathlib import Path
 import json
 import time
 import traceback
+import os
 import pandas as pd
 
 # multiprocessing
@@ -14,14 +15,14 @@ import multiprocessing
 import logging
 import logging.handlers
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # CORS
 import aiohttp_cors
-from aiohttp import web, web_exceptions
 
 #Convoscope
 from server_config import server_port
-from constants import USE_GPU_FOR_INFERENCING, IMAGE_PATH
+from constants import USE_GPU_FOR_INFERENCING, IMAGE_PATH, CUSTOM_DATA_UPLOADS_PATH, CUSTOM_DATA_JOB_PROGRESS_INTERVAL, INSIGHTS_HISTORY_IN_PROMPT
 from ContextualSearchEngine import ContextualSearchEngine
 from DatabaseHandler import DatabaseHandler
 from agents.proactive_agents_process import proactive_agents_processing_loop
@@ -30,10 +31,16 @@ from agents.explicit_agent_process import explicit_agent_processing_loop, call_e
 from agents.proactive_definer_agent_process import proactive_definer_processing_loop
 import agents.wake_words
 from Modules.RelevanceFilter import RelevanceFilter
+from Modules.update_embeddings import ingest_custom_data_csv
+from Modules.LLMScheduler import llm_priority, set_process_llm_priority, PRIORITY_CSE, PRIORITY_PROACTIVE
+from Modules.RollingContext import get_rolling_context_for_user
+from Modules.InsightDeduplicator import InsightDeduplicator
+import helpers.metrics as metrics
 
 global agent_executor
 global db_handler
 global relevance_filter
+global insight_deduplicator
 global app
 
 #handle new transcripts coming in
@@ -149,6 +156,7 @@ async def button_handler(request):
 # run cse/definer tools for subscribed users in background every n ms if there is fresh data to run on
 def cse_loop():
     print("START CSE PROCESSING LOOP")
+    set_process_llm_priority(PRIORITY_CSE)
 
     # setup things we need for processing
     db_handler = DatabaseHandler(parent_handler=False)
@@ -178,29 +186,44 @@ def cse_loop():
                 print("Run CSE with... user_id: '{}' ... text: '{}'".format(
                     transcript['user_id'], transcript['text']))
                 cse_start_time = time.time()
-
-                cse_responses = cse.custom_data_proactive_search(
-                    transcript['user_id'], transcript['text'])
-
-                cse_end_time = time.time()
-                # print("=== CSE completed in {} seconds ===".format(
-                #     round(cse_end_time - cse_start_time, 2)))
-
-                #filter responses with relevance filter, then save CSE results to the database
-                cse_responses_filtered = list()
-                if cse_responses:
-                    cse_responses_filtered = relevance_filter.should_display_result_based_on_context(
-                        transcript["user_id"], cse_responses, transcript["text"]
-                    )
-
-                    final_cse_responses = [cse_response for cse_response in cse_responses if cse_response["name"] in cse_responses_filtered]
+                user_id = transcript['user_id']
+
+                # match stage
+                matched_entities = list(cse.match_custom_data_entities(user_id, transcript['text']).values())
+                if not matched_entities:
+                    continue
+                metrics.increment("cse.stage.matched", len(matched_entities))
+                entities_needing_summary = sum(cse.does_entity_need_summary(entity) for entity in matched_entities)
+
+                # dedupe stage, drop terms the user was just shown and banned terms
+                candidate_entities = relevance_filter.remove_recently_shown_and_banned_terms(user_id, matched_entities)
+                metrics.increment("cse.stage.deduped_out", len(matched_entities) - len(candidate_entities))
+
+                # relevance stage, scored on the raw descriptions so we don't summarize entities we'd throw away
+                relevant_entities = list()
+                if candidate_entities:
+                    relevant_names = relevance_filter.score_relevance(user_id, candidate_entities, transcript["text"])
+                    relevant_entities = [entity for entity in candidate_entities if entity["name"] in relevant_names]
+                else:
+                    metrics.increment("cse.llm_calls_saved.relevance")
+                metrics.increment("cse.stage.filtered_out", len(candidate_entities) - len(relevant_entities))
+
+                # summarize stage, only for the survivors
+                surviving_summaries = sum(cse.does_entity_need_summary(entity) for entity in relevant_entities)
+                metrics.increment("cse.summaries_saved", entities_needing_summary - surviving_summaries)
+                if entities_needing_summary and not surviving_summaries:
+                    metrics.increment("cse.llm_calls_saved.summary")
+
+                final_cse_responses = cse.summarize_custom_data_entities(user_id, relevant_entities)
+                metrics.observe("cse.tick_time", time.time() - cse_start_time)
+                if final_cse_responses:
+                    metrics.increment("cse.stage.shown", len(final_cse_responses))
                     # print("=== CSE RESPONSES FILTERED: {} ===".format(final_cse_responses))
-
                     db_handler.add_cse_results_for_user(
-                        transcript["user_id"], final_cse_responses
+                        user_id, final_cse_responses
                     )
+                    relevance_filter.record_shown_terms(user_id, [cse_response["name"] for cse_response in final_cse_responses])
         except Exception as e:
-            cse_responses = None
             print("Exception in CSE...:")
             print(e)
             traceback.print_exc()
@@ -208,12 +231,65 @@ def cse_loop():
             p_loop_end_time = time.time()
             # print("=== processing_loop completed in {} seconds overall ===".format(
             #     round(p_loop_end_time - p_loop_start_time, 2)))
+            metrics.log_metrics_if_due("cse_loop")
 
         loop_run_period = 1.5 #run the loop this often
         while (time.time() - loop_start_time) < loop_run_period: #wait until loop_run_period has passed before running this again
             time.sleep(0.2)
 
 
+def run_custom_data_job(db_handler, job):
+    print("Running custom data job {} for user {}".format(job["job_id"], job["user_id"]))
+    last_progress_time = 0
+
+    def progress_callback(rows_done, rows_total):
+        nonlocal last_progress_time
+        if (time.time() - last_progress_time) < CUSTOM_DATA_JOB_PROGRESS_INTERVAL and rows_done < rows_total:
+            return
+        last_progress_time = time.time()
+        db_handler.update_custom_data_job_progress(job["job_id"], rows_done, rows_total)
+
+    # the CSE picks up the new data and the swapped-in index on its next reload check
+    ingest_custom_data_csv(job["upload_path"], job["user_id"], progress_callback=progress_callback,
+                           data_file_path=job.get("data_path"),
+                           save_data_file_path=lambda data_path: db_handler.set_custom_data_job_data_path(job["job_id"], data_path))
+
+
+def custom_data_ingestion_loop():
+    print("START CUSTOM DATA INGESTION LOOP")
+
+    db_handler = DatabaseHandler(parent_handler=False)
+    requeued_jobs = False
+
+    while True:
+        if not db_handler.ready:
+            print("db_handler not ready")
+            time.sleep(0.1)
+            continue
+
+        if not requeued_jobs:
+            # jobs left running by a previous process get picked up again - ingestion is incremental, so this is cheap
+            print("Requeued {} interrupted custom data jobs".format(db_handler.requeue_running_custom_data_jobs()))
+            requeued_jobs = True
+
+        job = None
+        try:
+            job = db_handler.claim_next_custom_data_job()
+            if job is None:
+                time.sleep(1)
+                continue
+
+            run_custom_data_job(db_handler, job)
+            db_handler.finish_custom_data_job(job["job_id"], "done")
+            print("--- Done custom data job {} for user {}".format(job["job_id"], job["user_id"]))
+        except Exception as e:
+            print("Exception in custom data ingestion...:")
+            print(e)
+            traceback.print_exc()
+            if job is not None:
+                db_handler.finish_custom_data_job(job["job_id"], "failed", error=str(e))
+
+
 #frontends poll this to get the results from our processing of their transcripts
 async def ui_poll_handler(request, minutes=0.5):
     # parse request
@@ -282,55 +358,122 @@ async def return_image_handler(request):
     return Response(body=data, content_type="image/jpg")
 
 
+def remove_upload(upload_path):
+    if os.path.exists(upload_path):
+        os.remove(upload_path)
+
+
 # frontend can upload CSVs to run custom data search on
-# DEV: we don't use this and it's not exposed on the frontend as it's currently broken and low priority
+# the upload is streamed to disk and queued as an ingestion job, see custom_data_ingestion_loop
 async def upload_user_data_handler(request):
-    # Check file size before doing anything else
     try:
-        post_data = await request.post()
-    except web_exceptions.HTTPRequestEntityTooLarge:
-        return web.Response(text="File too large. Max file size: {}MB".format(MAX_FILE_SIZE_MB), status=413)
+        reader = await request.multipart()
+    except Exception:
+        return web.Response(text="Expected a multipart upload", status=400)
+
+    job_id = str(uuid.uuid4())
+    os.makedirs(CUSTOM_DATA_UPLOADS_PATH, exist_ok=True)
+    upload_path = os.path.join(CUSTOM_DATA_UPLOADS_PATH, "{}.csv".format(job_id))
+    max_file_size = 1024*1024*MAX_FILE_SIZE_MB
+
+    # file I/O runs in the executor so a big upload doesn't stall every other request
+    loop = asyncio.get_running_loop()
+    user_id = None
+    got_file = False
+    while True:
+        field = await reader.next()
+        if field is None:
+            break
+
+        if field.name == 'user_id':
+            user_id = await field.text()
+        elif field.name == 'custom-file':
+            # Check if the file is a CSV file by looking at its content type
+            if field.headers.get('Content-Type') != 'text/csv':
+                return web.Response(text="Uploaded file is not a CSV", status=400)
+
+            # write the file a chunk at a time instead of holding the whole upload in memory
+            file_size = 0
+            f = await loop.run_in_executor(agent_executor, open, upload_path, 'wb')
+            try:
+                while True:
+                    chunk = await field.read_chunk()
+                    if not chunk:
+                        break
+                    file_size += len(chunk)
+                    if file_size > max_file_size:
+                        break
+                    await loop.run_in_executor(agent_executor, f.write, chunk)
+            finally:
+                await loop.run_in_executor(agent_executor, f.close)
+            if file_size > max_file_size:
+                remove_upload(upload_path)
+                return web.Response(text="File too large. Max file size: {}MB".format(MAX_FILE_SIZE_MB), status=413)
+            got_file = True
+
+    if not (got_file and user_id):
+        remove_upload(upload_path)
+        return web.Response(text="Missing user file or user ID in the received data", status=400)
 
-    user_file = post_data.get('custom-file')
-    user_id = post_data.get('user_id')
+    # Validate data, only the header is read here - the rows are parsed by the ingestion job
+    try:
+        columns = (await loop.run_in_executor(agent_executor, partial(pd.read_csv, upload_path, nrows=0))).columns
+    except Exception:
+        remove_upload(upload_path)
+        return web.Response(text="Could not read CSV", status=400)
+    if ('title' not in columns) or ('description' not in columns) or ('url' not in columns):
+        remove_upload(upload_path)
+        return web.Response(text="Bad data format", status=400)
 
-    if user_file and user_id:
-        # Check if the file is a CSV file by looking at its content type
-        if user_file.content_type != 'text/csv':
-            return web.Response(text="Uploaded file is not a CSV", status=400)
+    db_handler.add_custom_data_job(user_id, upload_path, job_id=job_id)
 
-        # Validate data
-        try:
-            df = pd.read_csv(user_file.file)
-        except Exception:
-            return web.Response(text="Could not read CSV", status=400)
+    return web.Response(text=json.dumps({'success': True, 'message': "Custom data upload queued", 'jobId': job_id}), status=200)
 
-        #if not cse.is_custom_data_valid(df):
-            #return web.Response(text="Bad data format", status=400)
-#
-        #cse.upload_custom_user_data(user_id, df)
+# poll the progress of a custom data upload
+async def upload_user_data_status_handler(request):
+    body = await request.json()
+    user_id = body.get('userId')
+    job_id = body.get('jobId')
 
-        return web.Response(text="Custom data uploaded successfully", status=200)
-    else:
-        return web.Response(text="Missing user file or user ID in the received data", status=400)
+    # 400 if missing params
+    if user_id is None or user_id == '':
+        print("user_id none in upload_userdata_status, exiting with error response 400.")
+        return web.Response(text='no userId in request', status=400)
+    if job_id is None or job_id == '':
+        print("job_id none in upload_userdata_status, exiting with error response 400.")
+        return web.Response(text='no jobId in request', status=400)
+
+    job = db_handler.get_custom_data_job_for_user(user_id, job_id)
+    if job is None:
+        return web.Response(text='no such job', status=404)
+
+    job.pop("upload_path", None)
+    return web.Response(text=json.dumps({'success': True, 'job': job}), status=200)
 
 async def expert_agent_runner(expert_agent_name, user_id):
     print("Starting agent run task of agent {} for user {}".format(expert_agent_name, user_id))
     #get the context for the last n minutes
     n_seconds = 5*60
-    convo_context = db_handler.get_transcripts_from_last_nseconds_for_user_as_string(user_id, n_seconds)
+    # updating the rolling summary embeds sentences, which would stall the web loop
+    loop = asyncio.get_running_loop()
+    convo_context = await loop.run_in_executor(agent_executor, partial(get_rolling_context_for_user, db_handler, user_id, raw_seconds=n_seconds))
 
     #get the most recent insights for this user
     # insights_history = db_handler.get_agent_insights_history_for_user(user_id)
-    insights_history = db_handler.get_recent_nminutes_agent_insights_history_for_user(user_id)
-    insights_history = [insight["insight"] for insight in insights_history]
+    insights_history = db_handler.get_recent_nminutes_agent_insights_history_for_user(user_id)[:INSIGHTS_HISTORY_IN_PROMPT]
+    insights_history = [insight["agent_insight"] for insight in insights_history]
 
-    #spin up the agent
-    agent_insight = await arun_single_expert_agent(expert_agent_name, convo_context, insights_history)
+    #spin up the agent, it's background work like the proactive agents even though it runs in the web process
+    with llm_priority(PRIORITY_PROACTIVE):
+        agent_insight = await arun_single_expert_agent(expert_agent_name, convo_context, insights_history)
 
-    #save this insight to the DB for the user
+    #save this insight to the DB for the user, unless it's a near duplicate of a recent one
     if agent_insight != None and agent_insight["agent_insight"] != None:
-        db_handler.add_agent_insight_result_for_user(user_id, agent_insight["agent_name"], agent_insight["agent_insight"], agent_insight["reference_url"])
+        # MiniLM encoding (and loading it the first time) would stall every request this loop serves
+        loop = asyncio.get_running_loop()
+        unique_insights = await loop.run_in_executor(agent_executor, insight_deduplicator.filter_insights, user_id, [agent_insight])
+        for insight, embedding in unique_insights:
+            db_handler.add_agent_insight_result_for_user(user_id, insight["agent_name"], insight["agent_insight"], insight["reference_url"], embedding=embedding)
 
     #agent run complete
     print("--- Done agent run task of agent {} from user {}".format(expert_agent_name, user_id))
@@ -412,6 +555,7 @@ if __name__ == '__main__':
     print("Starting server...")
     agent_executor = ThreadPoolExecutor()
     db_handler = DatabaseHandler()
+    insight_deduplicator = InsightDeduplicator(db_handler)
 
     # start proccessing loop subprocess to process data as it comes in
     if USE_GPU_FOR_INFERENCING:
@@ -422,6 +566,11 @@ if __name__ == '__main__':
     cse_process = multiprocessing.Process(target=cse_loop)
     cse_process.start()
 
+    # start the custom data ingestion process
+    print("Starting custom data ingestion process...")
+    custom_data_ingestion_process = multiprocessing.Process(target=custom_data_ingestion_loop)
+    custom_data_ingestion_process.start()
+
     # start intelligent definer agent process
     print("Starting Intelligent Definer Agent process...")
     intelligent_definer_agent_process = multiprocessing.Process(target=proactive_definer_processing_loop)
@@ -447,6 +596,7 @@ if __name__ == '__main__':
             web.post('/button_event', button_handler),
             web.post('/ui_poll', ui_poll_handler),
             web.post('/upload_userdata', upload_user_data_handler),
+            web.post('/upload_userdata_status', upload_user_data_status_handler),
             web.get('/image', return_image_handler),
             web.post('/run_single_agent', run_single_expert_agent_handler),
             web.post('/send_agent_chat', send_agent_chat_handler),
@@ -473,3 +623,4 @@ if __name__ == '__main__':
     intelligent_definer_agent_process.join()
     cse_process.join()
     explicit_background_process.join()
+    custom_data_ingestion_process.join()
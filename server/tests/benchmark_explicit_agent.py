@@ -0,0 +1,63 @@
+# time-to-first-LLM-call of explicit queries, rebuilding the agent graph per query (the old way) vs the cached graph
+# runs offline, with synthetic LLM and search responses from helpers/simulator.py
+#
+#   python3 benchmark_explicit_agent.py --queries 10
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers.simulator import Simulator
+from Modules.RateLimiter import use_in_process_rate_limiter
+from agents.explicit_meta_agent import explicit_meta_agent_prompt_blueprint, explicit_transcript, FirstLLMCallTimer, build_explicit_meta_agent, get_explicit_meta_agent
+
+CONTEXT = "We were talking about how the Roman aqueducts carried water into the city for hundreds of years."
+QUERIES = ["How long were the Roman aqueducts?", "Who built the first aqueduct?", "How much water did they carry per day?"]
+
+
+async def time_query(query, rebuild):
+    start_time = time.time()
+    timer = FirstLLMCallTimer(start_time)
+    agent = build_explicit_meta_agent() if rebuild else get_explicit_meta_agent()
+    explicit_transcript.set("{}\nQuery: {}".format(CONTEXT, query))
+    prompt = explicit_meta_agent_prompt_blueprint.format(conversation_context=CONTEXT, query=query)
+    await agent.arun(prompt, callbacks=[timer])
+    return timer.time_to_first_llm_call, time.time() - start_time
+
+
+async def run_benchmark(num_queries, rebuild):
+    results = []
+    for i in range(num_queries):
+        results.append(await time_query(QUERIES[i % len(QUERIES)], rebuild))
+    return results
+
+
+def print_results(name, results):
+    first_call_times = sorted(result[0] for result in results if result[0] is not None)
+    total_times = sorted(result[1] for result in results)
+    print("{:<10} time to first LLM call: mean {:.3f}s, max {:.3f}s | total: mean {:.3f}s".format(
+        name, sum(first_call_times) / len(first_call_times), first_call_times[-1], sum(total_times) / len(total_times)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=10)
+    args = parser.parse_args()
+
+    use_in_process_rate_limiter()
+    simulator = Simulator("synthetic")
+    simulator.install()
+    try:
+        rebuild_results = asyncio.run(run_benchmark(args.queries, rebuild=True))
+        # the server builds the cached graph when the worker starts, so that isn't part of any query
+        get_explicit_meta_agent()
+        cached_results = asyncio.run(run_benchmark(args.queries, rebuild=False))
+    finally:
+        simulator.uninstall()
+
+    print("\n=== EXPLICIT AGENT BENCHMARK ===")
+    print_results("rebuild", rebuild_results)
+    print_results("cached", cached_results)
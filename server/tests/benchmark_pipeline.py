@@ -0,0 +1,107 @@
+# benchmark the definer, proactive agents and explicit agent pipelines on lex transcripts, offline
+# every LLM, search, scrape and Wolfram Alpha call goes to helpers/simulator.py instead of the network
+#
+#   python3 benchmark_pipeline.py --mode synthetic --users 8 --windows 5
+#   python3 benchmark_pipeline.py --mode record --cassette lex_cassette.json   (needs api keys, once)
+#   python3 benchmark_pipeline.py --mode replay --cassette lex_cassette.json --replay-latency
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from test_on_lex import load_lex_transcripts
+from helpers.simulator import Simulator
+from Modules.RateLimiter import use_in_process_rate_limiter
+import helpers.metrics as metrics
+from agents.proactive_definer_agent import run_proactive_definer_agent_async
+from agents.proactive_meta_agent import run_proactive_meta_agent_and_experts_async
+from agents.explicit_meta_agent import run_explicit_meta_agent_async
+
+EXPLICIT_QUERY = "What is the most important idea they just talked about?"
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def timed(latencies, stage, coroutine):
+    start_time = time.time()
+    try:
+        await coroutine
+    except Exception as e:
+        print("{} failed: {}".format(stage, e))
+        latencies.setdefault(stage + ".errors", []).append(1)
+    latencies.setdefault(stage, []).append(time.time() - start_time)
+
+
+async def run_user(latencies, windows, explicit_every):
+    # one simulated wearer, working through their transcript windows one after another like the server would
+    for i, window in enumerate(windows):
+        tasks = [timed(latencies, "definer", run_proactive_definer_agent_async(window)),
+                 timed(latencies, "proactive", run_proactive_meta_agent_and_experts_async(window, []))]
+        if explicit_every and i % explicit_every == 0:
+            tasks.append(timed(latencies, "explicit", run_explicit_meta_agent_async(window, EXPLICIT_QUERY)))
+        start_time = time.time()
+        await asyncio.gather(*tasks)
+        latencies.setdefault("window", []).append(time.time() - start_time)
+
+
+async def run_benchmark(users_windows, explicit_every):
+    latencies = dict()
+    start_time = time.time()
+    await asyncio.gather(*[run_user(latencies, windows, explicit_every) for windows in users_windows])
+    return latencies, time.time() - start_time
+
+
+def print_report(latencies, total_time):
+    print("\n=== PIPELINE BENCHMARK ===")
+    print("{:<12}{:>8}{:>10}{:>10}{:>10}{:>10}".format("stage", "count", "p50", "p95", "p99", "max"))
+    for stage, values in sorted(latencies.items()):
+        if stage.endswith(".errors"):
+            continue
+        print("{:<12}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+            stage, len(values), percentile(values, 50), percentile(values, 95), percentile(values, 99), max(values)))
+    for stage, values in sorted(latencies.items()):
+        if stage.endswith(".errors"):
+            print("{}: {}".format(stage, len(values)))
+    print("windows per second: {:.2f} ({} windows in {:.1f}s)".format(
+        len(latencies.get("window", [])) / total_time, len(latencies.get("window", [])), total_time))
+    print("metrics: {}".format(json.dumps(metrics.snapshot(), indent=2)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["record", "replay", "synthetic"], default="synthetic")
+    parser.add_argument("--cassette", default=None, help="cassette file to record to or replay from")
+    parser.add_argument("--users", type=int, default=4, help="simulated users running at the same time")
+    parser.add_argument("--windows", type=int, default=5, help="transcript windows per user")
+    parser.add_argument("--window-seconds", type=int, default=60, help="seconds of transcript in each window")
+    parser.add_argument("--explicit-every", type=int, default=3, help="run an explicit query every n windows, 0 for never")
+    parser.add_argument("--replay-latency", action="store_true", help="replay responses after as long as they took when recorded")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # benchmarks shouldn't share rate limit buckets with a server running on the same machine
+    use_in_process_rate_limiter()
+
+    # the same transcripts every run with the same seed, so replays hit the cassette
+    random.seed(args.seed)
+    transcripts = load_lex_transcripts(random_n=args.users, transcript_folder="./lex_whisper_transcripts", chunk_time_seconds=args.window_seconds)
+    convo_names = sorted(transcripts.keys())
+    users_windows = [transcripts[convo_names[i % len(convo_names)]][:args.windows] for i in range(args.users)]
+
+    simulator = Simulator(args.mode, cassette_path=args.cassette, seed=args.seed, replay_latency=args.replay_latency)
+    simulator.install()
+    try:
+        latencies, total_time = asyncio.run(run_benchmark(users_windows, args.explicit_every))
+    finally:
+        simulator.uninstall()
+    print_report(latencies, total_time)
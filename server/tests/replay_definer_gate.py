@@ -0,0 +1,117 @@
+# replay the definer test transcripts through the definer loop's schedule and check the definer gate against
+# hand labeled entities (definer_test_transcripts/definer-test-entities.json)
+# reports the gate's precision and recall on transcript windows and how many definer LLM calls it saves
+#
+#   python3 replay_definer_gate.py
+#   python3 replay_definer_gate.py --rare-word-score 0.5 --verbose
+import os
+import re
+import sys
+import json
+import argparse
+
+SERVER_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_FOLDER)
+
+from Modules.DefinerGate import DefinerGate
+from constants import DEFINER_GATE_RARE_WORD_SCORE, DEFINER_GATE_PROPER_NOUN_SCORE
+
+TRANSCRIPT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "definer_test_transcripts")
+LABELS_FILE_NAME = "definer-test-entities.json"
+TICK_SECONDS = 10 # the definer loop runs every 10s
+TRANSCRIPT_SECONDS = 20 # on the last 20s of each user's transcript
+MIN_TRANSCRIPT_CHARS = 60 # and skips anything shorter
+
+
+def parse_timestamp(timestamp):
+    hours, minutes, seconds = timestamp.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def load_cues(vtt_path):
+    """
+    Returns [(start timestamp, end seconds, text)] for the cues in a vtt file, without the "Alex:" speaker labels.
+    """
+    with open(vtt_path, "r", encoding="utf-8") as f:
+        content = f.read()
+    cues = []
+    for start, end, text in re.findall(r"^(\S+) --> (\S+)\n(.+)$", content, re.M):
+        text = re.sub(r"^\w+:\s*", "", text.strip())
+        cues.append((start, parse_timestamp(end), text))
+    return cues
+
+
+def replay_transcript(cues, labels, gate):
+    """
+    Returns one entry per definer loop tick with a long enough window: the cues in it, whether any of them has
+    a labeled entity, and what the gate said.
+    """
+    windows = []
+    last_tick = int(max(end for _, end, _ in cues))
+    for tick in range(TICK_SECONDS, last_tick + TICK_SECONDS, TICK_SECONDS):
+        window_cues = [cue for cue in cues if tick - TRANSCRIPT_SECONDS < cue[1] <= tick]
+        text = " ".join(cue[2] for cue in window_cues)
+        if len(text) < MIN_TRANSCRIPT_CHARS:
+            continue
+        should_run, reason, candidates = gate.check("replay", text)
+        windows.append({"tick": tick, "text": text, "cues": [cue[0] for cue in window_cues],
+                        "labeled": any(labels.get(cue[0]) for cue in window_cues),
+                        "passed": should_run, "reason": reason, "candidates": candidates})
+    return windows
+
+
+def report(name, windows, labels, verbose=False):
+    true_positives = sum(1 for window in windows if window["passed"] and window["labeled"])
+    false_positives = sum(1 for window in windows if window["passed"] and not window["labeled"])
+    false_negatives = sum(1 for window in windows if not window["passed"] and window["labeled"])
+    passed = true_positives + false_positives
+    precision = true_positives / passed if passed else 0
+    recall = true_positives / (true_positives + false_negatives) if true_positives + false_negatives else 0
+
+    # an entity is only lost if every window it was said in got skipped
+    passed_cues = {cue for window in windows if window["passed"] for cue in window["cues"]}
+    entities = [(cue, entity) for cue in labels for entity in labels[cue]]
+    missed_entities = [entity for cue, entity in entities if cue not in passed_cues]
+
+    print("{}: gate precision {:.2f}, recall {:.2f}, definer calls without gate: {}, with gate: {}, saved: {:.0%}, entities missed: {}/{}".format(
+        name, precision, recall, len(windows), passed, 1 - passed / len(windows) if windows else 0, len(missed_entities), len(entities)))
+    if verbose:
+        for window in windows:
+            if window["passed"] and not window["labeled"]:
+                print("  false positive at {}s ({}: {}): {}".format(window["tick"], window["reason"], window["candidates"], window["text"]))
+            elif not window["passed"] and window["labeled"]:
+                print("  skipped at {}s: {}".format(window["tick"], window["text"]))
+        for entity in missed_entities:
+            print("  missed entity: {}".format(entity))
+    return true_positives, false_positives, false_negatives, len(windows), len(missed_entities), len(entities)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rare-word-score", type=float, default=DEFINER_GATE_RARE_WORD_SCORE)
+    parser.add_argument("--proper-noun-score", type=float, default=DEFINER_GATE_PROPER_NOUN_SCORE)
+    parser.add_argument("--verbose", action="store_true", help="print the windows the gate got wrong")
+    args = parser.parse_args()
+
+    with open(os.path.join(TRANSCRIPT_FOLDER, LABELS_FILE_NAME), "r", encoding="utf-8") as f:
+        all_labels = json.load(f)
+
+    # the word frequency indexes are loaded from ./pickles
+    os.chdir(SERVER_FOLDER)
+    gate = DefinerGate(rare_word_score=args.rare_word_score, proper_noun_score=args.proper_noun_score)
+
+    totals = [0] * 6
+    for file_name in sorted(all_labels.keys()):
+        cues = load_cues(os.path.join(TRANSCRIPT_FOLDER, file_name))
+        windows = replay_transcript(cues, all_labels[file_name], gate)
+        totals = [total + count for total, count in zip(totals, report(file_name, windows, all_labels[file_name], verbose=args.verbose))]
+
+    true_positives, false_positives, false_negatives, calls, missed_entities, entities = totals
+    passed = true_positives + false_positives
+    print("\n=== DEFINER GATE REPLAY ===")
+    print("gate precision: {:.2f}, recall: {:.2f}".format(
+        true_positives / passed if passed else 0,
+        true_positives / (true_positives + false_negatives) if true_positives + false_negatives else 0))
+    print("definer calls without gate: {}, with gate: {}, saved: {} ({:.0%})".format(
+        calls, passed, calls - passed, 1 - passed / calls if calls else 0))
+    print("labeled entities never sent to the definer: {}/{}".format(missed_entities, entities))
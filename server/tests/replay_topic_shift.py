@@ -0,0 +1,132 @@
+# replay lex transcripts through the proactive agents loop's schedule, with and without the topic shift gate
+# reports how many proactive meta agent calls the gate saves and, with --agents, how many insights it loses
+#
+#   python3 replay_topic_shift.py --convos 5
+#   python3 replay_topic_shift.py --convos 3 --agents --mode replay --cassette lex_cassette.json
+import os
+import sys
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from test_on_lex import load_lex_transcripts
+from Modules.TopicShiftDetector import TopicShiftDetector, embed_window, SKIP_MIN_INTERVAL
+from Modules.Summarizer import encode_texts
+from Modules.RateLimiter import use_in_process_rate_limiter
+from constants import TOPIC_SHIFT_THRESHOLD, TOPIC_SHIFT_MIN_INTERVAL, TOPIC_SHIFT_MAX_INTERVAL
+
+TRANSCRIPT_SECONDS = 240 # what the proactive agents loop sends the meta agent
+MIN_TRANSCRIPT_CHARS = 400 # the proactive agents loop skips anything shorter
+
+
+def replay_convo(chunks, tick_seconds, detector):
+    """
+    Returns one entry per loop tick that the ungated loop would run the meta agent on: (tick, window text, gated run?)
+    """
+    windows = []
+    chunks_per_window = max(1, TRANSCRIPT_SECONDS // tick_seconds)
+    for tick in range(len(chunks)):
+        text = " ".join(chunks[max(0, tick + 1 - chunks_per_window):tick + 1])
+        if len(text) < MIN_TRANSCRIPT_CHARS:
+            continue
+        now = tick * tick_seconds
+        should_run, reason, drift, embedding = detector.should_run("replay", text, now=now)
+        if should_run:
+            detector.mark_run("replay", embedding, now=now)
+        elif reason == SKIP_MIN_INTERVAL:
+            # the detector doesn't embed inside the min interval, work out whether this tick was a topic change it delayed
+            last_embedding = detector.last_runs["replay"][1]
+            drift = 1.0 - float(np.dot(embed_window(text), last_embedding))
+        windows.append({"tick": tick, "text": text, "gated_run": should_run, "reason": reason, "drift": drift})
+    return windows
+
+
+def count_new_insights(insights, similarity):
+    # insights that aren't a near duplicate of an earlier one
+    if not insights:
+        return []
+    embeddings = encode_texts(insights)
+    kept = []
+    for i in range(len(insights)):
+        if all(float(np.dot(embeddings[i], embeddings[j])) < similarity for j in kept):
+            kept.append(i)
+    return kept
+
+
+async def run_agents_on_windows(windows):
+    from agents.proactive_meta_agent import run_proactive_meta_agent_and_experts_async
+    for window in windows:
+        try:
+            insights = await run_proactive_meta_agent_and_experts_async(window["text"], [])
+        except Exception as e:
+            print("Proactive agents failed on tick {}: {}".format(window["tick"], e))
+            insights = []
+        window["insights"] = [insight["agent_insight"] for insight in insights
+                              if insight is not None and insight.get("agent_insight") not in (None, "null")]
+
+
+def report_insights(windows, similarity):
+    baseline_insights = [insight for window in windows for insight in window["insights"]]
+    gated_insights = [insight for window in windows if window["gated_run"] for insight in window["insights"]]
+    baseline_new = [baseline_insights[i] for i in count_new_insights(baseline_insights, similarity)]
+    gated_new = [gated_insights[i] for i in count_new_insights(gated_insights, similarity)]
+
+    # a distinct ungated insight is lost if no gated insight says nearly the same thing
+    lost = baseline_new
+    if baseline_new and gated_new:
+        similarities = encode_texts(baseline_new) @ encode_texts(gated_new).T
+        lost = [insight for insight, row in zip(baseline_new, similarities) if row.max() < similarity]
+    print("distinct insights without gate: {}, with gate: {}, lost: {}".format(len(baseline_new), len(gated_new), len(lost)))
+    for insight in lost:
+        print("  lost: {}".format(insight))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--convos", type=int, default=5, help="lex conversations to replay")
+    parser.add_argument("--tick-seconds", type=int, default=30, help="seconds between proactive agents loop cycles")
+    parser.add_argument("--threshold", type=float, default=TOPIC_SHIFT_THRESHOLD)
+    parser.add_argument("--min-interval", type=int, default=TOPIC_SHIFT_MIN_INTERVAL)
+    parser.add_argument("--max-interval", type=int, default=TOPIC_SHIFT_MAX_INTERVAL)
+    parser.add_argument("--agents", action="store_true", help="also run the proactive agents on every window to count insights lost")
+    parser.add_argument("--mode", choices=["record", "replay", "synthetic"], default="replay", help="simulator mode for --agents")
+    parser.add_argument("--cassette", default=None, help="simulator cassette for --agents")
+    parser.add_argument("--insight-similarity", type=float, default=0.8, help="cosine similarity above which two insights are the same")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    transcripts = load_lex_transcripts(random_n=args.convos, transcript_folder="./lex_whisper_transcripts", chunk_time_seconds=args.tick_seconds)
+
+    all_windows = []
+    for convo_name in sorted(transcripts.keys()):
+        detector = TopicShiftDetector(threshold=args.threshold, min_interval=args.min_interval, max_interval=args.max_interval)
+        windows = replay_convo(transcripts[convo_name], args.tick_seconds, detector)
+        gated_runs = sum(window["gated_run"] for window in windows)
+        print("{}: {} meta agent calls without gate, {} with".format(convo_name, len(windows), gated_runs))
+        all_windows.extend(windows)
+
+    baseline_calls = len(all_windows)
+    gated_calls = sum(window["gated_run"] for window in all_windows)
+    delayed = sum(1 for window in all_windows if window["reason"] == SKIP_MIN_INTERVAL and window["drift"] >= args.threshold)
+    print("\n=== TOPIC SHIFT GATE REPLAY ===")
+    print("meta agent calls without gate: {}, with gate: {}, saved: {:.0%}".format(
+        baseline_calls, gated_calls, 1 - gated_calls / baseline_calls if baseline_calls else 0))
+    for reason in sorted(set(window["reason"] for window in all_windows)):
+        print("  {}: {}".format(reason, sum(1 for window in all_windows if window["reason"] == reason)))
+    print("topic changes delayed by the min interval: {}".format(delayed))
+
+    if args.agents:
+        from helpers.simulator import Simulator
+        use_in_process_rate_limiter()
+        simulator = Simulator(args.mode, cassette_path=args.cassette, seed=args.seed)
+        simulator.install()
+        try:
+            asyncio.run(run_agents_on_windows(all_windows))
+        finally:
+            simulator.uninstall()
+        report_insights(all_windows, args.insight_similarity)
@@ -3,6 +3,7 @@ import json
 import time
 import test_on_lex
 import multiprocessing
+import os
 
 TEST_USERID = "caydenLexTester"
 TEST_DEVICEID = "testDeviceId"
@@ -10,7 +11,8 @@ TEST_DEVICEID = "testDeviceId"
 server_endpoint = '/dev2'
 URL = "https://vpmkebx0cl.execute-api.us-east-2.amazonaws.com/api"
 
-URI = URL + server_endpoint
+# point the tests at another backend, e.g. CONVOSCOPE_TEST_URL=http://localhost:8080 for a local server
+URI = os.environ.get("CONVOSCOPE_TEST_URL", URL + server_endpoint)
 UI_POLL_ENDPOINT = URI + "/ui_poll"
 CHAT_ENDPOINT = URI + "/chat"
 PLAYBACK_SPEED = 2